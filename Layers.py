@@ -207,12 +207,8 @@ class PhotonHeader(Packet):
         PacketListField("commands", None, CommandWrapper, count_from=lambda p:(p.command_count))
     ]
 
-# oprts used by the master, game(per map) and chat(maybe known as Nameserver in PUN) servers
-albion_ports = [
-    4535,
-    5055,
-    5056
-]
+# defined without Scapy, for the capture paths not using these layers
+from photon_decoder import albion_ports
 
 for bport in albion_ports:
     bind_layers(UDP, PhotonHeader, sport=bport)
@@ -1,4 +1,9 @@
-from struct import unpack
+from struct import unpack, unpack_from, Struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 '''
 A library for decoding Photon's Protocol16 used for their PUN(Photon Unity Network) library
@@ -139,6 +144,53 @@ def generic_Array_parser(data, size, parser_func):
     return parsed, data
 
 
+# struct format, numpy dtype and size of the fixed size types that can be decoded in bulk
+bulk_array_formats = {
+    ord("b"): ("B", ">u1", 1),
+    ord("k"): ("H", ">u2", 2),
+    ord("i"): ("I", ">u4", 4),
+    ord("l"): ("Q", ">u8", 8),
+    ord("f"): ("f", ">f4", 4),
+    ord("d"): ("d", ">f8", 8),
+}
+
+numpy_arrays = False
+
+def use_numpy_arrays(enabled=True):
+    '''
+    Opt-in to decoding numeric and boolean arrays("y" and "n") as numpy arrays instead of lists
+    '''
+    global numpy_arrays
+    if enabled and numpy is None:
+        raise ImportError("numpy is required for decoding to numpy arrays")
+    numpy_arrays = enabled
+
+
+def bulk_Array_parser_at(data, offset, size, type_code):
+    '''
+    Helper function for decoding an array of fixed size elements in one go,
+    type_code has to be in bulk_array_formats or be a Boolean
+
+    returns (parsed, new_offset)
+    '''
+    if type_code == ord("o"):
+        return bulk_BooleanArray_parser_at(data, offset, size)
+
+    struct_format, dtype, item_size = bulk_array_formats[type_code]
+    if numpy_arrays:
+        # astype copies to native byte order, so the result doesn't pin data
+        parsed = numpy.frombuffer(data, dtype, size, offset)
+        return parsed.astype(parsed.dtype.newbyteorder("=")), offset + size * item_size
+
+    return list(unpack_from(f">{size}{struct_format}", data, offset)), offset + size * item_size
+
+def bulk_BooleanArray_parser_at(data, offset, size):
+    if numpy_arrays:
+        return numpy.frombuffer(data, numpy.uint8, size, offset) > 0, offset + size
+
+    return list(map(bool, data[offset:offset+size])), offset + size
+
+
 @add_datatype_parser("a")
 def Parse_StringArray(data):
     size, data = Parse_Short(data)
@@ -148,18 +200,22 @@ def Parse_StringArray(data):
 def Parse_Array(data):
     size,data = Parse_Short(data)
     type_code, data = Parse_Byte(data)
+    if type_code in bulk_array_formats or type_code == ord("o"):
+        parsed, offset = bulk_Array_parser_at(data, 0, size, type_code)
+        return parsed, data[offset:]
     return generic_Array_parser(data, size, datatype_parsers[type_code])
 
 @add_datatype_parser("x")
 def Parse_ByteArray(data):
     size, data = Parse_Integer(data)
-    parsed, data = generic_Array_parser(data, size, Parse_Byte)
+    parsed, data = get(data, size)
     return bytes(parsed), data
 
 @add_datatype_parser("n")
 def Parse_BooleanArray(data):
     size, data = Parse_Short(data)
-    return generic_Array_parser(data, size, Parse_Boolean)
+    parsed, offset = bulk_BooleanArray_parser_at(data, 0, size)
+    return parsed, data[offset:]
 
 @add_datatype_parser("z")
 def Parse_ObjectArray(data):
@@ -211,3 +267,358 @@ def Parse_OperationRequest(data):
     code, data = Parse_Byte(data)
     parameters, data = Parse_Parameters(data)
     return (code, parameters), data
+
+
+'''
+Offset based decoder
+
+The parsers above return the unparsed remainder(data[n:]) which copies the rest of the payload
+for every decoded field, making big messages cost O(n²).
+The *_at variants walk a single buffer(bytes or memoryview) with a moving offset
+and return (parsed, new_offset) instead, without copying anything that isn't part of the result.
+
+They produce the same objects as their slicing counterparts, eg:
+    Parse_EventData(data)[0] == Parse_EventData_at(data)[0]
+'''
+
+datatype_offset_parsers = {}
+
+
+def add_datatype_offset_parser(key):
+    '''
+    Decorator generator for registering a new offset based parser
+    '''
+
+    # decode ascii
+    if type(key) is str:
+        key = ord(key)
+
+    def add_decorator(func):
+        datatype_offset_parsers[key] = func
+        return func
+
+    return add_decorator
+
+
+U16 = Struct(">H")
+U32 = Struct(">I")
+U64 = Struct(">Q")
+F32 = Struct(">f")
+F64 = Struct(">d")
+
+
+@add_datatype_offset_parser(0)    # None
+@add_datatype_offset_parser("*")  # Null
+def Parse_None_at(data, offset=0):
+    return None, offset
+
+
+def Parse_Object_at(data, offset=0, type_code=None):
+    if type_code is None or type_code in NO_OBJECT_CODES:
+        type_code = data[offset]
+        offset += 1
+    return datatype_offset_parsers[type_code](data, offset)
+
+
+@add_datatype_offset_parser("b")
+def Parse_Byte_at(data, offset=0):
+    return data[offset], offset + 1
+
+@add_datatype_offset_parser("o")
+def Parse_Boolean_at(data, offset=0):
+    return data[offset] > 0, offset + 1
+
+@add_datatype_offset_parser("k")
+def Parse_Short_at(data, offset=0):
+    return U16.unpack_from(data, offset)[0], offset + 2
+
+@add_datatype_offset_parser("i")
+def Parse_Integer_at(data, offset=0):
+    return U32.unpack_from(data, offset)[0], offset + 4
+
+@add_datatype_offset_parser("l")
+def Parse_Long_at(data, offset=0):
+    return U64.unpack_from(data, offset)[0], offset + 8
+
+@add_datatype_offset_parser("f")
+def Parse_Float_at(data, offset=0):
+    return F32.unpack_from(data, offset)[0], offset + 4
+
+@add_datatype_offset_parser("d")
+def Parse_Double_at(data, offset=0):
+    return F64.unpack_from(data, offset)[0], offset + 8
+
+@add_datatype_offset_parser("s")
+def Parse_String_at(data, offset=0):
+    size = U16.unpack_from(data, offset)[0]
+    offset += 2
+    # bytes() so memoryviews don't leak out and pin the whole packet
+    return bytes(data[offset:offset+size]), offset + size
+
+
+def generic_Array_parser_at(data, offset, size, parser_func):
+    '''
+    Helper function for decoding an array with a provided offset based parser function
+    '''
+    parsed = []
+    for _ in range(size):
+        temp, offset = parser_func(data, offset)
+        parsed.append(temp)
+
+    return parsed, offset
+
+
+@add_datatype_offset_parser("a")
+def Parse_StringArray_at(data, offset=0):
+    size, offset = Parse_Short_at(data, offset)
+    return generic_Array_parser_at(data, offset, size, Parse_String_at)
+
+@add_datatype_offset_parser("y")
+def Parse_Array_at(data, offset=0):
+    size, offset = Parse_Short_at(data, offset)
+    type_code, offset = Parse_Byte_at(data, offset)
+    if type_code in bulk_array_formats or type_code == ord("o"):
+        return bulk_Array_parser_at(data, offset, size, type_code)
+    return generic_Array_parser_at(data, offset, size, datatype_offset_parsers[type_code])
+
+@add_datatype_offset_parser("x")
+def Parse_ByteArray_at(data, offset=0):
+    size, offset = Parse_Integer_at(data, offset)
+    return bytes(data[offset:offset+size]), offset + size
+
+@add_datatype_offset_parser("n")
+def Parse_BooleanArray_at(data, offset=0):
+    size, offset = Parse_Short_at(data, offset)
+    return bulk_BooleanArray_parser_at(data, offset, size)
+
+@add_datatype_offset_parser("z")
+def Parse_ObjectArray_at(data, offset=0):
+    size, offset = Parse_Short_at(data, offset)
+    return generic_Array_parser_at(data, offset, size, Parse_Object_at)
+
+@add_datatype_offset_parser("D")
+def Parse_Dictionary_at(data, offset=0):
+    default_key_type_code = data[offset]
+    default_val_type_code = data[offset + 1]
+    size = U16.unpack_from(data, offset + 2)[0]
+    offset += 4
+
+    parsed = {}
+    for _ in range(size):
+        key, offset = Parse_Object_at(data, offset, default_key_type_code)
+        val, offset = Parse_Object_at(data, offset, default_val_type_code)
+
+        parsed[key] = val
+
+    return parsed, offset
+
+def Parse_Parameters_at(data, offset=0, keys=None):
+    '''
+    keys: only decode the parameters with these keys, the others are skipped(see Skip_Object_at), None for all of them
+    '''
+    size = U16.unpack_from(data, offset)[0]
+    offset += 2
+
+    parsed = {}
+    if keys is None:
+        for _ in range(size):
+            key = data[offset]
+            val, offset = Parse_Object_at(data, offset + 1)
+            parsed[key] = val
+
+        return parsed, offset
+
+    for _ in range(size):
+        key = data[offset]
+        if key in keys:
+            parsed[key], offset = Parse_Object_at(data, offset + 1)
+            continue
+
+        type_code = data[offset + 1]
+        offset += 2
+        if type_code in fixed_datatype_sizes:
+            offset += fixed_datatype_sizes[type_code]
+        else:
+            offset = datatype_skippers[type_code](data, offset)
+
+    return parsed, offset
+
+
+'''
+Skipping, for getting past values without decoding them
+
+Every type has a skipper returning the offset after the value, without building any python object
+for it or what it contains(the elements of arrays, the entries of dictionaries, ...)
+'''
+
+datatype_skippers = {}
+
+
+def add_datatype_skipper(key):
+    '''
+    Decorator generator for registering a new skipper
+    '''
+
+    # decode ascii
+    if type(key) is str:
+        key = ord(key)
+
+    def add_decorator(func):
+        datatype_skippers[key] = func
+        return func
+
+    return add_decorator
+
+
+# size of the fixed size types, for skipping values without decoding them
+fixed_datatype_sizes = {
+    0: 0, ord("*"): 0,
+    ord("b"): 1, ord("o"): 1,
+    ord("k"): 2,
+    ord("i"): 4, ord("f"): 4,
+    ord("l"): 8, ord("d"): 8,
+}
+
+
+def Skip_Object_at(data, offset=0, type_code=None):
+    if type_code is None or type_code in NO_OBJECT_CODES:
+        type_code = data[offset]
+        offset += 1
+    return datatype_skippers[type_code](data, offset)
+
+
+@add_datatype_skipper(0)
+@add_datatype_skipper("*")
+def Skip_None_at(data, offset=0):
+    return offset
+
+@add_datatype_skipper("b")
+@add_datatype_skipper("o")
+def Skip_Byte_at(data, offset=0):
+    return offset + 1
+
+@add_datatype_skipper("k")
+def Skip_Short_at(data, offset=0):
+    return offset + 2
+
+@add_datatype_skipper("i")
+@add_datatype_skipper("f")
+def Skip_Integer_at(data, offset=0):
+    return offset + 4
+
+@add_datatype_skipper("l")
+@add_datatype_skipper("d")
+def Skip_Long_at(data, offset=0):
+    return offset + 8
+
+@add_datatype_skipper("s")
+def Skip_String_at(data, offset=0):
+    return offset + 2 + U16.unpack_from(data, offset)[0]
+
+@add_datatype_skipper("x")
+def Skip_ByteArray_at(data, offset=0):
+    return offset + 4 + U32.unpack_from(data, offset)[0]
+
+@add_datatype_skipper("n")
+def Skip_BooleanArray_at(data, offset=0):
+    return offset + 2 + U16.unpack_from(data, offset)[0]
+
+def generic_Array_skipper_at(data, offset, size, skipper_func):
+    for _ in range(size):
+        offset = skipper_func(data, offset)
+    return offset
+
+@add_datatype_skipper("a")
+def Skip_StringArray_at(data, offset=0):
+    return generic_Array_skipper_at(data, offset + 2, U16.unpack_from(data, offset)[0], Skip_String_at)
+
+@add_datatype_skipper("y")
+def Skip_Array_at(data, offset=0):
+    size = U16.unpack_from(data, offset)[0]
+    type_code = data[offset + 2]
+    offset += 3
+    if type_code in fixed_datatype_sizes:
+        return offset + size * fixed_datatype_sizes[type_code]
+    return generic_Array_skipper_at(data, offset, size, datatype_skippers[type_code])
+
+@add_datatype_skipper("z")
+def Skip_ObjectArray_at(data, offset=0):
+    return generic_Array_skipper_at(data, offset + 2, U16.unpack_from(data, offset)[0], Skip_Object_at)
+
+@add_datatype_skipper("D")
+def Skip_Dictionary_at(data, offset=0):
+    default_key_type_code = data[offset]
+    default_val_type_code = data[offset + 1]
+    size = U16.unpack_from(data, offset + 2)[0]
+    offset += 4
+
+    for _ in range(size):
+        offset = Skip_Object_at(data, offset, default_key_type_code)
+        offset = Skip_Object_at(data, offset, default_val_type_code)
+
+    return offset
+
+def Skip_Parameters_at(data, offset=0):
+    size = U16.unpack_from(data, offset)[0]
+    offset += 2
+
+    for _ in range(size):
+        offset = Skip_Object_at(data, offset + 1)
+
+    return offset
+
+@add_datatype_skipper("e")
+@add_datatype_skipper("q")
+def Skip_EventData_at(data, offset=0):
+    return Skip_Parameters_at(data, offset + 1)
+
+@add_datatype_skipper("p")
+def Skip_OperationResponse_at(data, offset=0):
+    # code, return_code, debug_msg
+    return Skip_Parameters_at(data, Skip_Object_at(data, offset + 3))
+
+
+def Peek_Parameter_at(data, offset=0, key=None, default=None):
+    '''
+    Decodes only the parameter with the given key, default if it's missing
+    offset: the start of the parameters(the size)
+
+    The parameters before it are skipped without decoding
+    '''
+    size = U16.unpack_from(data, offset)[0]
+    offset += 2
+
+    for _ in range(size):
+        if data[offset] == key:
+            return Parse_Object_at(data, offset + 1)[0]
+
+        type_code = data[offset + 1]
+        offset += 2
+        if type_code in fixed_datatype_sizes:
+            offset += fixed_datatype_sizes[type_code]
+        else:
+            offset = datatype_skippers[type_code](data, offset)
+
+    return default
+
+
+@add_datatype_offset_parser("e")
+def Parse_EventData_at(data, offset=0, keys=None):
+    code = data[offset]
+    parameters, offset = Parse_Parameters_at(data, offset + 1, keys)
+    return (code, parameters), offset
+
+
+@add_datatype_offset_parser("p")
+def Parse_OperationResponse_at(data, offset=0, keys=None):
+    code = data[offset]
+    return_code = U16.unpack_from(data, offset + 1)[0]
+    debug_msg, offset = Parse_Object_at(data, offset + 3)
+    parameters, offset = Parse_Parameters_at(data, offset, keys)
+    return (code, return_code, debug_msg, parameters), offset
+
+@add_datatype_offset_parser("q")
+def Parse_OperationRequest_at(data, offset=0, keys=None):
+    code = data[offset]
+    parameters, offset = Parse_Parameters_at(data, offset + 1, keys)
+    return (code, parameters), offset
@@ -0,0 +1,652 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from copy import deepcopy
+from dataclasses import dataclass, field
+from functools import partial
+from datetime import datetime, timezone
+from glob import glob
+from time import perf_counter, perf_counter_ns, sleep
+from struct import pack
+from typing import Any, Callable, Dict, List, Tuple
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+import protocol16_parser as protocol16
+import photon_decoder as photon
+import pcap_reader
+import pipeline
+import metrics
+import hook_executors
+import message_log
+import traffic_generator
+import interning
+from reassembly import FragmentReassembler
+from reliable_window import ReliableWindow
+from streams import StreamSeparator, MessageStream, MessageTranslator, TRANSLATOR_IGNORE, RequestBundle, ReponseBundle, EventBundle, MESSAGE_CONTENT, SEPARATOR_MESSAGECODE, subscriptions_changed
+
+'''
+Benchmarks for every stage of the pipeline, run over the captures in captures/
+
+usage:
+    python benchmark.py [capture files...] [--stages photon_decode,dispatch] [--json results.json]
+    python benchmark.py --synthetic mixed [--json results.json]
+    python benchmark.py --synthetic fragmented --stages projection,interning     # the large responses
+    python benchmark.py --compare old.json new.json
+
+Without capture files every captures/*.pcap* file is used,
+--synthetic benchmarks one of the traffic_generator workloads instead.
+
+Every stage reports the throughput(best of --repeat passes over all of it's items)
+and the per item latency(mean, p50, p99, max of one extra pass timing every item).
+--json writes the results together with the commit they were measured on,
+--compare prints the throughput change of every stage between two such files.
+'''
+
+
+@dataclass
+class Result:
+    stage: str
+    items: int
+    seconds: float
+    latencies_ns: List[int] = field(default_factory=list, repr=False)
+
+    @property
+    def per_second(self):
+        return self.items / self.seconds if self.seconds else 0
+
+    def latency_us(self):
+        if not self.latencies_ns:
+            return {}
+        latencies = sorted(self.latencies_ns)
+        return {
+            "mean": sum(latencies) / len(latencies) / 1e3,
+            "p50":  latencies[len(latencies) // 2] / 1e3,
+            "p99":  latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1e3,
+            "max":  latencies[-1] / 1e3,
+        }
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "items": self.items,
+            "seconds": self.seconds,
+            "per_second": self.per_second,
+            "latency_us": self.latency_us(),
+        }
+
+    def __str__(self):
+        latency = self.latency_us()
+        latency = " | ".join(f"{name} {value:>9.2f}" for name, value in latency.items())
+        return f"{self.stage:<24}: {self.items:>8} items | {self.per_second:>12,.0f} /s | latency(us): {latency}"
+
+
+def best_time(func, repeat, setup=None):
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def measure(stage: str, items: List[Any], func: Callable[[Any], Any], repeat: int, setup=None) -> Result:
+    '''
+    Times func over every item, repeat times for throughput and once more item by item for latency
+    '''
+    def run_all():
+        for item in items:
+            func(item)
+
+    seconds = best_time(run_all, repeat, setup)
+
+    if setup:
+        setup()
+    latencies = []
+    for item in items:
+        start = perf_counter_ns()
+        func(item)
+        latencies.append(perf_counter_ns() - start)
+
+    return Result(stage, len(items), seconds, latencies)
+
+
+@dataclass
+class Workload:
+    '''
+    The inputs of every stage, extracted once from the captures
+    '''
+    capture_files: List[str]
+    datagrams: List[bytes] = field(default_factory=list)
+    fragments: List[photon.CommandRecord] = field(default_factory=list)
+    # (message_type, protocol16 payload), including reassembled fragmented commands
+    messages: List[Tuple[int, bytes]] = field(default_factory=list)
+    # (bundle, decoded message)
+    decoded: List[Tuple[StreamSeparator, Any]] = field(default_factory=list)
+
+
+bundles = {
+    photon.REQUEST_MESSAGE:  RequestBundle,
+    photon.RESPONSE_MESSAGE: ReponseBundle,
+    photon.EVENT_MESSAGE:    EventBundle,
+}
+
+
+def load_workload(capture_files: List[str]) -> Workload:
+    workload = Workload(capture_files)
+
+    for capture_file in capture_files:
+        with pcap_reader.PcapReader(capture_file) as reader:
+            workload.datagrams.extend(bytes(payload) for _, _, payload in reader)
+
+    reassembler = FragmentReassembler()
+    for datagram in workload.datagrams:
+        for command in photon.decode_datagram(datagram)[1]:
+            if command.command_type == photon.FRAGMENT_COMMAND:
+                workload.fragments.append(command)
+
+                fragmented_command = reassembler.add_record(None, command)
+                if fragmented_command is None:
+                    continue
+
+                message_type, payload = photon.split_message(fragmented_command)
+                # responses can have excesive sizes, so just asume this is a ResponseMessage(like pipeline.py)
+                workload.messages.append((message_type, bytes(payload)))
+                workload.decoded.append((ReponseBundle, pipeline.decode_payload(message_type, payload)[0]))
+
+            elif command.command_type in (photon.RELIABLE_COMMAND, photon.UNRELIABLE_COMMAND) and command.message_type in bundles:
+                workload.messages.append((command.message_type, bytes(command.payload)))
+                workload.decoded.append((bundles[command.message_type], pipeline.decode_payload(command.message_type, command.payload)[0]))
+
+    return workload
+
+
+def iter_message_streams(separator: StreamSeparator):
+    streams = list(separator.streams.values())
+    if separator.unknown_identifier_stream:
+        streams.append(separator.unknown_identifier_stream)
+
+    for stream in streams:
+        if isinstance(stream, StreamSeparator):
+            yield from iter_message_streams(stream)
+        elif isinstance(stream, MessageStream):
+            yield stream
+
+
+def resolve_stream(separator: StreamSeparator, target):
+    '''
+    the stream a message ends up in, following StreamSeparator.separate
+    '''
+    while isinstance(separator, StreamSeparator):
+        if separator.identifier_index is SEPARATOR_MESSAGECODE:
+            identifier = target[0]
+        else:
+            identifier = target[MESSAGE_CONTENT].get(separator.identifier_index)
+        separator = separator.streams.get(identifier, separator.unknown_identifier_stream)
+    return separator
+
+
+def noop_hook(target):
+    pass
+
+@contextmanager
+def replaced_hooks(hooks: List[Callable], only_hooked=False):
+    '''
+    replace the hooks of every MessageStream(so nothing prints while measuring)
+    only_hooked: only of the streams that already have hooks, keeping the others unsubscribed
+    '''
+    streams = [stream for bundle in bundles.values() for stream in iter_message_streams(bundle) if stream.hooks or not only_hooked]
+    saved = [stream.hooks for stream in streams]
+    for stream in streams:
+        stream.hooks = list(hooks)
+    subscriptions_changed()
+    try:
+        yield
+    finally:
+        for stream, stream_hooks in zip(streams, saved):
+            stream.hooks = stream_hooks
+        subscriptions_changed()
+
+
+@contextmanager
+def replaced_translators():
+    '''
+    remove the translators of every MessageStream
+    '''
+    streams = [stream for bundle in bundles.values() for stream in iter_message_streams(bundle)]
+    saved = [stream.translator for stream in streams]
+    for stream in streams:
+        stream.translator = None
+    subscriptions_changed()
+    try:
+        yield
+    finally:
+        for stream, translator in zip(streams, saved):
+            stream.translator = translator
+        subscriptions_changed()
+
+
+stages: Dict[str, Callable[[Workload, int], List[Result]]] = {}
+default_stages: List[str] = []
+
+def add_stage(name, default=True):
+    '''
+    Decorator generator for registering a stage, non default stages only run when asked for with --stages
+    '''
+    def add_decorator(func):
+        stages[name] = func
+        if default:
+            default_stages.append(name)
+        return func
+
+    return add_decorator
+
+
+@add_stage("photon_decode")
+def bench_photon_decode(workload, repeat):
+    return [measure("photon_decode", workload.datagrams, photon.decode_datagram, repeat)]
+
+
+@add_stage("photon_decode_scapy", default=False)
+def bench_photon_decode_scapy(workload, repeat):
+    from layers import PhotonHeader, FragmentCommand, commands
+
+    def walk_scapy_layers(datagram):
+        for command in PhotonHeader(datagram).commands:
+            if command.command_type not in commands:
+                continue
+            command = command.actual_command
+            if command.id == FragmentCommand.id:
+                command.command_fragment.original
+            else:
+                command.message.message.original
+
+    return [measure("photon_decode_scapy", workload.datagrams, walk_scapy_layers, repeat)]
+
+
+@add_stage("fragment_reassembly")
+def bench_fragment_reassembly(workload, repeat):
+    reassembler = FragmentReassembler()
+    return [measure("fragment_reassembly", workload.fragments, partial(reassembler.add_record, None), repeat, setup=reassembler.clear)]
+
+
+def bench_protocol16_decoders(workload, repeat, decoders, suffix=""):
+    results = []
+    for message_type, (name, decoder) in decoders.items():
+        payloads = [payload for payload_type, payload in workload.messages if payload_type == message_type]
+        if payloads:
+            results.append(measure(f"{name}{suffix}", payloads, decoder, repeat))
+    return results
+
+@add_stage("protocol16")
+def bench_protocol16(workload, repeat):
+    return bench_protocol16_decoders(workload, repeat, {
+        photon.REQUEST_MESSAGE:  ("Parse_OperationRequest",  protocol16.Parse_OperationRequest_at),
+        photon.RESPONSE_MESSAGE: ("Parse_OperationResponse", protocol16.Parse_OperationResponse_at),
+        photon.EVENT_MESSAGE:    ("Parse_EventData",         protocol16.Parse_EventData_at),
+    })
+
+@add_stage("protocol16_slicing", default=False)
+def bench_protocol16_slicing(workload, repeat):
+    return bench_protocol16_decoders(workload, repeat, {
+        photon.REQUEST_MESSAGE:  ("Parse_OperationRequest",  protocol16.Parse_OperationRequest),
+        photon.RESPONSE_MESSAGE: ("Parse_OperationResponse", protocol16.Parse_OperationResponse),
+        photon.EVENT_MESSAGE:    ("Parse_EventData",         protocol16.Parse_EventData),
+    }, suffix="_slicing")
+
+
+@add_stage("typed_arrays", default=False)
+def bench_typed_arrays(workload, repeat, size=5_000):
+    '''
+    per element and bulk decoding of synthetic typed arrays("y" and "n")
+    '''
+    results = []
+    for type_code, (struct_format, _, _) in protocol16.bulk_array_formats.items():
+        data = pack(f">HB{size}{struct_format}", size, type_code, *(i % 256 for i in range(size)))
+        parser_func = protocol16.datatype_offset_parsers[type_code]
+        results.append(measure(f"array_{chr(type_code)}_per_element", [data], lambda data: protocol16.generic_Array_parser_at(data, 3, size, parser_func), repeat))
+        results.append(measure(f"array_{chr(type_code)}_bulk", [data], protocol16.Parse_Array_at, repeat))
+
+    data = pack(">H", size) + bytes(i % 2 for i in range(size))
+    results.append(measure("array_n_per_element", [data], lambda data: protocol16.generic_Array_parser_at(data, 2, size, protocol16.Parse_Boolean_at), repeat))
+    results.append(measure("array_n_bulk", [data], protocol16.Parse_BooleanArray_at, repeat))
+    return results
+
+
+@add_stage("dispatch")
+def bench_dispatch(workload, repeat):
+    '''
+    Routing only, through the StreamSeparators and through the pipeline's DispatchTables,
+    with a no-op hook on every stream and no translators
+    '''
+    dispatch_tables = {bundle: pipeline.dispatch_tables[message_type] for message_type, bundle in bundles.items()}
+    routed = [(dispatch_tables[bundle], bundle, target) for bundle, target in workload.decoded]
+
+    with replaced_hooks([noop_hook]), replaced_translators():
+        results = [
+            measure("dispatch", routed, lambda item: item[1](item[2]), repeat),
+            measure("dispatch_table", routed, lambda item: item[0](item[2]), repeat),
+        ]
+
+        metrics.enable()
+        try:
+            results.append(measure("dispatch_table_metrics", routed, lambda item: item[0](item[2]), repeat))
+        finally:
+            metrics.disable()
+            metrics.reset()
+
+    return results
+
+
+def deepcopy_translate(translator: MessageTranslator, org_target):
+    '''
+    MessageTranslator.translate before it was compiled, for reference
+    '''
+    target = deepcopy(org_target)
+
+    for definition in translator.translations:
+        result = definition(target)
+
+        if not result:
+            continue
+
+        new_key, value = result
+
+        if new_key is not TRANSLATOR_IGNORE:
+            target[MESSAGE_CONTENT][new_key] = value
+
+        if definition.old_key in target[MESSAGE_CONTENT]:
+            del target[MESSAGE_CONTENT][definition.old_key]
+
+    return target
+
+
+@add_stage("translate")
+def bench_translate(workload, repeat):
+    translated = []
+    for bundle, target in workload.decoded:
+        stream = resolve_stream(bundle, target)
+        if isinstance(stream, MessageStream) and stream.translator:
+            translated.append((stream.translator, target))
+
+    return [
+        measure("translate", translated, lambda item: item[0](item[1]), repeat),
+        measure("translate_deepcopy", translated, lambda item: deepcopy_translate(*item), repeat),
+    ]
+
+
+@add_stage("interning")
+def bench_interning(workload, repeat):
+    '''
+    translating the messages of every stream with a translator(the same ones as translate),
+    with the caches of interning.py and without them
+    '''
+    translated = []
+    for bundle, target in workload.decoded:
+        stream = resolve_stream(bundle, target)
+        if isinstance(stream, MessageStream) and stream.translator:
+            translated.append((stream.translator, target))
+
+    results = [measure("translate_interned", translated, lambda item: item[0](item[1]), repeat)]
+    interning.set_enabled(False)
+    try:
+        results.append(measure("translate_not_interned", translated, lambda item: item[0](item[1]), repeat))
+    finally:
+        interning.set_enabled(True)
+    return results
+
+
+@add_stage("end_to_end")
+def bench_end_to_end(workload, repeat):
+    '''
+    Full pipeline from UDP payload to a no-op hook on every stream,
+    then the same including reading the capture files
+    '''
+    results = []
+    with replaced_hooks([noop_hook]):
+        results.append(measure("end_to_end", workload.datagrams, pipeline.procces_photon_payload, repeat, setup=pipeline.reassembler.clear))
+
+        def replay_all():
+            for capture_file in workload.capture_files:
+                pcap_reader.replay(capture_file, pipeline.procces_udp_payload)
+
+        seconds = best_time(replay_all, repeat, setup=pipeline.reassembler.clear)
+        results.append(Result("replay", len(workload.datagrams), seconds))
+
+    return results
+
+
+@add_stage("reliable_window")
+def bench_reliable_window(workload, repeat):
+    '''
+    end_to_end with and without dropping the retransmitted reliable commands(reliable_window.py),
+    over the captures and over them with 10% of the datagrams retransmitted
+    '''
+    window = ReliableWindow()
+    retransmitted = [payload for _, _, payload in traffic_generator.unreliable_network(
+        ((0.0, None, datagram) for datagram in workload.datagrams), duplicates=0.1
+    )]
+
+    def setup():
+        pipeline.reassembler.clear()
+        window.clear()
+
+    results = []
+    saved = pipeline.reliable_window
+    with replaced_hooks([noop_hook]):
+        for name, datagrams in (("end_to_end", workload.datagrams), ("end_to_end_retransmitted", retransmitted)):
+            pipeline.reliable_window = None
+            results.append(measure(name, datagrams, pipeline.procces_photon_payload, repeat, setup=setup))
+            pipeline.reliable_window = window
+            results.append(measure(f"{name}_window", datagrams, pipeline.procces_photon_payload, repeat, setup=setup))
+    pipeline.reliable_window = saved
+
+    return results
+
+
+@add_stage("multiprocess", default=False)
+def bench_multiprocess(workload, repeat, workers=(1, 2, 4)):
+    '''
+    replay through multiprocess_pipeline.py with a no-op hook on every stream, by number of decode workers
+    '''
+    from multiprocess_pipeline import MultiProcessPipeline
+
+    def source(prn):
+        for capture_file in workload.capture_files:
+            pcap_reader.replay(capture_file, prn)
+
+    results = []
+    with replaced_hooks([noop_hook]):
+        for worker_count in workers:
+            def run_pipeline():
+                multiprocess_pipeline = MultiProcessPipeline(source, workers=worker_count, lossless=True)
+                try:
+                    multiprocess_pipeline.run()
+                finally:
+                    multiprocess_pipeline.close()
+
+            seconds = best_time(run_pipeline, repeat)
+            results.append(Result(f"multiprocess_{worker_count}", len(workload.datagrams), seconds))
+
+    return results
+
+
+@add_stage("lazy_decoding")
+def bench_lazy_decoding(workload, repeat):
+    '''
+    end_to_end with only the streams hooked by streams.py subscribed,
+    decoding every message and only the ones reaching a hook(pipeline.lazy_decoding)
+    '''
+    results = []
+    saved = pipeline.lazy_decoding
+    with replaced_hooks([noop_hook], only_hooked=True):
+        for lazy_decoding in (False, True):
+            pipeline.lazy_decoding = lazy_decoding
+            name = "end_to_end_lazy" if lazy_decoding else "end_to_end_eager"
+            results.append(measure(name, workload.datagrams, pipeline.procces_photon_payload, repeat, setup=pipeline.reassembler.clear))
+    pipeline.lazy_decoding = saved
+
+    return results
+
+
+@add_stage("message_log")
+def bench_message_log(workload, repeat):
+    '''
+    recording every message to a message log and replaying the log into the streams with a no-op hook on every stream(message_log.py)
+    '''
+    directory = tempfile.mkdtemp(prefix="albion_benchmark_log_")
+    try:
+        with message_log.MessageLog(directory) as log:
+            results = [measure("message_log_record", workload.messages, lambda message: log.append(0.0, None, *message), repeat)]
+
+        # only the records of one pass
+        shutil.rmtree(directory)
+        with message_log.MessageLog(directory) as log:
+            for message_type, payload in workload.messages:
+                log.append(0.0, None, message_type, payload)
+
+        reader = message_log.MessageLogReader(directory)
+        with replaced_hooks([noop_hook]):
+            seconds = best_time(reader.replay, repeat)
+        results.append(Result("message_log_replay", len(workload.messages), seconds))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+@add_stage("projection")
+def bench_projection(workload, repeat):
+    '''
+    decoding the messages of streams with a translator, every parameter and what pipeline.projection picks,
+    the lookup included(only the big messages of projected streams, see MessageStream(projected=True)),
+    over all of them and over the ones of projected streams only(eg: PlayerInfoResponse)
+    '''
+    translated = []
+    projected = []
+    for (message_type, payload), (bundle, target) in zip(workload.messages, workload.decoded):
+        stream = resolve_stream(bundle, target)
+        if isinstance(stream, MessageStream) and stream.translator:
+            translated.append((message_type, payload))
+            if stream.projected:
+                projected.append((message_type, payload))
+
+    def decode_projected(item):
+        message_type, payload = item
+        return pipeline.decode_payload(message_type, payload, pipeline.projection(pipeline.dispatch_tables[message_type], message_type, payload))
+
+    results = []
+    with replaced_hooks([noop_hook]):
+        for suffix, items in (("", translated), ("_projected_streams", projected)):
+            if not items:
+                continue
+            results.append(measure(f"decode_full{suffix}", items, lambda item: pipeline.decode_payload(*item), repeat))
+            results.append(measure(f"decode_projected{suffix}", items, decode_projected, repeat))
+    return results
+
+
+def slow_hook(target):
+    # like a print to a slow terminal or a network call, releasing the GIL
+    sleep(0.000_05)
+
+
+@add_stage("hook_offload", default=False)
+def bench_hook_offload(workload, repeat, messages=2_000):
+    '''
+    dispatch time(as seen by the packet callback) with a slow hook on every stream, inline and in a thread(hook_executors.py)
+    '''
+    dispatch_tables = {bundle: pipeline.dispatch_tables[message_type] for message_type, bundle in bundles.items()}
+    routed = [
+        (dispatch_tables[bundle], target) for bundle, target in workload.decoded
+        if isinstance(resolve_stream(bundle, target), MessageStream)
+    ][:messages]
+
+    results = []
+    for mode in (hook_executors.INLINE, hook_executors.THREAD):
+        hook = hook_executors.wrap_hook(slow_hook, mode, queue_size=len(routed))
+        with replaced_hooks([hook]), replaced_translators():
+            results.append(measure(f"hook_{mode}", routed, lambda item: item[0](item[1]), repeat))
+        hook_executors.join()
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(workload: Workload, stage_names: List[str], repeat: int) -> dict:
+    results = []
+    for name in stage_names:
+        for result in stages[name](workload, repeat):
+            print(result)
+            results.append(result.as_dict())
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "captures": workload.capture_files,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    print(f"{old['meta']['commit']} -> {new['meta']['commit']}")
+    old_results = {result["stage"]: result for result in old["results"]}
+    for result in new["results"]:
+        if result["stage"] not in old_results or not old_results[result["stage"]]["per_second"]:
+            continue
+        change = result["per_second"] / old_results[result["stage"]]["per_second"] - 1
+        print(f"{result['stage']:<24}: {old_results[result['stage']]['per_second']:>12,.0f} /s -> {result['per_second']:>12,.0f} /s ({change:+.1%})")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark the stages of the pipeline over captures")
+    parser.add_argument("capture_files", nargs="*")
+    parser.add_argument("--stages", default=",".join(default_stages), help=f"comma separated, out of: {', '.join(stages)}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--synthetic", choices=traffic_generator.workloads, help="benchmark a generated workload instead of captures")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two --json results")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        exit()
+
+    capture_files = args.capture_files or sorted(glob("captures/*.pcap*"))
+    if args.synthetic:
+        capture_file = os.path.join(tempfile.gettempdir(), f"albion_benchmark_{args.synthetic}.pcap")
+        traffic_generator.write_pcap(capture_file, traffic_generator.workloads[args.synthetic]())
+        # dispatched to a stream of their own, like the messages of streams.py
+        traffic_generator.add_move_event_stream()
+        capture_files = [capture_file]
+    if not capture_files:
+        print("No capture files found in captures/")
+        exit()
+
+    workload = load_workload(capture_files)
+    print(f"{len(workload.datagrams)} datagrams, {len(workload.messages)} messages, {len(workload.fragments)} fragments")
+
+    report = run(workload, args.stages.split(","), args.repeat)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
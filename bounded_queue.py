@@ -0,0 +1,156 @@
+from collections import deque
+from queue import Empty
+from threading import Condition
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional
+
+'''
+Bounded queue of (name, data) items with a policy per name for when it's full
+
+Policies:
+    "drop_oldest":  the oldest queued item(of any name) is dropped to make room
+    "drop_newest":  the new item is dropped
+    "keep_latest":  a queued item with the same name and key(key(data), the name if no key function)
+                    is replaced in place, only the latest one is kept, otherwise like drop_oldest
+    "block":        put waits for room(backpressure on the producer), up to timeout seconds, then drops the new item
+
+Drops are counted per name, along with the high-water mark of the queue.
+Same interface as queue.Queue for the consumer: get, get_nowait(raising queue.Empty) and qsize.
+'''
+
+POLICIES = ("drop_oldest", "drop_newest", "keep_latest", "block")
+
+
+class QueuePolicy:
+    __slots__ = ("policy", "key", "timeout")
+
+    def __init__(self, policy: str, key: Optional[Callable[[Any], Hashable]] = None, timeout: Optional[float] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}, expected one of {POLICIES}")
+        self.policy = policy
+        self.key = key
+        self.timeout = timeout
+
+
+class BoundedQueue:
+    '''
+    maxsize:        items kept at most
+    default_policy: for names without their own, see set_policy
+    '''
+
+    def __init__(self, maxsize: int = 10_000, default_policy: str = "drop_oldest"):
+        self.maxsize = maxsize
+        self.default_policy = QueuePolicy(default_policy)
+        self.policies: Dict[str, QueuePolicy] = {}
+
+        # [name, data, latest_key], lists so keep_latest can replace the data in place
+        self.items = deque()
+        # latest_key => the queued item, for keep_latest
+        self.latest: Dict[Hashable, list] = {}
+        self.condition = Condition()
+
+        self.put_count = 0
+        self.replaced = 0
+        self.high_water = 0
+        self.dropped: Dict[str, int] = {}
+
+    def set_policy(self, name: str, policy: str, key: Optional[Callable[[Any], Hashable]] = None, timeout: Optional[float] = None):
+        '''
+        key:        for "keep_latest", items with the same key(data) replace each other, eg: lambda data: data["id"]
+        timeout:    for "block", seconds to wait for room, None waits forever
+        '''
+        self.policies[name] = QueuePolicy(policy, key, timeout)
+
+    def drop(self, name):
+        self.dropped[name] = self.dropped.get(name, 0) + 1
+
+    def drop_oldest(self):
+        item = self.items.popleft()
+        if item[2] is not None:
+            del self.latest[item[2]]
+        self.drop(item[0])
+
+    def put(self, name: str, data) -> bool:
+        '''
+        returns False if the item was dropped
+        '''
+        policy = self.policies.get(name, self.default_policy)
+
+        with self.condition:
+            self.put_count += 1
+            latest_key = None
+
+            if policy.policy == "keep_latest":
+                latest_key = (name, policy.key(data) if policy.key else None)
+                item = self.latest.get(latest_key)
+                if item is not None:
+                    item[1] = data
+                    self.replaced += 1
+                    return True
+
+            if len(self.items) >= self.maxsize:
+                if policy.policy == "drop_newest":
+                    self.drop(name)
+                    return False
+
+                if policy.policy == "block":
+                    deadline = None if policy.timeout is None else monotonic() + policy.timeout
+                    while len(self.items) >= self.maxsize:
+                        remaining = None if deadline is None else deadline - monotonic()
+                        if remaining is not None and remaining <= 0:
+                            self.drop(name)
+                            return False
+                        self.condition.wait(remaining)
+                else:
+                    self.drop_oldest()
+
+            item = [name, data, latest_key]
+            self.items.append(item)
+            if latest_key is not None:
+                self.latest[latest_key] = item
+
+            if len(self.items) > self.high_water:
+                self.high_water = len(self.items)
+
+            self.condition.notify_all()
+            return True
+
+    put_nowait = put
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        '''
+        returns the next (name, data), raises queue.Empty if there is none(after timeout, if blocking)
+        '''
+        with self.condition:
+            if block:
+                if not self.condition.wait_for(lambda: self.items, timeout):
+                    raise Empty
+            elif not self.items:
+                raise Empty
+
+            name, data, latest_key = self.items.popleft()
+            if latest_key is not None:
+                del self.latest[latest_key]
+
+            # room for blocked producers
+            self.condition.notify_all()
+            return name, data
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return len(self.items)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.items),
+            "maxsize": self.maxsize,
+            "high_water": self.high_water,
+            "put": self.put_count,
+            "replaced": self.replaced,
+            "dropped": dict(self.dropped),
+            "dropped_total": sum(self.dropped.values()),
+            "policies": {name: policy.policy for name, policy in self.policies.items()},
+            "default_policy": self.default_policy.policy,
+        }
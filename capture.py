@@ -0,0 +1,289 @@
+import socket
+from select import select
+from ctypes import create_string_buffer, addressof
+from struct import Struct, pack
+from typing import Callable, List, NamedTuple, Optional, Union
+
+from photon_decoder import albion_ports
+
+'''
+Linux only capture backend built directly on an AF_PACKET socket
+
+scapy.sniff dissects Ether/IP/UDP in python and calls back once per packet, which can't keep up with busy zones.
+Here the kernel does the port filtering(classic BPF attached with SO_ATTACH_FILTER),
+frames are pulled in batches with recv_into into preallocated buffers
+and only the IPv4/UDP headers needed for the 5-tuple are unpacked.
+
+The payload handed to the callback is a memoryview into a reused buffer,
+copy it(bytes(payload)) if it has to outlive the callback.
+
+Only Ethernet framed interfaces are supported(this includes the loopback interface),
+so captures can be tested offline by replaying a capture over lo, see replay_to_loopback.
+'''
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_HEADER_SIZE = 14
+IPPROTO_UDP = 17
+
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+SO_ATTACH_FILTER = 26
+
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+
+
+class FiveTuple(NamedTuple):
+    src: str
+    sport: int
+    dst: str
+    dport: int
+    protocol: int = IPPROTO_UDP
+
+
+# classic BPF opcodes
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+BPF_INSTRUCTION = Struct("HBBI")
+
+
+def udp_ports_bpf(ports: List[int], snaplen: int = 0xFFFF) -> List[tuple]:
+    '''
+    Compiles "ip and udp and not ip fragment and (port p1 or port p2 ...)" to classic BPF
+    returns a list of (code, jt, jf, k) instructions
+    '''
+    port_count = len(ports)
+    # index of the accept and drop instructions
+    accept = 9 + 2 * port_count
+    drop = accept + 1
+
+    program = [
+        (BPF_LD_H_ABS, 0, 0, 12),                       # 0: ether type
+        (BPF_JEQ_K,    0, drop - 2, ETH_P_IP),          # 1
+        (BPF_LD_B_ABS, 0, 0, 23),                       # 2: ip protocol
+        (BPF_JEQ_K,    0, drop - 4, IPPROTO_UDP),       # 3
+        (BPF_LD_H_ABS, 0, 0, 20),                       # 4: flags and fragment offset
+        (BPF_JSET_K,   drop - 6, 0, 0x1FFF),            # 5: only the first fragment has the UDP header
+        (BPF_LDX_B_MSH, 0, 0, ETH_HEADER_SIZE),         # 6: x = ip header length
+    ]
+
+    for port_offset in (ETH_HEADER_SIZE, ETH_HEADER_SIZE + 2):  # source port then destination port
+        program.append((BPF_LD_H_IND, 0, 0, port_offset))
+        for i, port in enumerate(ports):
+            index = len(program)
+            is_last = port_offset != ETH_HEADER_SIZE and i == port_count - 1
+            program.append((BPF_JEQ_K, accept - index - 1, drop - index - 1 if is_last else 0, port))
+
+    program.append((BPF_RET_K, 0, 0, snaplen))         # accept
+    program.append((BPF_RET_K, 0, 0, 0))               # drop
+
+    assert len(program) == drop + 1
+    return program
+
+
+def attach_filter(sock: socket.socket, program: List[tuple]):
+    instructions = create_string_buffer(b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in program))
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = pack("HL", len(program), addressof(instructions))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+# the RawSocketCaptures not closed yet, for reading their kernel counters(see loss.py)
+open_captures: List["RawSocketCapture"] = []
+
+IPV4_ADDRESSES = Struct(">9xB2x4s4s")
+UDP_HEADER = Struct(">HHH")
+
+
+class RawSocketCapture:
+    '''
+    interface: None captures on all interfaces
+    batch_size: max frames read without going back to the blocking recv
+    '''
+
+    def __init__(self, interface: Optional[str] = None, ports: List[int] = albion_ports, batch_size: int = 64, snaplen: int = 0xFFFF, timeout: float = 0.5):
+        self.interface = interface
+        self.ports = ports
+        self.batch_size = batch_size
+        self.snaplen = snaplen
+
+        self.buffers = [bytearray(snaplen) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+        self.captured = 0
+        self.kernel_received = 0
+        self.kernel_dropped = 0
+
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        # filter first, so nothing unfiltered gets queued
+        attach_filter(self.sock, udp_ports_bpf(ports, snaplen))
+        if interface:
+            self.sock.bind((interface, 0))
+        # the first frame of a batch is waited for with select, the rest are drained non-blocking
+        self.sock.setblocking(False)
+        self.timeout = timeout
+        open_captures.append(self)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self in open_captures:
+            open_captures.remove(self)
+        self.sock.close()
+
+    def recv_batch(self, wait: bool = True) -> int:
+        '''
+        Blocks(up to timeout) for the first frame, then drains whatever is already queued, up to batch_size
+        wait: False when the socket is known to be readable, eg: selected together with others
+        returns the number of frames read into self.buffers, their lengths are in self.lengths
+        '''
+        self.lengths = lengths = []
+        sock = self.sock
+
+        if wait and not select((sock,), (), (), self.timeout)[0]:
+            return 0
+
+        while len(lengths) < self.batch_size:
+            try:
+                length, address = sock.recvfrom_into(self.buffers[len(lengths)])
+            except BlockingIOError:
+                break
+            if not self.is_loopback_duplicate(address):
+                lengths.append(length)
+
+        return len(lengths)
+
+    @staticmethod
+    def is_loopback_duplicate(address):
+        # on lo every packet is seen twice, as outgoing and as incoming
+        return address[2] == PACKET_OUTGOING and address[3] == ARPHRD_LOOPBACK
+
+    def dispatch_batch(self, prn: Callable[[memoryview, FiveTuple], None]):
+        '''
+        Calls prn(payload, five_tuple) for every UDP frame of the last batch
+        '''
+        for frame, length in zip(self.views, self.lengths):
+            ip_header_size = (frame[ETH_HEADER_SIZE] & 0x0F) * 4
+            protocol, src, dst = IPV4_ADDRESSES.unpack_from(frame, ETH_HEADER_SIZE)
+            udp_offset = ETH_HEADER_SIZE + ip_header_size
+            # the UDP length, since short frames are padded
+            sport, dport, udp_length = UDP_HEADER.unpack_from(frame, udp_offset)
+
+            self.captured += 1
+            prn(
+                frame[udp_offset + 8:min(udp_offset + udp_length, length)],
+                FiveTuple(socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport, protocol)
+            )
+
+    def capture(self, prn: Callable[[memoryview, FiveTuple], None], count: int = 0, stop: Callable[[], bool] = None):
+        '''
+        Capture until count packets were captured(0 for no limit) or stop() returns True
+        '''
+        while not (count and self.captured >= count) and not (stop and stop()):
+            if self.recv_batch():
+                self.dispatch_batch(prn)
+
+    def update_stats(self):
+        '''
+        Reads the kernel side counters(reset on every read) into kernel_received and kernel_dropped
+        '''
+        packets, drops = Struct("II").unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+        self.kernel_received += packets
+        self.kernel_dropped += drops
+        return self.kernel_received, self.kernel_dropped
+
+
+def capture_interfaces(captures: List[RawSocketCapture], prn: Callable[[memoryview, FiveTuple], None], count: int = 0, stop: Callable[[], bool] = None):
+    '''
+    RawSocketCapture.capture over several captures(eg: one per interface) in the same thread
+    '''
+    timeout = min(capture.timeout for capture in captures)
+    while not (count and sum(capture.captured for capture in captures) >= count) and not (stop and stop()):
+        for capture in select(captures, (), (), timeout)[0]:
+            if capture.recv_batch(wait=False):
+                capture.dispatch_batch(prn)
+
+
+def sniff_raw(prn: Callable[[memoryview, FiveTuple], None], iface: Union[str, List[str], None] = None, count: int = 0, **kwargs):
+    '''
+    scapy.sniff like entry point for RawSocketCapture
+    iface: an interface, a list of them(eg: ["eth0", "wlan0"]) or None for all of them
+
+    returns the RawSocketCapture, a list of them for a list of interfaces
+    '''
+    interfaces = iface if isinstance(iface, (list, tuple)) else [iface]
+    captures = [RawSocketCapture(interface, **kwargs) for interface in interfaces]
+    try:
+        if len(captures) == 1:
+            captures[0].capture(prn, count=count)
+        else:
+            capture_interfaces(captures, prn, count=count)
+    finally:
+        for capture in captures:
+            capture.close()
+    return captures if isinstance(iface, (list, tuple)) else captures[0]
+
+
+def replay_to_loopback(capture_file: str, ports: List[int] = albion_ports, delay: float = 0):
+    '''
+    Resend the UDP payloads on the given ports from a capture over 127.0.0.1, keeping their ports,
+    so RawSocketCapture("lo") can be tested offline
+
+    returns the number of sent datagrams
+    '''
+    from time import sleep
+    from scapy.utils import PcapReader
+    from scapy.layers.inet import UDP
+
+    senders = {}
+    sent = 0
+    for packet in PcapReader(capture_file):
+        if not packet.haslayer(UDP):
+            continue
+        udp = packet[UDP]
+        if udp.sport not in ports and udp.dport not in ports:
+            continue
+
+        if udp.sport not in senders:
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sender.bind(("127.0.0.1", udp.sport))
+            senders[udp.sport] = sender
+
+        senders[udp.sport].sendto(bytes(udp.payload), ("127.0.0.1", udp.dport))
+        sent += 1
+        if delay:
+            sleep(delay)
+
+    for sender in senders.values():
+        sender.close()
+    return sent
+
+
+if __name__ == '__main__':
+    # offline check: replay a capture over lo and count what RawSocketCapture sees
+    import sys
+    from threading import Thread
+    from time import sleep
+
+    capture = RawSocketCapture("lo")
+    received = []
+    done = False
+    receiver = Thread(target=capture.capture, args=(lambda payload, five_tuple: received.append(five_tuple),), kwargs={"stop": lambda: done})
+    receiver.start()
+
+    sent = replay_to_loopback(sys.argv[1])
+    # let the receiver drain the socket
+    sleep(1)
+    done = True
+    receiver.join()
+
+    print(f"sent: {sent} captured: {len(received)} kernel(received, dropped): {capture.update_stats()}")
@@ -0,0 +1,316 @@
+import mmap
+import os
+from struct import Struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import photon_decoder as photon
+import protocol16_parser as protocol16
+import pipeline
+from capture import FiveTuple
+from photon_decoder import albion_ports
+from pcap_reader import PcapReader, udp_datagram
+from reassembly import FragmentReassembler
+
+'''
+Index of the Photon messages of a capture by (message type, code, sub code), for pulling out the few messages
+of one kind(eg: while reverse engineering it) without decoding the whole capture again
+
+The capture is scanned once(pcap_reader.PcapReader), for every message only the code and the sub code are read:
+    sub code:   parameter 252 of events, 253 of requests and responses(what the StreamSeparators of streams.py look at),
+                None if missing or not an integer
+
+Every message is located by it's parts, a part being (frame offset, frame length, link type, command number in the datagram),
+reassembled fragmented commands having a part per fragment.
+The index is saved next to the capture(capture.pcapng.idx) and rebuilt when the capture changes size or modification time.
+
+The index file is the entries grouped by key, with a table of the keys in front,
+so a query only reads the table and the entries of the matching keys, then decodes only the matching messages.
+'''
+
+INDEX_MAGIC = b"ASFIDX1\0"
+# magic, capture size, capture mtime, key count
+HEADER = Struct("<8sQdI")
+# message type, code, sub code, offset of the entries, entry count
+KEY = Struct("<BBiQI")
+# timestamp, part count
+ENTRY = Struct("<dH")
+# frame offset, frame length, link type, command number
+PART = Struct("<QIHH")
+
+NO_SUB_CODE = -0x8000_0000
+SUB_CODE_PARAMETERS = {
+    photon.REQUEST_MESSAGE:  253,
+    photon.RESPONSE_MESSAGE: 253,
+    photon.EVENT_MESSAGE:    252,
+}
+
+MESSAGE_TYPES = {
+    "request":  photon.REQUEST_MESSAGE,
+    "response": photon.RESPONSE_MESSAGE,
+    "event":    photon.EVENT_MESSAGE,
+}
+
+# (message_type, code, sub_code)
+IndexKey = Tuple[int, int, Optional[int]]
+# (frame_offset, frame_length, link_type, command_number)
+Part = Tuple[int, int, int, int]
+
+
+def message_key(message_type, payload) -> IndexKey:
+    '''
+    the key of a message, only the code and the sub code parameter are read
+    '''
+    sub_code = protocol16.Peek_Parameter_at(payload, pipeline.parameters_offset(message_type, payload), SUB_CODE_PARAMETERS[message_type])
+    if type(sub_code) is not int or not NO_SUB_CODE < sub_code <= 0x7FFF_FFFF:
+        sub_code = None
+    return message_type, payload[0], sub_code
+
+
+def index_path(capture_file: str) -> str:
+    return capture_file + ".idx"
+
+
+class CaptureIndex:
+    '''
+    entries: key => [(timestamp, parts)], see build, load and open_index
+    '''
+
+    def __init__(self, capture_file: str, entries: Dict[IndexKey, List[Tuple[float, List[Part]]]] = None):
+        self.capture_file = capture_file
+        self.entries = entries if entries is not None else {}
+        # key => (offset, count) in the index file, for the keys not loaded yet
+        self.key_table: Dict[IndexKey, Tuple[int, int]] = {}
+        self.path = None
+
+    @classmethod
+    def build(cls, capture_file: str, ports: List[int] = albion_ports) -> "CaptureIndex":
+        '''
+        scans the whole capture
+        '''
+        index = cls(capture_file)
+        entries = index.entries
+        timestamp = 0.0
+        reassembler = FragmentReassembler(clock=lambda: timestamp)
+        # parts of the commands in the reassembler
+        fragment_parts: Dict[tuple, List[Part]] = {}
+
+        with PcapReader(capture_file, ports) as reader:
+            for timestamp, five_tuple, payload in reader:
+                try:
+                    _, command_records = photon.decode_datagram(payload)
+                except photon.MalformedDatagram:
+                    continue
+
+                for command_number, command in enumerate(command_records):
+                    part = (reader.frame_offset, reader.frame_length, reader.link_type, command_number)
+
+                    if command.command_type == photon.FRAGMENT_COMMAND:
+                        key = (five_tuple, command.channel_id, command.start_sequence_number)
+                        fragment_parts.setdefault(key, []).append(part)
+                        reassembled = reassembler.add_record(five_tuple, command)
+                        if reassembled is None:
+                            if key not in reassembler.pending:
+                                # dropped, a duplicate of a completed command, ...
+                                del fragment_parts[key]
+                            elif len(fragment_parts) > 2 * len(reassembler.pending) + 1024:
+                                # evicted ones
+                                for stale in [key for key in fragment_parts if key not in reassembler.pending]:
+                                    del fragment_parts[stale]
+                            continue
+
+                        message_type, message_payload = photon.split_message(reassembled)
+                        parts = fragment_parts.pop(key)
+
+                    elif command.command_type in (photon.RELIABLE_COMMAND, photon.UNRELIABLE_COMMAND):
+                        message_type, message_payload, parts = command.message_type, command.payload, [part]
+
+                    else:
+                        continue
+
+                    if message_type not in SUB_CODE_PARAMETERS or not message_payload:
+                        continue
+                    try:
+                        key = message_key(message_type, message_payload)
+                    except Exception:
+                        # malformed parameters
+                        key = (message_type, message_payload[0], None)
+                    entries.setdefault(key, []).append((timestamp, parts))
+
+        return index
+
+    def save(self, path: str = None):
+        '''
+        next to the capture by default
+        '''
+        self.load_all()
+        path = path or index_path(self.capture_file)
+        stat = os.stat(self.capture_file)
+
+        keys = sorted(self.entries, key=lambda key: (key[0], key[1], NO_SUB_CODE if key[2] is None else key[2]))
+        groups = []
+        for key in keys:
+            groups.append(b"".join(
+                ENTRY.pack(timestamp, len(parts)) + b"".join(PART.pack(*part) for part in parts)
+                    for timestamp, parts in self.entries[key]
+            ))
+
+        offset = HEADER.size + KEY.size * len(keys)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime, len(keys)))
+            for key, group in zip(keys, groups):
+                message_type, code, sub_code = key
+                f.write(KEY.pack(message_type, code, NO_SUB_CODE if sub_code is None else sub_code, offset, len(self.entries[key])))
+                offset += len(group)
+            for group in groups:
+                f.write(group)
+        self.path = path
+
+    @classmethod
+    def load(cls, capture_file: str, path: str = None) -> Optional["CaptureIndex"]:
+        '''
+        reads only the table of keys, the entries are read by query
+        returns None if there is no index or it is out of date
+        '''
+        path = path or index_path(capture_file)
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(capture_file)
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, capture_size, capture_mtime, key_count = HEADER.unpack(header)
+            if magic != INDEX_MAGIC or capture_size != stat.st_size or capture_mtime != stat.st_mtime:
+                return None
+            table = f.read(KEY.size * key_count)
+
+        index = cls(capture_file)
+        index.path = path
+        for offset in range(0, len(table), KEY.size):
+            message_type, code, sub_code, entries_offset, count = KEY.unpack_from(table, offset)
+            index.key_table[(message_type, code, None if sub_code == NO_SUB_CODE else sub_code)] = (entries_offset, count)
+        return index
+
+    def load_key(self, key: IndexKey):
+        entries_offset, count = self.key_table.pop(key)
+        entries = self.entries[key] = []
+        with open(self.path, "rb") as f:
+            f.seek(entries_offset)
+            for _ in range(count):
+                timestamp, part_count = ENTRY.unpack(f.read(ENTRY.size))
+                parts = f.read(PART.size * part_count)
+                entries.append((timestamp, [PART.unpack_from(parts, offset) for offset in range(0, len(parts), PART.size)]))
+
+    def load_all(self):
+        for key in list(self.key_table):
+            self.load_key(key)
+
+    def keys(self) -> Dict[IndexKey, int]:
+        '''
+        key => number of messages
+        '''
+        counts = {key: count for key, (_, count) in self.key_table.items()}
+        counts.update((key, len(entries)) for key, entries in self.entries.items())
+        return counts
+
+    def find(self, message_type: int = None, code: int = None, sub_code: int = None) -> List[Tuple[float, List[Part]]]:
+        '''
+        the (timestamp, parts) of the matching messages, in capture order, None matches anything
+        '''
+        matching = [
+            key for key in self.keys()
+                if (message_type is None or key[0] == message_type)
+                and (code is None or key[1] == code)
+                and (sub_code is None or key[2] == sub_code)
+        ]
+        found = []
+        for key in matching:
+            if key in self.key_table:
+                self.load_key(key)
+            found += self.entries[key]
+        found.sort(key=lambda entry: entry[1][0][0])
+        return found
+
+    def query(self, message_type: int = None, code: int = None, sub_code: int = None,
+              ports: List[int] = albion_ports) -> Iterator[Tuple[float, FiveTuple, int, tuple]]:
+        '''
+        yields (timestamp, five_tuple, message_type, message) of the matching messages, decoding only them
+        eg: index.query(photon.EVENT_MESSAGE, 1, 68)
+        '''
+        ports = frozenset(ports)
+        with open(self.capture_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = memoryview(mapped)
+            try:
+                for timestamp, parts in self.find(message_type, code, sub_code):
+                    located = self.message_at(data, parts, ports)
+                    if located is None:
+                        continue
+                    five_tuple, found_type, payload = located
+                    message = pipeline.decode_payload(found_type, payload)
+                    if message:
+                        # copies of everything, nothing refers to the mapping once decoded
+                        yield timestamp, five_tuple, found_type, message[0]
+                    del payload, located
+            finally:
+                data.release()
+
+    @staticmethod
+    def message_at(data, parts: List[Part], ports):
+        '''
+        (five_tuple, message_type, payload) of the message made of the parts
+        '''
+        reassembler = None
+        for frame_offset, frame_length, link_type, command_number in parts:
+            datagram = udp_datagram(data[frame_offset:frame_offset + frame_length], link_type, ports)
+            if not datagram:
+                return None
+            five_tuple, payload = datagram
+            _, command_records = photon.decode_datagram(payload)
+            command = command_records[command_number]
+
+            if command.command_type != photon.FRAGMENT_COMMAND:
+                return five_tuple, command.message_type, bytes(command.payload)
+
+            if reassembler is None:
+                reassembler = FragmentReassembler()
+            reassembled = reassembler.add_record(five_tuple, command)
+            if reassembled is not None:
+                message_type, payload = photon.split_message(reassembled)
+                return five_tuple, message_type, bytes(payload)
+        return None
+
+
+def open_index(capture_file: str, rebuild: bool = False) -> CaptureIndex:
+    '''
+    loads the index saved next to the capture, building and saving it if missing or out of date
+    '''
+    index = None if rebuild else CaptureIndex.load(capture_file)
+    if index is None:
+        index = CaptureIndex.build(capture_file)
+        index.save()
+    return index
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from pprint import pprint
+
+    parser = ArgumentParser(description="Index the Photon messages of a capture, list them by code or decode the ones of a code")
+    parser.add_argument("capture_file")
+    parser.add_argument("--type", choices=MESSAGE_TYPES)
+    parser.add_argument("--code", type=int)
+    parser.add_argument("--sub-code", type=int)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    index = open_index(args.capture_file, args.rebuild)
+    if args.type is None and args.code is None and args.sub_code is None:
+        names = {message_type: name for name, message_type in MESSAGE_TYPES.items()}
+        for (message_type, code, sub_code), count in sorted(index.keys().items(), key=lambda item: -item[1]):
+            print(f"{names[message_type]:<8} code: {code:<4} sub code: {str(sub_code):<6} {count}")
+        exit()
+
+    for timestamp, five_tuple, message_type, message in index.query(MESSAGE_TYPES.get(args.type), args.code, args.sub_code):
+        print(f"{timestamp:.6f} {five_tuple.src}:{five_tuple.sport} -> {five_tuple.dst}:{five_tuple.dport}")
+        pprint(message, width=150)
@@ -1,69 +1,259 @@
-from flask import Flask, render_template, request, url_for
-from flask_socketio import SocketIO, join_room, leave_room, emit
-from threading import Thread
-from typing import List, Dict, Callable
-from queue import Queue
-from time import sleep
+from threading import Thread, Lock
+from typing import List, Dict, Callable, Set, Tuple
+from queue import Empty
+from time import sleep, monotonic
 from functools import partial
+import json
+
+from bounded_queue import BoundedQueue
+import metrics
+import hook_executors
+from sessions import sessions
+import pipeline
+import loss
+import interning
 
 __all__ = [
     "send_event",
     "send_event_gen",
     "register_on_event",
     "register_on_event_gen",
+    "set_coalescing",
+    "set_queue_policy",
 ]
 
-app = Flask(__name__)
-socketio = SocketIO(app)
 
-@socketio.event
+class Serialized:
+    '''
+    A payload already serialized to JSON, inlined as is by SerializedJSON
+    '''
+    __slots__ = ("json",)
+
+    def __init__(self, json: str):
+        self.json = json
+
+
+class SerializedJSON:
+    '''
+    json module for the Socket.IO packets, Serialized payloads are not serialized again
+    '''
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        if type(obj) is list and any(type(item) is Serialized for item in obj):
+            return "[" + ",".join(
+                item.json if type(item) is Serialized else json.dumps(item, *args, **kwargs)
+                    for item in obj
+            ) + "]"
+        return json.dumps(obj, *args, **kwargs)
+
+    loads = staticmethod(json.loads)
+
+
+# the web server(Flask and Flask-SocketIO) is only imported and created by create_server,
+# on start() or the first time event.app or event.socketio is used(eg: by an extension),
+# sending events(send_event) works without it
+server_created = False
+
+def create_server():
+    global server_created, app, socketio, request, join_room, leave_room, emit
+    if server_created:
+        return
+    from flask import Flask, request
+    from flask_socketio import SocketIO, join_room, leave_room, emit
+
+    app = Flask(__name__)
+    socketio = SocketIO(app, json=SerializedJSON)
+    for handler in (connect, disconnect, subscribe, unsubscribe, echo):
+        socketio.on_event(handler.__name__, handler)
+    for rule, view in routes:
+        app.add_url_rule(rule, view_func=view)
+    server_created = True
+
+def __getattr__(name):
+    if name in ("app", "socketio"):
+        create_server()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# rule => view, added to the app by create_server
+routes: List[Tuple[str, Callable]] = []
+
+def add_route(rule: str):
+    '''
+    Decorator generator for registering a route of the web server
+    '''
+    def add_decorator(func):
+        routes.append((rule, func))
+        if server_created:
+            app.add_url_rule(rule, view_func=func)
+        return func
+
+    return add_decorator
+
+
 def connect(arg):
     do_on_event("connect")
     print("New Client ", request.sid)
 
-@socketio.event
 def disconnect():
     do_on_event("disconnect")
     print('Disconnected ', request.sid)
+    # socketio leaves the rooms on it's own
+    for event_name in list(client_rooms.get(request.sid, ())):
+        remove_subscriber(request.sid, event_name)
 
-@socketio.event
 def subscribe(event_name):
     print("subscribed ", event_name)
     join_room(event_name)
+    add_subscriber(request.sid, event_name)
 
-    do_on_event("subscribe", subscrive_to=event_name)
+    do_on_event("subscribe", subscribed_to=event_name)
 
-@socketio.event
 def unsubscribe(event_name):
     print("unsubscribe ", event_name)
-    do_on_event("unsubscribe")
-    leave_room(event_name, unsubscribe_from=event_name)
+    do_on_event("unsubscribe", unsubscribed_from=event_name)
+    leave_room(event_name)
+    remove_subscriber(request.sid, event_name)
 
 
-@socketio.event
 def echo(data):
     emit("echo", "data", to=request.sid)
 
 
-event_queue = Queue()
+# clients subscribed to each event(room), events without any are not sent
+room_subscribers: Dict[str, int] = {}
+# sid => subscribed events
+client_rooms: Dict[str, Set[str]] = {}
+subscribers_lock = Lock()
+
+def add_subscriber(sid, event_name):
+    with subscribers_lock:
+        rooms = client_rooms.setdefault(sid, set())
+        if event_name not in rooms:
+            rooms.add(event_name)
+            room_subscribers[event_name] = room_subscribers.get(event_name, 0) + 1
+
+def remove_subscriber(sid, event_name):
+    with subscribers_lock:
+        rooms = client_rooms.get(sid, set())
+        if event_name in rooms:
+            rooms.discard(event_name)
+            room_subscribers[event_name] -= 1
+            if not room_subscribers[event_name]:
+                del room_subscribers[event_name]
+        if not rooms:
+            client_rooms.pop(sid, None)
+
+def has_subscribers(event_name: str) -> bool:
+    return event_name in room_subscribers
+
+
+# seconds between emits, the queue is drained in batches once per tick
+emit_interval = 0.05
+# event_name => how it's coalesced when sent multiple times in a tick(see set_coalescing)
+coalescing: Dict[str, str] = {}
+
+def set_coalescing(event_name: str, mode: str = "latest"):
+    '''
+    How an event sent multiple times in the same tick is emitted
+        None:       every payload in it's own frame(default)
+        "latest":   only the last payload
+        "batch":    a single frame with the list of payloads, the clients have to expect a list
+    '''
+    if mode is None:
+        coalescing.pop(event_name, None)
+    elif mode in ("latest", "batch"):
+        coalescing[event_name] = mode
+    else:
+        raise ValueError(f"Unknown coalescing mode: {mode}")
+
+
+def serialize(data):
+    '''
+    the payload serialized once, no matter how many clients it's sent to
+    payloads JSON can't hold(eg: bytes) are left to socketio
+    '''
+    try:
+        return Serialized(json.dumps(data, separators=(',', ':')))
+    except (TypeError, ValueError):
+        return data
+
+
+# events waiting for the emitter, when full the policy of the event decides what's dropped(see bounded_queue.py)
+event_queue_size = 10_000
+event_queue = BoundedQueue(event_queue_size, default_policy="drop_oldest")
 queue_consumer = False
 
+def set_queue_policy(event_name: str, policy: str, key=None, timeout=None):
+    '''
+    policy: "drop_oldest"(default), "drop_newest", "keep_latest" or "block"
+    key: for "keep_latest", only the latest queued event with the same key(data) is kept, eg: lambda data: data["id"]
+    timeout: for "block", seconds the hook waits for room
+    '''
+    event_queue.set_policy(event_name, policy, key=key, timeout=timeout)
+
+def drain_queue(first_item):
+    '''
+    returns the queued events in the order they have to be emited, coalesced
+    '''
+    batch = [first_item]
+    try:
+        while True:
+            batch.append(event_queue.get_nowait())
+    except Empty:
+        pass
+
+    # event_name => position in frames
+    coalesced = {}
+    frames = []
+    for event_name, data in batch:
+        mode = coalescing.get(event_name)
+        if mode is None:
+            frames.append((event_name, [data]))
+        elif event_name in coalesced:
+            payloads = frames[coalesced[event_name]][1]
+            if mode == "latest":
+                payloads[0] = data
+            else:
+                payloads.append(data)
+        else:
+            coalesced[event_name] = len(frames)
+            frames.append((event_name, [data]))
+
+    return frames
+
+def emit_frame(event_name, payloads):
+    if not has_subscribers(event_name):
+        return
+
+    if coalescing.get(event_name) == "batch":
+        data = serialize(payloads)
+    else:
+        data = serialize(payloads[-1])
+
+    socketio.emit(event_name, data, to=event_name)
+
 def later_loop():
     global queue_consumer
     queue_consumer = True
 
     print("later_loop started")
     while True:
-        event_name, data = event_queue.get()
-        socketio.emit(event_name, data, to=event_name)
+        tick_start = monotonic()
+        for event_name, payloads in drain_queue(event_queue.get()):
+            emit_frame(event_name, payloads)
+
+        if emit_interval:
+            sleep(max(0, emit_interval - (monotonic() - tick_start)))
 
 
 def send_event(event_name: str, data):
     '''
     fake sender, adds to queue
     '''
-    if queue_consumer:
-        event_queue.put_nowait((event_name, data))
+    if queue_consumer and event_name in room_subscribers:
+        event_queue.put_nowait(event_name, data)
 
 def send_event_gen(event_name: str):
     return partial(send_event, event_name)
@@ -87,15 +277,65 @@ def do_on_event(triggering_event: str, *args, **kwargs):
         callback_function(triggering_event, *args, **kwargs)
 
 
-@app.route("/site-map")
+@add_route("/site-map")
 def site_map():
     return repr(app.url_map)
 
+@add_route("/metrics")
+def prometheus_metrics():
+    '''
+    see metrics.py, empty unless metrics.enable() was called
+    '''
+    return metrics.render_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@add_route("/event_queue")
+def event_queue_stats():
+    return event_queue.stats()
+
+@add_route("/sessions")
+def session_stats():
+    '''
+    the clients followed, see sessions.py
+    '''
+    return {"sessions": sessions.stats()}
+
+@add_route("/reliable_window")
+def reliable_window_stats():
+    '''
+    duplicated, missing and reordered reliable commands, see reliable_window.py
+    '''
+    if pipeline.reliable_window is None:
+        return {}
+    return pipeline.reliable_window.stats()
+
+@add_route("/loss")
+def loss_stats():
+    '''
+    reliable gaps, unfinished fragmented commands and capture drops, totals and rolling rates, see loss.py
+    '''
+    return loss.monitor.report()
+
+@add_route("/interning")
+def interning_stats():
+    '''
+    hits, misses and memory of the caches of the decoded names and ids, see interning.py
+    '''
+    return interning.stats()
+
+@add_route("/hooks")
+def hook_stats():
+    '''
+    queue and lag of the hooks running off the packet thread, see hook_executors.py
+    '''
+    return hook_executors.stats()
+
 
-t = Thread(target=socketio.run, args=[app,], kwargs={"port":5055}, daemon=True)
 loop_task = Thread(target=later_loop, daemon=True)
 
 def start():
+    global t
+    create_server()
+    t = Thread(target=socketio.run, args=[app,], kwargs={"port":5055}, daemon=True)
     t.start()
     loop_task.start()
 
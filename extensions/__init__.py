@@ -1,21 +1,119 @@
+import ast
 import os
 from functools import partial
-from importlib import import_module 
+from importlib import import_module
 from pathlib import Path
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+import import_timings
+import streams
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
+# when the extensions were loaded(startup), for the lazy ones that measure from then, eg: fame_meter
+started = time()
+
+# extension => names of the streams(in streams.py) it hooks, from the lazy_streams = [...] of the extension,
+# these are imported on the first message of one of them instead of at startup
+# the ones without it are imported at startup, eg: the ones with a web page(hello_world)
+lazy_extensions: Dict[str, List[str]] = {}
+
+def load_extension(name: str):
+    print(f"Importing [{name}]: ...")
+    start = perf_counter()
+    import_module(f".{name}", package="extensions")
+    import_timings.record(f"extensions.{name}", perf_counter() - start)
+
 def import_small_extension(filename: str):
-    print(f"Importing [{filename}]: ...")
-    import_module(f".{filename[:-3]}", package="extensions")
+    load_extension(filename[:-3])
 
 def import_extension(extension_path: Path):
-    print(f"Importing [{filename}]: ...")
-    import_module(f".{filename}", package="extensions")
+    load_extension(os.path.basename(extension_path))
+
+
+def declared_lazy_streams(path: str) -> Optional[List[str]]:
+    '''
+    the lazy_streams of an extension(it's __init__.py for a directory), read without importing it(or it's dependencies)
+    None for the ones without it
+    '''
+    if os.path.isdir(path):
+        path = os.path.join(path, "__init__.py")
+    with open(path, encoding="utf-8") as file:
+        module = ast.parse(file.read(), path)
+
+    for statement in module.body:
+        if isinstance(statement, ast.Assign) and \
+                any(isinstance(target, ast.Name) and target.id == "lazy_streams" for target in statement.targets):
+            stream_names = ast.literal_eval(statement.value)
+            for stream_name in stream_names:
+                if not isinstance(getattr(streams, stream_name, None), streams.MessageStream):
+                    raise ValueError(f"{path}: lazy_streams has {stream_name!r}, not a stream in streams.py")
+            return list(stream_names)
+    return None
+
+
+def hook_counts() -> Dict[str, int]:
+    return {
+        stream_name: len(stream.hooks)
+        for stream_name, stream in vars(streams).items()
+        if isinstance(stream, streams.MessageStream)
+    }
+
+
+# the lazy extensions already imported
+loaded = set()
+
+def load_on_first_message(name: str, stream_names: List[str]):
+    '''
+    hooks a placeholder on the streams, the first message of one of them imports the extension,
+    the placeholders are removed and the hooks the extension added get that message
+    '''
+    placeholders = {}
+
+    def placeholder(stream, target):
+        if name not in loaded:
+            loaded.add(name)
+            for hooked_stream, hooked_placeholder in placeholders.items():
+                # a new list, the one being dispatched keeps going as it is
+                hooked_stream.hooks = [hook for hook in hooked_stream.hooks if hook is not hooked_placeholder]
+            streams.subscriptions_changed()
+
+            already_hooked = len(stream.hooks)
+            before = hook_counts()
+            load_extension(name)
+
+            undeclared = [
+                stream_name for stream_name, count in hook_counts().items()
+                if count > before.get(stream_name, 0) and stream_name not in stream_names
+            ]
+            if undeclared:
+                # those hooks would miss every message before the first one of the declared streams
+                raise RuntimeError(f"extension {name} hooks {', '.join(undeclared)}, missing from it's lazy_streams")
+
+            for hook in stream.hooks[already_hooked:]:
+                hook(target)
+
+    for stream_name in stream_names:
+        stream = getattr(streams, stream_name)
+        placeholders[stream] = partial(placeholder, stream)
+        stream.add_hook(placeholders[stream])
+
 
 for filename in (os.listdir(current_dir)):
     filepath = os.path.join(current_dir, filename)
     if os.path.isfile(filepath) and filename.endswith(".py") and filename != "__init__.py":
-        import_small_extension(filename)
+        name = filename[:-3]
     elif os.path.isdir(filepath) and filename != "__pycache__":
+        name = filename
+    else:
+        continue
+
+    stream_names = declared_lazy_streams(filepath)
+    if stream_names is not None:
+        lazy_extensions[name] = stream_names
+        load_on_first_message(name, stream_names)
+    elif os.path.isfile(filepath):
+        import_small_extension(filename)
+    else:
         import_extension(filepath)
@@ -1,11 +1,17 @@
 from streams import FameEvent
 from time import time
+import extensions
+
+# imported on the first message of these streams instead of at startup(see extensions.lazy_extensions)
+lazy_streams = ["FameEvent"]
 
 fame_meter_data={
     "total_fame": 0,
-    "start_time": time()
+    # imported on the first FameEvent(see lazy_streams), measured from startup
+    "start_time": extensions.started
 }
 
+# add_hook(mode="thread") would keep the printing off the packet thread, see hook_executors.py
 @FameEvent.add_hook
 def fame_meter(fame_event):
     '''
@@ -15,6 +21,9 @@ def fame_meter(fame_event):
     # print(fame_event)
     fame_meter_data["total_fame"] += fame_event[1]["fame_gained"]
     time_delta = time() - fame_meter_data["start_time"]
+    if time_delta <= 0:
+        # on a coarse clock, right at the start
+        return
     fame_per_sec = fame_meter_data["total_fame"] / time_delta
     kfame_per_h = fame_per_sec * 60*60 / 1000
 
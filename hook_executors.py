@@ -0,0 +1,222 @@
+import asyncio
+import traceback
+from abc import ABC, abstractmethod
+from functools import update_wrapper
+from queue import Empty
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+from bounded_queue import BoundedQueue
+
+'''
+Execution modes for the hooks of streams.MessageStream, see MessageStream.add_hook(func, mode=...)
+
+    "inline":   called in the packet callback, like before, a slow hook stalls the capture
+    "thread":   queued to a thread of it's own
+    "async":    queued to a background asyncio event loop, shared by all async hooks,
+                the hook is a coroutine function(or a plain function returning an awaitable)
+
+Every off-thread hook has it's own BoundedQueue(see bounded_queue.py), so a slow hook only drops it's own messages,
+and it's messages are handled one at a time, in order.
+The lag(time between queueing a message and the hook starting on it) is tracked per hook, see stats.
+'''
+
+INLINE = "inline"
+THREAD = "thread"
+ASYNC = "async"
+MODES = (INLINE, THREAD, ASYNC)
+
+# all off-thread hooks, for stats and join
+executors: List["OffThreadHook"] = []
+
+
+class OffThreadHook(ABC):
+    '''
+    Callable replacing the hook in the stream, __call__ only queues the message
+    the subclasses start what consumes the queue in run_worker
+
+    queue_size: messages kept at most before the policy kicks in
+    policy:     of the queue when full("drop_oldest", "drop_newest", "block"), see bounded_queue.py
+    timeout:    for "block", seconds to wait for room
+    '''
+
+    def __init__(self, func: Callable, queue_size: int = 1_000, policy: str = "drop_oldest", timeout: Optional[float] = None):
+        update_wrapper(self, func)
+        self.func = func
+        self.name = metrics.hook_name(func)
+        self.queue = BoundedQueue(queue_size, default_policy=policy)
+        if policy == "block":
+            self.queue.set_policy(self.name, policy, timeout=timeout)
+        self.started = False
+        self.start_lock = Lock()
+
+        self.processed = 0
+        self.errors = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+        executors.append(self)
+
+    def __call__(self, target):
+        if not self.started:
+            self.start()
+        self.queue.put(self.name, (perf_counter(), target))
+
+    def start(self):
+        # lazily, so no threads exist before multiprocess_pipeline forks it's workers
+        with self.start_lock:
+            if not self.started:
+                self.started = True
+                self.run_worker()
+
+    @abstractmethod
+    def run_worker(self):
+        '''
+        starts consuming the queue, called once, on the first message
+        '''
+
+    def started_on(self, queued_at):
+        lag = perf_counter() - queued_at
+        self.lag_last = lag
+        self.lag_total += lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        if metrics.enabled:
+            metrics.hook_lag_histogram(self.name).observe(lag)
+
+    def failed(self):
+        self.errors += 1
+        print(f"Hook {self.name} failed:")
+        traceback.print_exc()
+
+    def pending(self) -> int:
+        '''
+        messages queued or being handled
+        '''
+        return self.queue.put_count - self.queue.replaced - self.queue.stats()["dropped_total"] - self.processed - self.errors
+
+    def stats(self) -> Dict[str, Any]:
+        handled = self.processed + self.errors
+        queue = self.queue.stats()
+        return {
+            "mode": self.mode,
+            "processed": self.processed,
+            "errors": self.errors,
+            "queued": queue["size"],
+            "high_water": queue["high_water"],
+            "dropped": queue["dropped_total"],
+            "lag_last": self.lag_last,
+            "lag_max": self.lag_max,
+            "lag_mean": self.lag_total / handled if handled else 0.0,
+        }
+
+
+class ThreadHook(OffThreadHook):
+    mode = THREAD
+
+    def run_worker(self):
+        Thread(target=self.worker, name=f"hook {self.name}", daemon=True).start()
+
+    def worker(self):
+        func = self.func
+        get = self.queue.get
+        while True:
+            _, (queued_at, target) = get()
+            self.started_on(queued_at)
+            try:
+                func(target)
+                self.processed += 1
+            except Exception:
+                self.failed()
+
+
+class AsyncHook(OffThreadHook):
+    mode = ASYNC
+
+    def run_worker(self):
+        self.loop = event_loop()
+        self.ready = None
+        asyncio.run_coroutine_threadsafe(self.worker(), self.loop).result()
+
+    def __call__(self, target):
+        if not self.started:
+            self.start()
+        self.queue.put(self.name, (perf_counter(), target))
+        # wake up the worker, the queue itself can't be awaited
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def worker(self):
+        # created in the loop
+        self.ready = asyncio.Event()
+        asyncio.create_task(self.consume())
+
+    async def consume(self):
+        func = self.func
+        get_nowait = self.queue.get_nowait
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while True:
+                try:
+                    _, (queued_at, target) = get_nowait()
+                except Empty:
+                    break
+
+                self.started_on(queued_at)
+                try:
+                    result = func(target)
+                    if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+                        await result
+                    self.processed += 1
+                except Exception:
+                    self.failed()
+
+
+loop = None
+loop_lock = Lock()
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    '''
+    the background event loop of the async hooks, started on first use
+    '''
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name="async hooks", daemon=True).start()
+    return loop
+
+
+def wrap_hook(func: Callable, mode: str = INLINE, **options) -> Callable:
+    '''
+    returns what the stream should call for func
+    options: queue_size, policy, timeout, see OffThreadHook
+    '''
+    if mode == INLINE:
+        return func
+    if mode == THREAD:
+        return ThreadHook(func, **options)
+    if mode == ASYNC:
+        return AsyncHook(func, **options)
+    raise ValueError(f"Unknown hook mode: {mode}, expected one of {MODES}")
+
+
+def join(timeout: Optional[float] = None) -> bool:
+    '''
+    waits for the off-thread hooks to handle everything queued, eg: before exiting after replaying a capture
+    returns False on timeout
+    '''
+    deadline = None if timeout is None else perf_counter() + timeout
+    while any(executor.pending() > 0 for executor in executors):
+        if deadline is not None and perf_counter() >= deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {executor.name: executor.stats() for executor in executors}
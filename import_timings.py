@@ -0,0 +1,58 @@
+import builtins
+import sys
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+'''
+Import timings, to keep the time from starting main.py to the first packet low
+
+enable() wraps __import__ and records how long every module took to import the first time,
+including the modules it imported itself(like the cumulative column of python -X importtime, which has every module).
+Modules imported with importlib(eg: the extensions) are recorded with record().
+
+main.py enables it before it's other imports and prints report() once the capture is about to start.
+'''
+
+started = perf_counter()
+# module => seconds, in the order they finished importing
+timings: Dict[str, float] = {}
+
+original_import = builtins.__import__
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return original_import(name, globals, locals, fromlist, level)
+
+    start = perf_counter()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        if name not in timings and name in sys.modules:
+            timings[name] = perf_counter() - start
+
+
+def enable():
+    builtins.__import__ = timed_import
+
+
+def disable():
+    builtins.__import__ = original_import
+
+
+def record(name: str, seconds: float):
+    timings[name] = seconds
+
+
+def slowest(top: int = 15) -> List[Tuple[str, float]]:
+    '''
+    a module's time includes the ones it imported, so a slow package and the module that imported it both show up
+    '''
+    return sorted(timings.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def report(top: int = 15) -> str:
+    lines = [f"Started in {perf_counter() - started:.3f}s, slowest imports:"]
+    for name, seconds in slowest(top):
+        lines.append(f"    {seconds * 1000:8.1f} ms  {name}")
+    return "\n".join(lines)
@@ -0,0 +1,115 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+'''
+Bounded interning of the strings and ids the translators decode over and over
+
+Parse_String returns new bytes for every occurrence and the translators decode them again for every message,
+eg: player_name, guild_name, LocationID and CharacterID of every PlayerInfoResponse.
+An InternCache is used as a transformer instead of bytes.decode/bytes.hex, it returns the same str object
+for the same bytes, so long sessions don't keep allocating copies of the same names
+and the messages kept by the hooks share them.
+
+The caches are LRU bounded(max_size entries), a name not seen for a while is dropped first.
+Free text(eg: chat messages) shouldn't go through one, it rarely repeats and only pushes the names out.
+
+stats() has the hits, misses, evictions and the memory held by every cache, served on /interning.
+'''
+
+caches: Dict[str, "InternCache"] = {}
+
+
+class InternCache:
+    '''
+    func:       turns the raw value(eg: the bytes of Parse_String) into the canonical one, called on a miss
+    max_size:   entries kept, the least recently used one is dropped first
+    '''
+
+    def __init__(self, name: str, func: Callable[[Any], Any], max_size: int = 4096):
+        self.name = name
+        self.func = func
+        self.max_size = max_size
+        self.enabled = True
+        # raw value => canonical value, least recently used first
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def __call__(self, value):
+        if not self.enabled:
+            return self.func(value)
+
+        entries = self.entries
+        try:
+            interned = entries.get(value)
+        except TypeError:
+            # unhashable, eg: a memoryview
+            return self.func(value)
+
+        if interned is not None:
+            entries.move_to_end(value)
+            self.hits += 1
+            return interned
+
+        self.misses += 1
+        interned = entries[value] = self.func(value)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return interned
+
+    def clear(self):
+        self.entries.clear()
+
+    def memory(self) -> int:
+        '''
+        bytes held by the cache, the keys and values included
+        '''
+        # copied, called from other threads
+        items = list(self.entries.items())
+        return sys.getsizeof(self.entries) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in items)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "memory_bytes": self.memory(),
+        }
+
+    def __repr__(self):
+        return f"InternCache({self.name}, {len(self.entries)}/{self.max_size})"
+
+
+# names and location ids
+decode_string = InternCache("decode_string", bytes.decode)
+# character ids
+hex_id = InternCache("hex_id", bytes.hex)
+
+
+def set_enabled(enabled: bool):
+    '''
+    disabled caches call their func every time, the entries are dropped
+    '''
+    for cache in caches.values():
+        cache.enabled = enabled
+        if not enabled:
+            cache.clear()
+
+
+def clear():
+    for cache in caches.values():
+        cache.clear()
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {name: cache.stats() for name, cache in list(caches.items())}
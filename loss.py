@@ -0,0 +1,207 @@
+import traceback
+from collections import deque
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import capture
+import pipeline
+
+'''
+Loss accounting, to tell the messages the game never sent from the ones the sniffer lost
+
+    reliable:       reliable commands received and the sequence numbers never received(gaps), in total and per peer,
+                    from pipeline.reliable_window(see reliable_window.py)
+    fragments:      fragmented commands completed and the ones evicted before all of their fragments came,
+                    from pipeline.reassembler(see reassembly.py)
+    capture:        frames the kernel dropped before the packet socket read them, from the open capture.RawSocketCaptures
+    multiprocess:   datagrams dropped by the full rings of multiprocess_pipeline.py, while it runs
+
+Gaps without capture or ring drops were lost before the sniffer(the game or the network),
+drops growing with the traffic mean the pipeline is saturated, eg: more decode workers or bigger batches are needed.
+
+The sources are read every interval seconds by a background thread, the report has the totals and,
+for every window(eg: the last 10s, 1m and 5m), the rate per second of every counter and the share of what was lost(loss_ratio).
+Served on /loss.
+'''
+
+# group => counter => value, a source can report several groups, eg: one per peer as "reliable/<peer>"
+Groups = Dict[str, Dict[str, int]]
+
+sources: Dict[str, Callable[[], Groups]] = {}
+
+
+def add_source(name):
+    '''
+    Decorator generator for registering a function returning the current counters
+    '''
+    def add_decorator(func):
+        sources[name] = func
+        return func
+
+    return add_decorator
+
+
+# counters of what is there now instead of what happened, left out of the rates
+GAUGES = {"pending"}
+
+# kind of group => (lost counter, counters it is a share of), see the loss_ratio in LossMonitor.rates
+RATIOS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "reliable":     ("gaps", ("gaps", "received")),
+    "fragments":    ("evicted", ("evicted", "completed")),
+    # kernel_received includes the dropped frames
+    "capture":      ("kernel_dropped", ("kernel_received",)),
+    "multiprocess": ("ring_dropped", ("captured",)),
+}
+
+
+def peer_name(peer: Hashable) -> str:
+    if isinstance(peer, capture.FiveTuple):
+        return f"{peer.src}:{peer.sport}>{peer.dst}:{peer.dport}"
+    return "unknown" if peer is None else str(peer)
+
+
+@add_source("reliable")
+def reliable_counters(peers: bool = True) -> Groups:
+    window = pipeline.reliable_window
+    if window is None or not window.accepted:
+        return {}
+
+    stats = window.stats()
+    groups = {"reliable": {"received": stats["accepted"], "duplicates": stats["duplicates"], "gaps": stats["gaps"]}}
+    if peers:
+        for peer, counters in window.peer_stats().items():
+            groups[f"reliable/{peer_name(peer)}"] = counters
+    return groups
+
+
+@add_source("fragments")
+def fragment_counters() -> Groups:
+    reassembler = pipeline.reassembler
+    if not reassembler.fragments:
+        return {}
+    return {"fragments": {
+        "completed": reassembler.completed,
+        "evicted": reassembler.evicted_timeout + reassembler.evicted_memory,
+        "evicted_bytes": reassembler.evicted_bytes,
+        # not complete yet
+        "pending": len(reassembler.pending),
+    }}
+
+
+@add_source("capture")
+def capture_counters() -> Groups:
+    if not capture.open_captures:
+        return {}
+
+    counters = {"captured": 0, "kernel_received": 0, "kernel_dropped": 0}
+    for raw_capture in list(capture.open_captures):
+        try:
+            raw_capture.update_stats()
+        except OSError:
+            # closed in the meantime
+            continue
+        counters["captured"] += raw_capture.captured
+        counters["kernel_received"] += raw_capture.kernel_received
+        counters["kernel_dropped"] += raw_capture.kernel_dropped
+    return {"capture": counters}
+
+
+def local_counters() -> Groups:
+    '''
+    the counters of this process without the per peer ones, published by the workers of multiprocess_pipeline.py
+    '''
+    return {**reliable_counters(peers=False), **fragment_counters(), **capture_counters()}
+
+
+class LossMonitor:
+    '''
+    interval:   seconds between two readings of the sources
+    windows:    seconds the rates are computed over
+    '''
+
+    def __init__(self, interval: float = 1.0, windows: Tuple[float, ...] = (10, 60, 300), clock=monotonic):
+        self.interval = interval
+        self.windows = windows
+        self.clock = clock
+        # (time, groups), readings done for a report come on top of the periodic ones
+        self.samples = deque(maxlen=2 * int(max(windows) / interval) + 2)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread: Optional[Thread] = None
+
+    def sample(self) -> Groups:
+        groups = {}
+        for name, source in list(sources.items()):
+            try:
+                groups.update(source())
+            except Exception:
+                print(f"Loss source {name} failed:")
+                traceback.print_exc()
+
+        with self.lock:
+            self.samples.append((self.clock(), groups))
+        return groups
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, name="loss accounting", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def rates(self, window: float) -> Dict[str, Dict[str, float]]:
+        '''
+        group => counter => increase per second over the last window seconds, with the loss_ratio of the group
+        '''
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) < 2:
+            return {}
+
+        now, latest = samples[-1]
+        start, oldest = samples[-2]
+        for sample_time, groups in samples[:-1]:
+            if sample_time >= now - window:
+                start, oldest = sample_time, groups
+                break
+        elapsed = now - start
+        if elapsed <= 0:
+            return {}
+
+        rates = {}
+        for group, counters in latest.items():
+            before = oldest.get(group)
+            if before is None:
+                # showed up in the window, or it's source failed for that sample, no rate until the next window
+                continue
+            deltas = {counter: value - before.get(counter, 0) for counter, value in counters.items() if counter not in GAUGES}
+            group_rates = rates[group] = {counter: delta / elapsed for counter, delta in deltas.items()}
+
+            if group.partition("/")[0] in RATIOS:
+                lost, of = RATIOS[group.partition("/")[0]]
+                total = sum(deltas.get(counter, 0) for counter in of)
+                group_rates["loss_ratio"] = deltas.get(lost, 0) / total if total > 0 else 0.0
+
+        return rates
+
+    def report(self) -> Dict:
+        self.sample()
+        with self.lock:
+            totals = self.samples[-1][1]
+        return {
+            "totals": totals,
+            "rates": {f"{window:g}s": self.rates(window) for window in self.windows},
+        }
+
+
+monitor = LossMonitor()
@@ -1,16 +1,18 @@
-# import scapy
-# from scapy.all import *
+# time every import from here on, see show_import_timings
+import import_timings
+import_timings.enable()
+
 import traceback
 from streams import *
-from event import start as event_start, send_event
-from scapy.sendrecv import *
-from scapy.utils import *
-from scapy.all import get_if_hwaddr
-from layers import *
-from scapy.pipetool import CLIFeeder, PipeEngine
-from scapy.scapypipes import (WiresharkSink)
 import protocol16_parser as protocol16
+import pipeline
+import hook_executors
+from sessions import sessions
+from capture import FiveTuple
+import photon_decoder as photon
+from photon_decoder import albion_ports
 import json
+from functools import partial
 from pprint import pprint
 from time import sleep
 
@@ -19,52 +21,144 @@ def group_by_2(theList): return group_by(theList, 2)
 
 
 show_unknown_command_types=False
-
-
-interface = "Ethernet"
-mac_address = get_if_hwaddr(interface)
-
+pipeline.show_unknown_command_types = show_unknown_command_types
+
+# walk the payload with a moving offset instead of slicing off every decoded field(Scapy layers only)
+use_offset_decoder = True
+
+# decode the Photon layers with photon_decoder(pipeline.py) instead of the Scapy layers(kept for debugging and show())
+use_photon_decoder = True
+
+# "scapy": scapy.sniff
+# "af_packet": capture.RawSocketCapture, linux only, always uses the photon decoder
+capture_backend = "scapy"
+
+# how captures are read
+# "scapy": sniff(offline=...)
+# "mmap": pcap_reader.replay, always uses the photon decoder
+offline_reader = "mmap"
+
+# Scapy(only the submodules used) and the Scapy layers are only imported for it's paths
+uses_scapy = capture_backend == "scapy" or offline_reader == "scapy"
+if uses_scapy:
+    from scapy.config import conf
+    from scapy.sendrecv import sniff
+    from layers import *
+
+# the web server for the clients(Flask and Flask-SocketIO, see event.py), without it the events are not sent
+use_event_server = True
+
+# print how long the slowest imports took, once started(see import_timings.py)
+show_import_timings = True
+
+# only decode messages with hooks or unknown streams listening(see pipeline.is_subscribed)
+use_lazy_decoding = True
+pipeline.lazy_decoding = use_lazy_decoding
+
+# per stream/hook counters and latencies, served on /metrics(see metrics.py)
+use_metrics = False
+if use_metrics:
+    import metrics
+    metrics.enable()
+
+# capture, decode and dispatch in separate processes(multiprocess_pipeline.py, linux only)
+# only with the "af_packet" backend or the "mmap" reader
+use_multiprocess = False
+decode_workers = 2
+
+# positions of the player and, given the stream of their move events, the entities around it(see spatial.py)
+use_spatial_index = False
+if use_spatial_index:
+    import spatial
+    spatial.enable()
+
+# drop retransmitted reliable commands before decoding them(see reliable_window.py)
+use_reliable_window = True
+# and hold the ones arriving ahead of a missing one until it comes, photon decoder only
+reorder_reliable_commands = False
+if use_reliable_window:
+    from reliable_window import ReliableWindow
+    pipeline.reliable_window = ReliableWindow(reorder=reorder_reliable_commands)
+
+# rolling rates of the reliable gaps, the unfinished fragmented commands and the capture drops, served on /loss(see loss.py)
+use_loss_accounting = True
+if use_loss_accounting:
+    import loss
+    loss.monitor.start()
+
+# one str object for the names and ids the translators decode again for every message, stats on /interning(see interning.py)
+use_interning = True
+if not use_interning:
+    import interning
+    interning.set_enabled(False)
+
+# record every message to a message log in this directory, eg: "logs/session"(see message_log.py), not with use_multiprocess
+record_directory = None
+if record_directory and not use_multiprocess:
+    from message_log import MessageLog
+    pipeline.recorder = MessageLog(record_directory)
+
+# the other backends go straight to pipeline.py
+use_photon_decoder = use_photon_decoder or capture_backend == "af_packet" or offline_reader == "mmap"
+
+if use_offset_decoder:
+    Parse_EventData = protocol16.Parse_EventData_at
+    Parse_OperationRequest = protocol16.Parse_OperationRequest_at
+    Parse_OperationResponse = protocol16.Parse_OperationResponse_at
+else:
+    Parse_EventData = protocol16.Parse_EventData
+    Parse_OperationRequest = protocol16.Parse_OperationRequest
+    Parse_OperationResponse = protocol16.Parse_OperationResponse
+
+
+# every interface to capture on, the clients are told apart by their connection(see sessions.py)
+interfaces = ["Ethernet"]
+
+# the ones with a lazy_streams = [...] are imported on the first message of those streams(see extensions.lazy_extensions)
 import extensions
 
+# the Scapy layers dispatch through the same tables as pipeline.py, so they are counted by metrics.py too
+request_table = pipeline.dispatch_tables[photon.REQUEST_MESSAGE]
+response_table = pipeline.dispatch_tables[photon.RESPONSE_MESSAGE]
+event_table = pipeline.dispatch_tables[photon.EVENT_MESSAGE]
 
-def decode_message(message):
-    if message.message_type == EventMessage.id:
-        return protocol16.Parse_EventData(message.message.original)
-
-    elif message.message_type == RequestMessage.id:
-        return protocol16.Parse_OperationRequest(message.message.original)
-
-    elif message.message_type == ResponseMessage.id:
-        return protocol16.Parse_OperationResponse(message.message.original)
 
-    else:
-        print("unknown message type:  ", message.message_type)
-
-fragmented_commands = {}
+def decode_payload(message_type, payload):
+    if message_type == EventMessage.id:
+        return Parse_EventData(payload)
 
+    elif message_type == RequestMessage.id:
+        return Parse_OperationRequest(payload)
 
-def handle_FragmentCommand(command):
-    if command.start_sequence_number not in fragmented_commands:
-        # new command
-        fragmented_commands[command.start_sequence_number] = {}
+    elif message_type == ResponseMessage.id:
+        return Parse_OperationResponse(payload)
 
-    # save contents of fragment
-    fragmented_commands[command.start_sequence_number][command.fragment_number] = command.command_fragment.original
+    else:
+        print("unknown message type:  ", message_type)
 
-    if len(fragmented_commands[command.start_sequence_number]) != command.fragment_count:
-        # waiting for fragments
+def decode_message(message):
+    return decode_payload(message.message_type, message.message.original)
+
+def handle_FragmentCommand(command, peer, channel_id):
+    fragmented_command = pipeline.reassembler.add(
+        peer,
+        channel_id,
+        command.start_sequence_number,
+        command.fragment_number,
+        command.fragment_count,
+        command.total_length,
+        command.fragment_offset,
+        command.command_fragment.original
+    )
+
+    if fragmented_command is None:
         return
 
-    # reasemble command
-    fragmented_command = b"".join([
-        fragmented_commands[command.start_sequence_number][i]
-            for i in range(command.fragment_count)
-    ])
-
-    # delete fragments
-    del fragmented_commands[command.start_sequence_number]
+    message = MessageWrapper(bytes(fragmented_command))
+    if use_lazy_decoding and not pipeline.is_subscribed(response_table, message.message_type, message.message.original):
+        return
 
-    fragmented_command = decode_message(MessageWrapper(fragmented_command))
+    fragmented_command = decode_message(message)
 
     if not fragmented_command:
         # failed to decode
@@ -73,7 +167,7 @@ def handle_FragmentCommand(command):
     fragmented_command = fragmented_command[0]
 
     # responses can have excesive sizes, so just asume this is a ResponseMessage
-    ReponseBundle(fragmented_command)
+    response_table(fragmented_command)
 
 
 def handle_unknown_command(command):
@@ -85,15 +179,27 @@ def handle_unknown_command(command):
 
 
 def procces_packet(pOrg):
-    if not pOrg.haslayer(PhotonHeader):
+    if use_photon_decoder:
+        if not pOrg.haslayer(UDP):
+            return
+        udp = pOrg[UDP]
+        if udp.sport not in albion_ports and udp.dport not in albion_ports:
+            return
+    elif not pOrg.haslayer(PhotonHeader):
         return
-    pHeader = pOrg[PhotonHeader]
 
-    ether: Ether = pOrg[Ether]
-    # this might not hold for ppl 2 network interface, eg: laptops or PC with WIFI
-    # TODO: make more robust
-    assert ether.dst == mac_address or ether.src == mac_address
-    incomming_request = ether.dst == mac_address
+    ip = pOrg[IP]
+    udp = pOrg[UDP]
+    # identifies the connection when reassembling fragments and the session(the direction comes from the albion ports)
+    peer = FiveTuple(ip.src, udp.sport, ip.dst, udp.dport)
+
+    if use_photon_decoder:
+        pipeline.procces_photon_payload(bytes(udp.payload), peer)
+        return
+
+    sessions.activate(peer)
+
+    pHeader = pOrg[PhotonHeader]
 
     for i, command in enumerate(pHeader.commands):
         try:
@@ -109,10 +215,16 @@ def procces_packet(pOrg):
             handle_unknown_command(command)
             continue
 
+        channel_id = command.channel_id
         command = command.actual_command
 
+        if pipeline.reliable_window is not None and command.id in (ReliableCommand.id, FragmentCommand.id) and \
+                not pipeline.reliable_window.accept(peer, channel_id, command.sequence_number):
+            # retransmitted
+            continue
+
         if command.id == FragmentCommand.id:
-            handle_FragmentCommand(command)
+            handle_FragmentCommand(command, peer, channel_id)
             continue
 
         try:
@@ -123,42 +235,77 @@ def procces_packet(pOrg):
             pOrg.show()
             exit()
 
+        message_type = command.message.message_type
+        if use_lazy_decoding and message_type in pipeline.dispatch_tables and \
+                not pipeline.is_subscribed(pipeline.dispatch_tables[message_type], message_type, command.message.message.original):
+            continue
+
         if command.message.message_type == EventMessage.id:
             pass
-            event = protocol16.Parse_EventData(command.message.message.original)[0]
+            event = Parse_EventData(command.message.message.original)[0]
             # print("Event: ", event)
-            EventBundle(event)
+            event_table(event)
 
         elif command.message.message_type == RequestMessage.id:
             pass
-            request = protocol16.Parse_OperationRequest(command.message.message.original)[0]
+            request = Parse_OperationRequest(command.message.message.original)[0]
             # print("Request: ", request)
-            RequestBundle(request)
+            request_table(request)
 
         elif command.message.message_type == ResponseMessage.id:
             pass
-            response = protocol16.Parse_OperationResponse(command.message.message.original)[0]
+            response = Parse_OperationResponse(command.message.message.original)[0]
             # print("Response: ", response)
-            ReponseBundle(response)
+            response_table(response)
 
         else:
             pass
             # print("unknown message type:  ", command.message.message_type)
             # command.message.show()
 
-conf.layers.filter([Ether, IP, UDP, PhotonHeader])
+if uses_scapy:
+    if use_photon_decoder:
+        # leave the UDP payload undissected
+        conf.layers.filter([Ether, IP, UDP])
+    else:
+        conf.layers.filter([Ether, IP, UDP, PhotonHeader])
 sniffer_settings = {
     "filter":"udp",
     "store": False,
 }
-event_start()
+if use_event_server:
+    from event import start as event_start
+    event_start()
 
+# the imports from here on are not timed
+import_timings.disable()
+if show_import_timings:
+    print(import_timings.report())
 
-# sniff(iface=interface, prn=procces_packet, **sniffer_settings), exit()
+
+# sniff(iface=interfaces, prn=procces_packet, **sniffer_settings), exit()
+
+if capture_backend == "af_packet":
+    from capture import sniff_raw
+    if use_multiprocess:
+        from multiprocess_pipeline import MultiProcessPipeline
+        MultiProcessPipeline(partial(sniff_raw, iface=interfaces), workers=decode_workers, stats_interval=60).run(), exit()
+    sniff_raw(pipeline.procces_udp_payload, iface=interfaces), exit()
 
 capture_file = "captures/change_zone.pcapng"
 capture_file = "captures/0_to_city.pcapng"
 
 input("Using a capture? is the event engine ready?")
-sniff(prn=procces_packet, offline=capture_file, store=False)
+if offline_reader == "mmap":
+    from pcap_reader import replay
+    if use_multiprocess:
+        from multiprocess_pipeline import MultiProcessPipeline
+        MultiProcessPipeline(partial(replay, capture_file), workers=decode_workers, lossless=True).run()
+    else:
+        replay(capture_file, pipeline.procces_udp_payload)
+        pipeline.flush_reliable_window()
+else:
+    sniff(prn=procces_packet, offline=capture_file, store=False)
+# let the hooks running off the packet thread catch up
+hook_executors.join(timeout=30)
 input("exit?"), exit()
@@ -0,0 +1,323 @@
+import mmap
+import os
+import socket
+from bisect import bisect_right
+from glob import glob
+from struct import Struct
+from time import perf_counter, sleep, time
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import photon_decoder as photon
+import protocol16_serializer
+from capture import FiveTuple
+
+'''
+Append-only log of the Photon messages of a session, for re-analysing it without Scapy or the capture
+
+A log is a directory of segments, each one a pair of files:
+    NNNNNNNN.log:   the records, back to back
+    NNNNNNNN.idx:   sparse time index, a (timestamp, offset) entry every index_interval seconds of the segment
+
+A record is:
+    u32     length of the payload
+    f64     timestamp(seconds since the epoch)
+    u8      kind: the photon message type(photon.REQUEST_MESSAGE, RESPONSE_MESSAGE, EVENT_MESSAGE)
+    4s H    source ip and port
+    4s H    destination ip and port
+    payload the message(code, parameters and for responses the return code and debug message) in Protocol16,
+            as it came in the datagram(or serialized by protocol16_serializer, see MessageLog.append_message)
+
+Keeping the parameters in Protocol16 means recording costs no decoding or serializing(it works with lazy decoding)
+and replaying goes through the same offset decoders as the live pipeline.
+
+Seeking to a time only reads the indexes and the records from the closest indexed one,
+a segment whose index ends before the start is skipped without being read.
+A record cut short(eg: the recorder was killed) ends the segment.
+'''
+
+RECORD = Struct("<IdB4sH4sH")
+INDEX_ENTRY = Struct("<dQ")
+NO_PEER = (b"\0" * 4, 0, b"\0" * 4, 0)
+
+serializers = {
+    photon.REQUEST_MESSAGE:  protocol16_serializer.Serialize_OperationRequest,
+    photon.RESPONSE_MESSAGE: protocol16_serializer.Serialize_OperationResponse,
+    photon.EVENT_MESSAGE:    protocol16_serializer.Serialize_EventData,
+}
+
+
+def pack_peer(peer) -> tuple:
+    '''
+    peer: a capture.FiveTuple, the 12 byte key of multiprocess_pipeline.peer_key or None
+    '''
+    if isinstance(peer, FiveTuple):
+        return socket.inet_aton(peer.src), peer.sport, socket.inet_aton(peer.dst), peer.dport
+    if isinstance(peer, (bytes, bytearray)) and len(peer) == 12:
+        return peer[:4], int.from_bytes(peer[4:6], "big"), peer[6:10], int.from_bytes(peer[10:12], "big")
+    return NO_PEER
+
+
+def unpack_peer(src, sport, dst, dport) -> Optional[FiveTuple]:
+    if sport == 0 and dport == 0:
+        return None
+    return FiveTuple(socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport)
+
+
+def segment_paths(directory: str) -> List[str]:
+    '''
+    the .log files of the directory, oldest first
+    '''
+    return sorted(glob(os.path.join(directory, "*.log")))
+
+
+class MessageLog:
+    '''
+    Writer
+
+    directory:      created if missing, appending to an existing log starts a new segment
+    segment_size:   bytes after which a new segment is started
+    index_interval: seconds between the entries of the time index
+    clock:          timestamps of record, eg: the capture's time when converting a capture
+    '''
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, index_interval: float = 1.0, clock: Callable[[], float] = time):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+
+        existing = segment_paths(directory)
+        self.segment_number = int(os.path.basename(existing[-1])[:-4]) + 1 if existing else 0
+        self.file = None
+        self.index_file = None
+
+        self.records = 0
+        self.bytes_written = 0
+
+    def open_segment(self):
+        self.close()
+        base = os.path.join(self.directory, f"{self.segment_number:08d}")
+        self.segment_number += 1
+        self.file = open(base + ".log", "wb", buffering=1024 * 1024)
+        self.index_file = open(base + ".idx", "wb")
+        self.offset = 0
+        self.next_index = float("-inf")
+
+    def append(self, timestamp: float, peer, kind: int, payload):
+        '''
+        payload: the message in Protocol16, eg: a command's payload
+        '''
+        if self.file is None or self.offset >= self.segment_size:
+            self.open_segment()
+
+        if timestamp >= self.next_index:
+            # every index_interval, so at most that much is lost if the process dies
+            self.file.flush()
+            self.index_file.write(INDEX_ENTRY.pack(timestamp, self.offset))
+            self.next_index = timestamp + self.index_interval
+
+        self.file.write(RECORD.pack(len(payload), timestamp, kind, *pack_peer(peer)))
+        self.file.write(payload)
+
+        size = RECORD.size + len(payload)
+        self.offset += size
+        self.bytes_written += size
+        self.records += 1
+
+    def record(self, kind: int, payload, peer=None):
+        '''
+        append at the current time of the clock, called by pipeline.py for every message when pipeline.recorder is set
+        '''
+        self.append(self.clock(), peer, kind, payload)
+
+    def append_message(self, timestamp: float, peer, kind: int, message):
+        '''
+        append an already decoded message, serialized with protocol16_serializer
+        '''
+        self.append(timestamp, peer, kind, serializers[kind](message))
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            self.index_file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path[:-4] + ".idx", "rb") as f:
+            index = f.read()
+        # a partially written entry is ignored
+        entries = [INDEX_ENTRY.unpack_from(index, offset) for offset in range(0, len(index) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        self.index_times = [entry[0] for entry in entries]
+        self.index_offsets = [entry[1] for entry in entries]
+
+    @property
+    def start(self) -> Optional[float]:
+        return self.index_times[0] if self.index_times else None
+
+    def offset_of(self, timestamp: Optional[float]) -> int:
+        '''
+        offset of the last indexed record at or before timestamp, records before it are older
+        '''
+        if timestamp is None or not self.index_times:
+            return 0
+        position = bisect_right(self.index_times, timestamp) - 1
+        return self.index_offsets[position] if position >= 0 else 0
+
+    def read(self, start: Optional[float] = None, end: Optional[float] = None):
+        '''
+        yields (timestamp, peer, kind, payload)
+        returns True if the end was reached
+        '''
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                data = memoryview(mapped)
+                try:
+                    offset = self.offset_of(start)
+                    size = len(data)
+                    while offset + RECORD.size <= size:
+                        length, timestamp, kind, src, sport, dst, dport = RECORD.unpack_from(data, offset)
+                        payload_start = offset + RECORD.size
+                        offset = payload_start + length
+                        if offset > size:
+                            # cut short
+                            break
+                        if start is not None and timestamp < start:
+                            continue
+                        if end is not None and timestamp > end:
+                            return True
+                        # copied, decoded messages can keep views of it around(eg: in a hook's queue)
+                        yield timestamp, unpack_peer(src, sport, dst, dport), kind, data[payload_start:offset].tobytes()
+                finally:
+                    data.release()
+        return False
+
+
+class MessageLogReader:
+    '''
+    Reader of the directory written by MessageLog
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segments = [Segment(path) for path in segment_paths(directory)]
+
+    def read(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[float, Optional[FiveTuple], int, bytes]]:
+        '''
+        yields (timestamp, peer, kind, payload) of the records between start and end(seconds since the epoch, inclusive)
+        '''
+        segments = self.segments
+        for number, segment in enumerate(segments):
+            next_start = segments[number + 1].start if number + 1 < len(segments) else None
+            if start is not None and next_start is not None and next_start < start:
+                # everything is older
+                continue
+            if end is not None and segment.start is not None and segment.start > end:
+                break
+
+            if (yield from segment.read(start, end)):
+                break
+
+    __iter__ = read
+
+    def time_range(self) -> Tuple[Optional[float], Optional[float]]:
+        '''
+        (first, last) timestamp, only the last segment is read
+        '''
+        starts = [segment.start for segment in self.segments if segment.start is not None]
+        if not starts:
+            return None, None
+        last = starts[-1]
+        for timestamp, *_ in self.segments[-1].read(self.segments[-1].index_times[-1] if self.segments[-1].index_times else None):
+            last = timestamp
+        return starts[0], last
+
+    def replay(self, start: Optional[float] = None, end: Optional[float] = None, speed: float = 0,
+               dispatch: Callable[[int, bytes, Optional[FiveTuple]], None] = None) -> int:
+        '''
+        feeds the records to the streams(RequestBundle, ReponseBundle, EventBundle through pipeline.py)
+
+        speed:      0 for as fast as possible, 1 for wall-clock, 2 for twice as fast, ...
+        dispatch:   called with (kind, payload, peer), pipeline.procces_message by default
+
+        returns the number of records replayed
+        '''
+        if dispatch is None:
+            import pipeline
+            dispatch = pipeline.procces_message
+
+        replayed = 0
+        first_timestamp = None
+        for timestamp, peer, kind, payload in self.read(start, end):
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp, started = timestamp, perf_counter()
+                delay = (timestamp - first_timestamp) / speed - (perf_counter() - started)
+                if delay > 0:
+                    sleep(delay)
+
+            dispatch(kind, payload, peer)
+            replayed += 1
+        return replayed
+
+
+def record_capture(capture_file: str, directory: str, **kwargs) -> int:
+    '''
+    converts a capture to a log, with the capture's timestamps, every message is recorded regardless of lazy decoding
+    kwargs: of MessageLog
+
+    returns the number of records
+    '''
+    import pipeline
+    from pcap_reader import PcapReader
+
+    timestamp = 0.0
+    saved = pipeline.recorder
+    pipeline.reassembler.clear()
+    with MessageLog(directory, clock=lambda: timestamp, **kwargs) as log, PcapReader(capture_file) as reader:
+        pipeline.recorder = log
+        try:
+            for timestamp, five_tuple, payload in reader:
+                for _ in pipeline.decode_photon_payload(payload, five_tuple):
+                    pass
+        finally:
+            pipeline.recorder = saved
+        return log.records
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from datetime import datetime
+
+    parser = ArgumentParser(description="Record captures to a message log, or show what a log contains")
+    parser.add_argument("directory")
+    parser.add_argument("capture_files", nargs="*", help="appended to the log, one segment or more each")
+    args = parser.parse_args()
+
+    for capture_file in args.capture_files:
+        print(f"{capture_file}: {record_capture(capture_file, args.directory)} records")
+
+    reader = MessageLogReader(args.directory)
+    first, last = reader.time_range()
+    if first is None:
+        print("empty log")
+    else:
+        size = sum(os.path.getsize(segment.path) for segment in reader.segments)
+        print(f"{len(reader.segments)} segments, {size:,} bytes, {datetime.fromtimestamp(first)} -> {datetime.fromtimestamp(last)}")
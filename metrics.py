@@ -0,0 +1,187 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, List, Tuple
+
+'''
+Counters and latency histograms of the dispatch path, in Prometheus' text format(served on /metrics by event.py)
+
+    stream_messages:    messages dispatched to each stream
+    stream_latency:     translation and all hooks of a stream, per message
+    hook_latency:       each hook, per message(only the queueing for hooks off the packet thread, see hook_executors.py)
+    hook_lag:           hooks off the packet thread, time from queueing a message to handling it
+    unknown_messages:   messages with an identifier no stream is added for, by (code, sub_code)
+
+Instrumentation is off by default and costs nothing then:
+enable swaps the dispatch of streams.DispatchTable for an instrumented one, disable swaps it back.
+Both decoders dispatch through the tables of pipeline.py, the Scapy layers of main.py included.
+'''
+
+enabled = False
+
+# seconds
+LATENCY_BUCKETS = [
+    0.000_001, 0.000_005, 0.000_010, 0.000_050, 0.000_100, 0.000_500,
+    0.001, 0.005, 0.010, 0.050, 0.100, 0.500, 1.0,
+]
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: List[float] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        # the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            yield bound, total
+
+
+# (table, stream) => count
+stream_messages: Dict[Tuple[str, str], int] = {}
+# (table, stream) => Histogram
+stream_latency: Dict[Tuple[str, str], Histogram] = {}
+# (table, stream, hook) => Histogram
+hook_latency: Dict[Tuple[str, str, str], Histogram] = {}
+# hook => Histogram
+hook_lag: Dict[str, Histogram] = {}
+# (table, code, sub_code) => count
+unknown_messages: Dict[Tuple[str, str, str], int] = {}
+
+# only for creating new entries, the hot path relies on the GIL
+registry_lock = Lock()
+
+
+def stream_histogram(table: str, stream: str) -> Histogram:
+    key = (table, stream)
+    if key not in stream_latency:
+        with registry_lock:
+            stream_messages.setdefault(key, 0)
+            stream_latency.setdefault(key, Histogram())
+    return stream_latency[key]
+
+
+def hook_histogram(table: str, stream: str, hook: str) -> Histogram:
+    key = (table, stream, hook)
+    if key not in hook_latency:
+        with registry_lock:
+            hook_latency.setdefault(key, Histogram())
+    return hook_latency[key]
+
+
+def hook_lag_histogram(hook: str) -> Histogram:
+    if hook not in hook_lag:
+        with registry_lock:
+            hook_lag.setdefault(hook, Histogram())
+    return hook_lag[hook]
+
+
+def count_unknown(table: str, code, sub_code=None):
+    key = (table, str(code), "" if sub_code is None else str(sub_code))
+    unknown_messages[key] = unknown_messages.get(key, 0) + 1
+
+
+def hook_name(hook) -> str:
+    module = getattr(hook, "__module__", None)
+    name = getattr(hook, "__qualname__", None) or repr(hook)
+    return f"{module}.{name}" if module else name
+
+
+def enable():
+    global enabled
+    from streams import DispatchTable, subscriptions_changed
+
+    enabled = True
+    DispatchTable.__call__ = DispatchTable.dispatch_instrumented
+    DispatchTable.is_subscribed = DispatchTable.is_subscribed_instrumented
+    # recompile the routes with the hook names
+    subscriptions_changed()
+
+
+def disable():
+    global enabled
+    from streams import DispatchTable
+
+    enabled = False
+    DispatchTable.__call__ = DispatchTable.dispatch
+    DispatchTable.is_subscribed = DispatchTable.is_subscribed_plain
+
+
+def reset():
+    with registry_lock:
+        stream_messages.clear()
+        stream_latency.clear()
+        hook_latency.clear()
+        hook_lag.clear()
+        unknown_messages.clear()
+
+    # the compiled routes of the dispatch tables hold the old histograms, rebuilt on the next message
+    import streams
+    streams.subscriptions_changed()
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_histogram(lines: List[str], name: str, histogram: Histogram, **labels):
+    for bound, count in histogram.cumulative():
+        lines.append(f"{name}_bucket{format_labels(**labels, le='+Inf' if bound == float('inf') else repr(bound))} {count}")
+    lines.append(f"{name}_sum{format_labels(**labels)} {histogram.sum!r}")
+    lines.append(f"{name}_count{format_labels(**labels)} {histogram.count}")
+
+
+def render_prometheus() -> str:
+    '''
+    everything collected, in Prometheus' text exposition format
+    '''
+    lines = [
+        "# HELP albion_stream_messages_total Messages dispatched to a stream",
+        "# TYPE albion_stream_messages_total counter",
+    ]
+    for (table, stream), count in list(stream_messages.items()):
+        lines.append(f"albion_stream_messages_total{format_labels(table=table, stream=stream)} {count}")
+
+    lines += [
+        "# HELP albion_stream_latency_seconds Translation and hooks of a stream, per message",
+        "# TYPE albion_stream_latency_seconds histogram",
+    ]
+    for (table, stream), histogram in list(stream_latency.items()):
+        format_histogram(lines, "albion_stream_latency_seconds", histogram, table=table, stream=stream)
+
+    lines += [
+        "# HELP albion_hook_latency_seconds A single hook, per message",
+        "# TYPE albion_hook_latency_seconds histogram",
+    ]
+    for (table, stream, hook), histogram in list(hook_latency.items()):
+        format_histogram(lines, "albion_hook_latency_seconds", histogram, table=table, stream=stream, hook=hook)
+
+    lines += [
+        "# HELP albion_hook_lag_seconds Queueing to handling of a message, for hooks off the packet thread",
+        "# TYPE albion_hook_lag_seconds histogram",
+    ]
+    for hook, histogram in list(hook_lag.items()):
+        format_histogram(lines, "albion_hook_lag_seconds", histogram, hook=hook)
+
+    lines += [
+        "# HELP albion_unknown_messages_total Messages with a code or sub code without a stream",
+        "# TYPE albion_unknown_messages_total counter",
+    ]
+    for (table, code, sub_code), count in list(unknown_messages.items()):
+        lines.append(f"albion_unknown_messages_total{format_labels(table=table, code=code, sub_code=sub_code)} {count}")
+
+    return "\n".join(lines) + "\n"
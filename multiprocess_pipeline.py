@@ -0,0 +1,459 @@
+import multiprocessing
+import pickle
+import socket
+from multiprocessing.shared_memory import SharedMemory
+from struct import Struct
+from time import monotonic, sleep
+from typing import Callable, List
+from zlib import crc32
+
+import loss
+import pipeline
+from capture import FiveTuple
+from sessions import sessions
+
+'''
+Optional multi-process mode of pipeline.py, Linux only(the workers are forked)
+
+    capture process ==ring==> decode worker ==ring==> dispatch(this process)
+                    ==ring==> decode worker ==ring==>
+                    ...
+
+capture:    runs a capture source(capture.sniff_raw, pcap_reader.replay, ...) and writes the raw UDP payloads
+            to the input ring of a worker, picked by the connection so every peer is decoded in order by one worker
+decode:     Photon and Protocol16 decoding(pipeline.decode_photon_payload, including fragment reassembly and lazy decoding),
+            the decoded messages are pickled to it's output ring
+dispatch:   the process calling MultiProcessPipeline.run, unpickles the messages and runs the streams.py hooks,
+            so the extensions and the event server keep running in the main process,
+            every message carries it's connection so the hooks see the session it belongs to(see sessions.py)
+
+Connections, so the sessions of different clients, are spread over the decode workers.
+
+The rings are single producer, single consumer queues over multiprocessing.shared_memory,
+when an input ring is full the datagram is dropped(unless lossless, eg: for replaying captures),
+the workers wait for room in their output ring, so a slow dispatch shows up as drops at the capture.
+
+The workers are forked after the extensions are imported, hooks added later are not seen by lazy decoding in the workers.
+'''
+
+# indexes in the header of a ring, in u64s
+# written by the producer
+RING_WRITE = 0
+RING_WRITTEN = 1
+RING_DROPPED = 2
+RING_CLOSED = 3
+# written by the consumer, on it's own cache line
+RING_READ = 8
+RING_READ_RECORDS = 9
+
+RING_HEADER_SIZE = 128
+RECORD_HEADER = Struct("<I")
+# rest of the ring is unused, start over
+RECORD_WRAP = 0xFFFFFFFF
+
+IDLE_SLEEP = 0.0005
+
+
+class RingBuffer:
+    '''
+    Single producer, single consumer queue of variable sized records in shared memory
+
+    Records are a u32 length followed by the data, never split over the end of the ring.
+    The producer and consumer positions are ever increasing byte counts,
+    each one written by a single process, so no locks are needed.
+    '''
+
+    def __init__(self, capacity: int = 8 * 1024 * 1024):
+        self.capacity = capacity
+        self.memory = SharedMemory(create=True, size=RING_HEADER_SIZE + capacity)
+        self.header = self.memory.buf[:RING_HEADER_SIZE].cast("Q")
+        self.data = self.memory.buf[RING_HEADER_SIZE:]
+        for index in range(len(self.header)):
+            self.header[index] = 0
+
+    def put(self, *parts, block: bool = False, stop=None) -> bool:
+        '''
+        writes the parts as a single record
+        block: wait for room instead of dropping the record, until stop() is True
+
+        returns False if the record was dropped
+        '''
+        size = sum(len(part) for part in parts)
+        record_size = RECORD_HEADER.size + size
+        if record_size > self.capacity // 2:
+            raise ValueError(f"record of {size} bytes too big for a ring of {self.capacity}")
+
+        header = self.header
+        write = header[RING_WRITE]
+        position = write % self.capacity
+        tail = self.capacity - position
+        # records don't go over the end of the ring, the tail is skipped
+        wrap = tail < record_size
+        needed = record_size + tail if wrap else record_size
+
+        while self.capacity - (write - header[RING_READ]) < needed:
+            if not block or (stop and stop()):
+                header[RING_DROPPED] += 1
+                return False
+            sleep(IDLE_SLEEP)
+
+        data = self.data
+        if wrap:
+            if tail >= RECORD_HEADER.size:
+                RECORD_HEADER.pack_into(data, position, RECORD_WRAP)
+            write += tail
+            position = 0
+
+        RECORD_HEADER.pack_into(data, position, size)
+        position += RECORD_HEADER.size
+        for part in parts:
+            data[position:position + len(part)] = part
+            position += len(part)
+
+        # publish after the data is written
+        header[RING_WRITE] = write + record_size
+        header[RING_WRITTEN] += 1
+        return True
+
+    def peek(self):
+        '''
+        returns a view of the next record, None if the ring is empty
+        the view is only valid until advance
+        '''
+        header = self.header
+        read = header[RING_READ]
+        if read == header[RING_WRITE]:
+            return None
+
+        position = read % self.capacity
+        if self.capacity - position < RECORD_HEADER.size or RECORD_HEADER.unpack_from(self.data, position)[0] == RECORD_WRAP:
+            # skip the tail
+            read += self.capacity - position
+            header[RING_READ] = read
+            position = 0
+
+        size = RECORD_HEADER.unpack_from(self.data, position)[0]
+        self.next_read = read + RECORD_HEADER.size + size
+        return self.data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + size]
+
+    def advance(self):
+        '''
+        releases the record returned by peek
+        '''
+        self.header[RING_READ] = self.next_read
+        self.header[RING_READ_RECORDS] += 1
+
+    def close_writer(self):
+        self.header[RING_CLOSED] = 1
+
+    @property
+    def closed(self):
+        return self.header[RING_CLOSED] == 1
+
+    def stats(self):
+        header = self.header
+        return {
+            "queue_depth": header[RING_WRITTEN] - header[RING_READ_RECORDS],
+            "queue_bytes": header[RING_WRITE] - header[RING_READ],
+            "written": header[RING_WRITTEN],
+            "dropped": header[RING_DROPPED],
+        }
+
+    def close(self):
+        if self.memory is None:
+            return
+        self.header.release()
+        self.data.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+
+class SharedCounters:
+    '''
+    Named u64 counters in shared memory, each one incremented by a single process
+    '''
+
+    def __init__(self, names: List[str]):
+        self.names = names
+        self.indexes = {name: index for index, name in enumerate(names)}
+        self.memory = SharedMemory(create=True, size=8 * len(names))
+        self.values = self.memory.buf.cast("Q")
+        for index in range(len(names)):
+            self.values[index] = 0
+
+    def add(self, name, value=1):
+        self.values[self.indexes[name]] += value
+
+    def set(self, name, value):
+        self.values[self.indexes[name]] = value
+
+    def __getitem__(self, name):
+        return self.values[self.indexes[name]]
+
+    def close(self):
+        if self.memory is None:
+            return
+        self.values.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+
+PEER = Struct("!4sH4sH")
+
+
+def peer_key(five_tuple: FiveTuple) -> bytes:
+    return PEER.pack(socket.inet_aton(five_tuple.src), five_tuple.sport, socket.inet_aton(five_tuple.dst), five_tuple.dport)
+
+
+def peer_tuple(key: bytes) -> FiveTuple:
+    '''
+    inverse of peer_key
+    '''
+    src, sport, dst, dport = PEER.unpack(key)
+    return FiveTuple(socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport)
+
+
+def connection_shard(key: bytes, shards: int) -> int:
+    '''
+    the same for both directions of a connection
+    '''
+    return crc32(min(key[:6], key[6:]) + max(key[:6], key[6:])) % shards
+
+
+# the counters of loss.local_counters published by every process, as "<process>:<group>:<counter>"
+LOSS_COUNTERS = {
+    "reliable":     ("received", "duplicates", "gaps"),
+    "fragments":    ("completed", "evicted", "evicted_bytes"),
+    "capture":      ("captured", "kernel_received", "kernel_dropped"),
+}
+# datagrams between two publications
+LOSS_PUBLISH_INTERVAL = 1024
+
+
+def loss_counter_names(process: str) -> List[str]:
+    return [f"{process}:{group}:{counter}" for group, names in LOSS_COUNTERS.items() for counter in names]
+
+
+def publish_loss(counters: SharedCounters, process: str):
+    '''
+    the loss.py counters of this process, for the loss source of the dispatch process(see MultiProcessPipeline.loss_counters)
+    '''
+    for group, values in loss.local_counters().items():
+        for counter in LOSS_COUNTERS.get(group, ()):
+            counters.set(f"{process}:{group}:{counter}", values.get(counter, 0))
+
+
+def capture_process(source, rings: List[RingBuffer], counters: SharedCounters, lossless: bool):
+    captured = 0
+
+    def prn(payload, five_tuple):
+        nonlocal captured
+        key = peer_key(five_tuple)
+        counters.add("captured")
+        rings[connection_shard(key, len(rings))].put(key, payload, block=lossless)
+        captured += 1
+        if captured % LOSS_PUBLISH_INTERVAL == 0:
+            # the kernel drops of the packet sockets
+            publish_loss(counters, "capture")
+
+    try:
+        source(prn)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publish_loss(counters, "capture")
+        for ring in rings:
+            ring.close_writer()
+
+
+def decode_process(index: int, input_ring: RingBuffer, output_ring: RingBuffer, counters: SharedCounters):
+    datagrams = f"decode_{index}_datagrams"
+    messages = f"decode_{index}_messages"
+    errors = f"decode_{index}_errors"
+    decoded = 0
+
+    try:
+        while True:
+            record = input_ring.peek()
+            if record is None:
+                if input_ring.closed and input_ring.peek() is None:
+                    break
+                sleep(IDLE_SLEEP)
+                continue
+
+            # the peer key(see peer_key) is used as is by the reassembler
+            peer = bytes(record[:PEER.size])
+            try:
+                for message_type, message in pipeline.decode_photon_payload(record[PEER.size:], peer):
+                    output_ring.put(bytes((message_type,)), peer, pickle.dumps(message, pickle.HIGHEST_PROTOCOL), block=True)
+                    counters.add(messages)
+            except Exception as e:
+                print(f"decode worker {index}: {e!r}")
+                counters.add(errors)
+
+            del record
+            input_ring.advance()
+            counters.add(datagrams)
+            decoded += 1
+            if decoded % LOSS_PUBLISH_INTERVAL == 0:
+                publish_loss(counters, f"decode_{index}")
+
+        # the end of the capture, the commands held for reordering(see pipeline.flush_reliable_window)
+        for peer, message_type, message in pipeline.decode_reliable_window_flush():
+            output_ring.put(bytes((message_type,)), peer, pickle.dumps(message, pickle.HIGHEST_PROTOCOL), block=True)
+            counters.add(messages)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publish_loss(counters, f"decode_{index}")
+        output_ring.close_writer()
+
+
+class MultiProcessPipeline:
+    '''
+    source:     called in the capture process with the prn(payload, five_tuple) callback, eg:
+                    partial(capture.sniff_raw, iface="eth0")
+                    partial(pcap_reader.replay, "captures/capture.pcapng")
+    workers:    number of decode processes
+    lossless:   wait for room in the rings instead of dropping, for replaying captures
+    stats_interval: seconds between printing stats() while running, 0 to disable
+    '''
+
+    def __init__(self, source: Callable[[Callable], None], workers: int = 2, ring_capacity: int = 8 * 1024 * 1024,
+                 lossless: bool = False, batch_size: int = 64, stats_interval: float = 0):
+        self.source = source
+        self.workers = workers
+        self.ring_capacity = ring_capacity
+        self.lossless = lossless
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+
+        self.input_rings = [RingBuffer(ring_capacity) for _ in range(workers)]
+        self.output_rings = [RingBuffer(ring_capacity) for _ in range(workers)]
+        self.counters = SharedCounters(["captured", "dispatched"] + [
+            f"decode_{index}_{name}" for index in range(workers) for name in ("datagrams", "messages", "errors")
+        ] + loss_counter_names("capture") + [name for index in range(workers) for name in loss_counter_names(f"decode_{index}")])
+        self.processes = []
+
+    def start(self):
+        context = multiprocessing.get_context("fork")
+        self.processes.append(context.Process(
+            target=capture_process, args=(self.source, self.input_rings, self.counters, self.lossless),
+            name="capture", daemon=True
+        ))
+        for index in range(self.workers):
+            self.processes.append(context.Process(
+                target=decode_process, args=(index, self.input_rings[index], self.output_rings[index], self.counters),
+                name=f"decode_{index}", daemon=True
+            ))
+        for process in self.processes:
+            process.start()
+
+    def dispatch_batch(self) -> int:
+        '''
+        dispatches up to batch_size messages from every output ring, returns how many were dispatched
+        '''
+        dispatched = 0
+        dispatch_tables = pipeline.dispatch_tables
+        last_peer = None
+        for ring in self.output_rings:
+            for _ in range(self.batch_size):
+                record = ring.peek()
+                if record is None:
+                    break
+                message_type = record[0]
+                peer = bytes(record[1:1 + PEER.size])
+                message = pickle.loads(record[1 + PEER.size:])
+                del record
+                ring.advance()
+
+                if peer != last_peer:
+                    last_peer = peer
+                    sessions.activate(peer_tuple(peer))
+                dispatch_tables[message_type](message)
+                dispatched += 1
+
+        self.counters.add("dispatched", dispatched)
+        return dispatched
+
+    def run(self):
+        '''
+        starts the capture and decode processes and dispatches in this one until the capture source ends
+        '''
+        loss.sources["multiprocess"] = self.loss_counters
+        self.start()
+        last_stats = monotonic()
+        try:
+            while True:
+                if not self.dispatch_batch():
+                    if all(ring.closed for ring in self.output_rings) and not self.dispatch_batch():
+                        break
+                    sleep(IDLE_SLEEP)
+
+                if self.stats_interval and monotonic() - last_stats >= self.stats_interval:
+                    last_stats = monotonic()
+                    print(self.format_stats())
+        finally:
+            # a pipeline runs once, the rings and counters are unlinked with it
+            self.close()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes = []
+
+    def loss_counters(self) -> loss.Groups:
+        '''
+        loss.py source, the counters published by the capture and decode processes summed, and the ring drops
+        '''
+        groups = {"multiprocess": {
+            "captured": self.counters["captured"],
+            "ring_dropped": sum(ring.header[RING_DROPPED] for ring in self.input_rings),
+        }}
+        processes = ["capture"] + [f"decode_{index}" for index in range(self.workers)]
+        for group, names in LOSS_COUNTERS.items():
+            values = {counter: sum(self.counters[f"{process}:{group}:{counter}"] for process in processes) for counter in names}
+            if any(values.values()):
+                groups[group] = values
+        return groups
+
+    def close(self):
+        if loss.sources.get("multiprocess") == self.loss_counters:
+            del loss.sources["multiprocess"]
+        self.stop()
+        for ring in self.input_rings + self.output_rings:
+            ring.close()
+        self.counters.close()
+
+    def stats(self):
+        counters = self.counters
+        return {
+            "capture": {
+                "captured": counters["captured"],
+                "dropped": sum(ring.header[RING_DROPPED] for ring in self.input_rings),
+            },
+            "decode": [
+                {
+                    **ring.stats(),
+                    "datagrams": counters[f"decode_{index}_datagrams"],
+                    "messages": counters[f"decode_{index}_messages"],
+                    "errors": counters[f"decode_{index}_errors"],
+                } for index, ring in enumerate(self.input_rings)
+            ],
+            "dispatch": {
+                "queue_depth": sum(ring.stats()["queue_depth"] for ring in self.output_rings),
+                "dispatched": counters["dispatched"],
+            },
+        }
+
+    def format_stats(self):
+        stats = self.stats()
+        decode = " ".join(f"[{worker['queue_depth']} queued {worker['dropped']} dropped]" for worker in stats["decode"])
+        return (
+            f"captured: {stats['capture']['captured']} dropped: {stats['capture']['dropped']} | "
+            f"decode: {decode} | dispatch: {stats['dispatch']['queue_depth']} queued {stats['dispatch']['dispatched']} dispatched"
+        )
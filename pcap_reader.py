@@ -0,0 +1,280 @@
+import mmap
+import socket
+from struct import Struct
+from typing import Callable, Iterator, List, Tuple
+
+from photon_decoder import albion_ports
+from capture import FiveTuple
+
+'''
+Streaming reader of .pcap and .pcapng files for replaying captures at max speed
+
+sniff(offline=...) fully dissects every frame with Scapy, even though only the UDP payloads
+on the albion ports are of interest. Here the file is memory-mapped and walked block by block,
+frames are filtered on the IPv4/UDP header fields(fixed offsets read with struct)
+and the payloads are handed out as memoryviews into the mapping, nothing is copied.
+Datagrams cut short(by the snaplen, or a capture stopped while writing it's last frame) are skipped.
+
+Supported:
+    pcap:   micro and nanosecond resolution, both byte orders
+    pcapng: Enhanced and Simple Packet Blocks, multiple sections and interfaces(if_tsresol)
+    link types: Ethernet(with 802.1Q tags), Linux cooked(SLL and SLL2), raw IPv4
+
+References:
+    https://www.ietf.org/archive/id/draft-ietf-opsawg-pcap-03.html
+    https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-01.html
+'''
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_OPTION_TSRESOL = 9
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+IPPROTO_UDP = 17
+
+U16 = Struct(">H")
+IPV4_HEADER = Struct(">B5xHxB2x4s4s")
+UDP_HEADER = Struct(">HHH")
+
+# (timestamp, five_tuple, payload)
+Datagram = Tuple[float, FiveTuple, memoryview]
+
+
+def ip_offset(frame, link_type):
+    '''
+    returns the offset of the IPv4 header in the frame, or None for anything else
+    '''
+    if link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ether_type = U16.unpack_from(frame, offset)[0]
+        while ether_type == ETH_P_8021Q:
+            offset += 4
+            if len(frame) < offset + 2:
+                return None
+            ether_type = U16.unpack_from(frame, offset)[0]
+        return offset + 2 if ether_type == ETH_P_IP else None
+
+    if link_type == LINKTYPE_LINUX_SLL:
+        return 16 if U16.unpack_from(frame, 14)[0] == ETH_P_IP else None
+
+    if link_type == LINKTYPE_LINUX_SLL2:
+        return 20 if U16.unpack_from(frame, 0)[0] == ETH_P_IP else None
+
+    if link_type in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0 if frame[0] >> 4 == 4 else None
+
+    return None
+
+
+def udp_datagram(frame, link_type, ports) -> Tuple[FiveTuple, memoryview]:
+    '''
+    returns (five_tuple, payload) if frame carries a UDP datagram on one of the ports, None otherwise
+    '''
+    if len(frame) < 28:
+        # not even an IPv4+UDP header
+        return None
+
+    offset = ip_offset(frame, link_type)
+    if offset is None or len(frame) < offset + IPV4_HEADER.size:
+        # or cut short(snaplen)
+        return None
+
+    version_ihl, fragment, protocol, src, dst = IPV4_HEADER.unpack_from(frame, offset)
+    # only the first fragment carries the UDP header
+    if protocol != IPPROTO_UDP or fragment & 0x1FFF:
+        return None
+
+    offset += (version_ihl & 0x0F) * 4
+    if len(frame) < offset + 8:
+        # the options or the UDP header cut short
+        return None
+    sport, dport, udp_length = UDP_HEADER.unpack_from(frame, offset)
+    if sport not in ports and dport not in ports:
+        return None
+    if len(frame) < offset + udp_length:
+        # the payload cut short, it would only fail to decode
+        return None
+
+    return (
+        FiveTuple(socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport, protocol),
+        # the UDP length, since short frames are padded
+        frame[offset + 8:offset + udp_length]
+    )
+
+
+class PcapReader:
+    '''
+    Iterates over the UDP datagrams on the given ports as (timestamp, five_tuple, payload)
+
+    The payloads are views into the mapped file, they are only valid until the reader is closed
+    frame_offset, frame_length and link_type locate the frame of the last datagram in the file, see capture_index.py
+    '''
+
+    def __init__(self, capture_file: str, ports: List[int] = albion_ports):
+        self.capture_file = capture_file
+        self.ports = frozenset(ports)
+
+        self.file = open(capture_file, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.map)
+
+        # frames seen, regardless of the filter
+        self.frames = 0
+
+        self.frame_offset = 0
+        self.frame_length = 0
+        self.link_type = 0
+
+    def close(self):
+        self.data.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # payloads are still referenced, the mapping goes away with the last of them
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self) -> Iterator[Datagram]:
+        magic = self.data[:4].tobytes()
+        if int.from_bytes(magic, "little") == PCAPNG_SECTION_HEADER:
+            return self.iter_pcapng()
+        return self.iter_pcap()
+
+    def iter_pcap(self) -> Iterator[Datagram]:
+        data = self.data
+        for byte_order in "<>":
+            magic = Struct(byte_order + "I").unpack_from(data, 0)[0]
+            if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                break
+        else:
+            raise ValueError(f"{self.capture_file} is not a pcap or pcapng file")
+
+        resolution = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        link_type = Struct(byte_order + "I").unpack_from(data, 20)[0] & 0x0FFFFFFF
+        record_header = Struct(byte_order + "IIII")
+        ports = self.ports
+
+        offset = 24
+        end = len(data)
+        while offset + record_header.size <= end:
+            ts_sec, ts_frac, captured_length, _ = record_header.unpack_from(data, offset)
+            offset += record_header.size
+            if offset + captured_length > end:
+                # the capture was cut short while writing this frame
+                break
+            frame = data[offset:offset + captured_length]
+            offset += captured_length
+            self.frames += 1
+
+            datagram = udp_datagram(frame, link_type, ports)
+            if datagram:
+                self.frame_offset, self.frame_length, self.link_type = offset - captured_length, captured_length, link_type
+                yield ts_sec + ts_frac * resolution, datagram[0], datagram[1]
+
+    def iter_pcapng(self) -> Iterator[Datagram]:
+        data = self.data
+        ports = self.ports
+        end = len(data)
+
+        offset = 0
+        # per section
+        block_header = None
+        # per interface: (link_type, resolution)
+        interfaces = []
+
+        while offset + 12 <= end:
+            if int.from_bytes(data[offset:offset + 4], "little") == PCAPNG_SECTION_HEADER:
+                # the byte order is only known after reading the byte order magic
+                byte_order = "<" if Struct("<I").unpack_from(data, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                block_header = Struct(byte_order + "II")
+                enhanced_packet = Struct(byte_order + "IIIII")
+                simple_packet = Struct(byte_order + "I")
+                interface_description = Struct(byte_order + "HH")
+                option_header = Struct(byte_order + "HH")
+                interfaces = []
+
+            block_type, block_length = block_header.unpack_from(data, offset)
+            if block_length < 12:
+                raise ValueError(f"{self.capture_file}: corrupt block at {offset}")
+            if offset + block_length > end:
+                # the capture was cut short while writing this block
+                break
+            body = offset + 8
+
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface_id, ts_high, ts_low, captured_length, _ = enhanced_packet.unpack_from(data, body)
+                frame = data[body + 20:body + 20 + captured_length]
+                link_type, resolution = interfaces[interface_id]
+                self.frames += 1
+
+                datagram = udp_datagram(frame, link_type, ports)
+                if datagram:
+                    self.frame_offset, self.frame_length, self.link_type = body + 20, captured_length, link_type
+                    yield ((ts_high << 32) | ts_low) * resolution, datagram[0], datagram[1]
+
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                original_length = simple_packet.unpack_from(data, body)[0]
+                frame = data[body + 4:body + 4 + min(original_length, block_length - 16)]
+                link_type, _ = interfaces[0]
+                self.frames += 1
+
+                datagram = udp_datagram(frame, link_type, ports)
+                if datagram:
+                    self.frame_offset, self.frame_length, self.link_type = body + 4, len(frame), link_type
+                    # simple packets have no timestamp
+                    yield 0.0, datagram[0], datagram[1]
+
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                link_type = interface_description.unpack_from(data, body)[0]
+                resolution = 1e-6
+
+                # options, looking for if_tsresol
+                option_offset = body + 8
+                block_end = offset + block_length - 4
+                while option_offset + 4 <= block_end:
+                    option_code, option_length = option_header.unpack_from(data, option_offset)
+                    if option_code == 0:
+                        break
+                    if option_code == PCAPNG_OPTION_TSRESOL:
+                        tsresol = data[option_offset + 4]
+                        resolution = 2.0 ** -(tsresol & 0x7F) if tsresol & 0x80 else 10.0 ** -tsresol
+                    # options are padded to 32 bits
+                    option_offset += 4 + (option_length + 3) // 4 * 4
+
+                interfaces.append((link_type, resolution))
+
+            offset += block_length
+
+
+def replay(capture_file: str, prn: Callable[[memoryview, FiveTuple], None], ports: List[int] = albion_ports) -> int:
+    '''
+    Feeds every UDP datagram on the ports to prn(payload, five_tuple), as fast as possible,
+    same callback as capture.RawSocketCapture
+
+    returns the number of datagrams replayed
+    '''
+    replayed = 0
+    with PcapReader(capture_file, ports) as reader:
+        for _, five_tuple, payload in reader:
+            prn(payload, five_tuple)
+            replayed += 1
+    return replayed
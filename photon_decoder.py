@@ -0,0 +1,164 @@
+from struct import Struct
+from dataclasses import dataclass
+from typing import List, Tuple, Union
+
+'''
+Lightweight decoder for the PUN(Photon Unity Networking) layers defined in layers.py
+
+The Scapy layers build a full object tree for every datagram, which is great for show() and debugging
+but too slow for the hot path. This decoder only unpacks the fixed size headers with struct
+and hands out memoryview slices of the message payloads, ready for the offset based protocol16 parsers.
+
+Datagram layout:
+#########################################################################
+#  PhotonHeader  #  Command  #  Command  #  ...                         #
+#----------------#-----------#-----------#------------------------------#
+#    12 bytes    #  msg_len  #  msg_len  #  command_count commands      #
+#########################################################################
+
+Command layout:
+###############################################################################
+#  command_type  #  channel_id  #  flags  #  reserved  #  msg_len  #  body    #
+#----------------#--------------#---------#------------#-----------#----------#
+#     1 byte     #    1 byte    #  1 byte #   1 byte   #  4 bytes  #  msg_len-8 bytes
+###############################################################################
+
+Reliable(6) body:   sequence_number(4), MessageWrapper
+Unreliable(7) body: sequence_number(4), unreliable_info(4), MessageWrapper
+Fragment(8) body:   sequence_number(4), start_sequence_number(4), fragment_count(4),
+                    fragment_number(4), total_length(4), fragment_offset(4), fragment
+MessageWrapper:     skipped(1), message_type(1), message payload(protocol16)
+'''
+
+# mirror the ids from layers.py, without importing Scapy
+RELIABLE_COMMAND = 6
+UNRELIABLE_COMMAND = 7
+FRAGMENT_COMMAND = 8
+KNOWN_UNKNOWN_COMMANDS = (1, 5)
+
+REQUEST_MESSAGE = 2
+RESPONSE_MESSAGE = 3
+EVENT_MESSAGE = 4
+
+# oprts used by the master, game(per map) and chat(maybe known as Nameserver in PUN) servers
+albion_ports = [
+    4535,
+    5055,
+    5056
+]
+
+
+PHOTON_HEADER = Struct(">HBBII")
+COMMAND_HEADER = Struct(">BBBBI")
+FRAGMENT_HEADER = Struct(">IIIIII")
+U32 = Struct(">I")
+
+
+@dataclass(slots=True)
+class PhotonHeaderRecord:
+    peer_id: int
+    crc_enabled: int
+    command_count: int
+    timestamp: int
+    challenge: int
+
+
+@dataclass(slots=True)
+class CommandRecord:
+    '''
+    payload:
+        Reliable/Unreliable: the message payload(protocol16), without the MessageWrapper bytes
+        Fragment: the fragment
+        other: the command body
+    '''
+    command_type: int
+    channel_id: int
+    flags: int
+    sequence_number: int = 0
+    message_type: int = 0
+    payload: Union[bytes, memoryview] = b""
+
+    # only for FragmentCommands
+    start_sequence_number: int = 0
+    fragment_count: int = 0
+    fragment_number: int = 0
+    total_length: int = 0
+    fragment_offset: int = 0
+
+
+class MalformedDatagram(Exception):
+    pass
+
+
+def decode_header(data) -> PhotonHeaderRecord:
+    return PhotonHeaderRecord(*PHOTON_HEADER.unpack_from(data, 0))
+
+
+def decode_datagram(data) -> Tuple[PhotonHeaderRecord, List[CommandRecord]]:
+    '''
+    Decodes a UDP payload into it's header and commands
+
+    Commands after a malformed one are dropped, like in layers.py
+    raises MalformedDatagram if the header itself is truncated
+    '''
+    if len(data) < PHOTON_HEADER.size:
+        raise MalformedDatagram(f"datagram too short for a PhotonHeader: {len(data)}")
+
+    data = memoryview(data)
+    header = decode_header(data)
+
+    commands = []
+    offset = PHOTON_HEADER.size
+    for _ in range(header.command_count):
+        if offset + COMMAND_HEADER.size > len(data):
+            break
+        command_type, channel_id, flags, _, msg_len = COMMAND_HEADER.unpack_from(data, offset)
+        end = offset + msg_len
+        if msg_len < COMMAND_HEADER.size or end > len(data):
+            break
+
+        commands.append(decode_command(data, offset + COMMAND_HEADER.size, end, command_type, channel_id, flags))
+        offset = end
+
+    return header, commands
+
+
+def decode_command(data, offset, end, command_type, channel_id, flags) -> CommandRecord:
+    '''
+    Decodes the body(data[offset:end]) of a command
+    '''
+    command = CommandRecord(command_type, channel_id, flags)
+
+    if command_type == RELIABLE_COMMAND and end - offset >= 6:
+        command.sequence_number = U32.unpack_from(data, offset)[0]
+        command.message_type = data[offset + 5]
+        command.payload = data[offset + 6:end]
+
+    elif command_type == UNRELIABLE_COMMAND and end - offset >= 10:
+        command.sequence_number = U32.unpack_from(data, offset)[0]
+        command.message_type = data[offset + 9]
+        command.payload = data[offset + 10:end]
+
+    elif command_type == FRAGMENT_COMMAND and end - offset >= FRAGMENT_HEADER.size:
+        (
+            command.sequence_number,
+            command.start_sequence_number,
+            command.fragment_count,
+            command.fragment_number,
+            command.total_length,
+            command.fragment_offset,
+        ) = FRAGMENT_HEADER.unpack_from(data, offset)
+        command.payload = data[offset + FRAGMENT_HEADER.size:end]
+
+    else:
+        command.payload = data[offset:end]
+
+    return command
+
+
+def split_message(data):
+    '''
+    Splits a MessageWrapper(eg: a reassembled fragmented command) into (message_type, payload)
+    '''
+    data = memoryview(data)
+    return data[1], data[2:]
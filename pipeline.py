@@ -0,0 +1,224 @@
+from streams import RequestBundle, ReponseBundle, EventBundle, DispatchTable
+import protocol16_parser as protocol16
+import photon_decoder as photon
+from reassembly import FragmentReassembler
+from sessions import sessions
+
+'''
+The hot path from a UDP payload to the message streams, without Scapy
+
+main.py feeds it from the capture backends(capture.py, pcap_reader.py or scapy.sniff),
+it is kept out of main.py so it can be imported on it's own, eg: by benchmark.py
+'''
+
+show_unknown_command_types = False
+
+# only decode messages that would reach a hook or an unknown stream, see is_subscribed
+lazy_decoding = True
+
+# a message_log.MessageLog, every message is recorded before the lazy decoding check
+recorder = None
+
+# a reliable_window.ReliableWindow, drops the retransmitted reliable commands(and reorders them) before anything else
+reliable_window = None
+
+bundles = {
+    photon.REQUEST_MESSAGE:  RequestBundle,
+    photon.RESPONSE_MESSAGE: ReponseBundle,
+    photon.EVENT_MESSAGE:    EventBundle,
+}
+
+# the bundles flattened, used for routing and is_subscribed
+dispatch_tables = {
+    photon.REQUEST_MESSAGE:  DispatchTable(RequestBundle, "request"),
+    photon.RESPONSE_MESSAGE: DispatchTable(ReponseBundle, "response"),
+    photon.EVENT_MESSAGE:    DispatchTable(EventBundle,   "event"),
+}
+
+
+def decode_payload(message_type, payload, keys=None):
+    '''
+    keys: only decode these parameters, None for all of them, see projection
+    '''
+    if message_type == photon.EVENT_MESSAGE:
+        return protocol16.Parse_EventData_at(payload, 0, keys)
+
+    elif message_type == photon.REQUEST_MESSAGE:
+        return protocol16.Parse_OperationRequest_at(payload, 0, keys)
+
+    elif message_type == photon.RESPONSE_MESSAGE:
+        return protocol16.Parse_OperationResponse_at(payload, 0, keys)
+
+    else:
+        print("unknown message type:  ", message_type)
+
+
+def parameters_offset(message_type, payload):
+    '''
+    offset of the parameters in the payload of a message
+    '''
+    if message_type == photon.RESPONSE_MESSAGE:
+        # code, return_code, debug_msg
+        return protocol16.Parse_Object_at(payload, 3)[1]
+    # code
+    return 1
+
+
+def is_subscribed(bundle, message_type, payload):
+    '''
+    if the message would reach any hook or unknown stream of the bundle(or it's DispatchTable),
+    decided on the message code and the parameters the separators look at, without decoding the rest
+    '''
+    def peek_parameter(key):
+        return protocol16.Peek_Parameter_at(payload, parameters_offset(message_type, payload), key)
+
+    return bundle.is_subscribed(payload[0], peek_parameter)
+
+
+# payloads shorter than this are decoded in full, skipping their parameters saves less than peeking their identifiers costs
+projection_min_size = 1024
+
+def projection(dispatch_table, message_type, payload):
+    '''
+    the parameters of the message it's stream needs, None to decode all of them(see MessageStream(projected=True))
+    only looked up for big messages with a projected stream under their message code
+    '''
+    if len(payload) < projection_min_size or not dispatch_table.has_projections(payload[0]):
+        return None
+
+    def peek_parameter(key):
+        return protocol16.Peek_Parameter_at(payload, parameters_offset(message_type, payload), key)
+
+    return dispatch_table.projection(payload[0], peek_parameter)
+
+
+reassembler = FragmentReassembler()
+
+
+def decode_fragment_record(command: photon.CommandRecord, peer=None):
+    '''
+    returns the decoded message once all of the fragments were received, None otherwise
+    '''
+    fragmented_command = reassembler.add_record(peer, command)
+
+    if fragmented_command is None:
+        return None
+
+    message_type, payload = photon.split_message(fragmented_command)
+    if recorder is not None:
+        recorder.record(message_type, payload, peer)
+    dispatch_table = dispatch_tables[photon.RESPONSE_MESSAGE]
+    if lazy_decoding and not is_subscribed(dispatch_table, message_type, payload):
+        return None
+
+    fragmented_command = decode_payload(message_type, payload, projection(dispatch_table, message_type, payload))
+
+    if not fragmented_command:
+        # failed to decode
+        return None
+
+    return fragmented_command[0]
+
+
+def decode_photon_payload(payload, peer=None):
+    '''
+    Yields the messages in the UDP payload as (message_type, message), the message_type selecting the dispatch table
+    messages nobody is subscribed to are skipped(see lazy_decoding)
+
+    peer: identifies the connection for reassembling fragments, eg: the capture.FiveTuple
+    '''
+    try:
+        _, command_records = photon.decode_datagram(payload)
+    except photon.MalformedDatagram as e:
+        print("Error parsing datagram:", e)
+        return
+
+    if reliable_window is not None:
+        command_records = reliable_window.filter_records(peer, command_records)
+
+    yield from decode_commands(command_records, peer)
+
+
+def decode_commands(command_records, peer=None):
+    '''
+    decode_photon_payload, for already decoded commands
+    '''
+    for command in command_records:
+        if command.command_type == photon.FRAGMENT_COMMAND:
+            fragmented_command = decode_fragment_record(command, peer)
+            if fragmented_command is not None:
+                # responses can have excesive sizes, so just asume this is a ResponseMessage
+                yield photon.RESPONSE_MESSAGE, fragmented_command
+            continue
+
+        if command.command_type not in (photon.RELIABLE_COMMAND, photon.UNRELIABLE_COMMAND):
+            if command.command_type not in photon.KNOWN_UNKNOWN_COMMANDS and show_unknown_command_types:
+                print("unknown_command: ", command.command_type, "|", len(command.payload) + 8)
+            continue
+
+        dispatch_table = dispatch_tables.get(command.message_type)
+        if dispatch_table is None:
+            continue
+
+        if recorder is not None:
+            recorder.record(command.message_type, command.payload, peer)
+
+        if lazy_decoding and not is_subscribed(dispatch_table, command.message_type, command.payload):
+            continue
+
+        keys = projection(dispatch_table, command.message_type, command.payload)
+        yield command.message_type, decode_payload(command.message_type, command.payload, keys)[0]
+
+
+def procces_photon_payload(payload, peer=None):
+    '''
+    Hot path equivalent of main.procces_packet using photon_decoder on the UDP payload
+    '''
+    if peer is not None:
+        sessions.activate(peer)
+    for message_type, message in decode_photon_payload(payload, peer):
+        dispatch_tables[message_type](message)
+
+
+def decode_reliable_window_flush():
+    '''
+    yields (peer, message_type, message) of the commands held for reordering by reliable_window
+    '''
+    if reliable_window is None:
+        return
+    for peer, command_records in reliable_window.flush():
+        for message_type, message in decode_commands(command_records, peer):
+            yield peer, message_type, message
+
+
+def flush_reliable_window():
+    '''
+    dispatches the commands held for reordering by reliable_window, eg: at the end of a capture
+    '''
+    for peer, message_type, message in decode_reliable_window_flush():
+        if peer is not None:
+            sessions.activate(peer)
+        dispatch_tables[message_type](message)
+
+
+def procces_message(message_type, payload, peer=None):
+    '''
+    decodes and dispatches a single message, eg: replayed by message_log.py
+    '''
+    if peer is not None:
+        sessions.activate(peer)
+    dispatch_table = dispatch_tables.get(message_type)
+    if dispatch_table is None:
+        return
+    if lazy_decoding and not is_subscribed(dispatch_table, message_type, payload):
+        return
+    message = decode_payload(message_type, payload, projection(dispatch_table, message_type, payload))
+    if message:
+        dispatch_table(message[0])
+
+
+def procces_udp_payload(payload, five_tuple):
+    '''
+    callback for capture.RawSocketCapture and pcap_reader.replay, the albion ports are already filtered
+    '''
+    procces_photon_payload(payload, five_tuple)
@@ -0,0 +1,275 @@
+from dataclasses import dataclass
+from struct import Struct
+from typing import Any
+
+from protocol16_parser import NO_OBJECT_CODES, bulk_array_formats
+
+'''
+Encoder for Photon's Protocol16, the counterpart of protocol16_parser
+
+Every type registered in protocol16_parser.datatype_parsers has a serializer here, so that:
+    Parse_Object(Serialize_Object(value))[0] == value
+for anything the parser can produce(the parser decodes strings to bytes, these are re-encoded as ByteArrays).
+
+Python types don't map one to one to the C# ones, so Serialize_Object infers:
+    None            => "*" Null
+    bool            => "o" Boolean
+    int             => "i" Integer, "l" Long if it doesn't fit,
+                       negative ones in two's complement(the parser reads them back unsigned, like the game's ids)
+    float           => "d" Double
+    str             => "s" String(utf-8)
+    bytes           => "x" ByteArray
+    list of str     => "a" StringArray
+    list of bool    => "n" BooleanArray
+    other lists     => "z" ObjectArray
+    dict            => "D" Dictionary, every key and value with it's own type
+    numpy arrays    => "y" Array
+use Typed(type_code, value) to pick the type, eg: Typed("k", 253) or Typed("y", [1.0, 2.0], element_type="f")
+'''
+
+datatype_serializers = {}
+
+
+def add_datatype_serializer(key):
+    '''
+    Decorator generator for registering a new serializer
+    '''
+
+    # decode ascii
+    if type(key) is str:
+        key = ord(key)
+
+    def add_decorator(func):
+        datatype_serializers[key] = func
+        return func
+
+    return add_decorator
+
+
+@dataclass
+class Typed:
+    '''
+    A value with an explicit type code
+    element_type: for "y" arrays, the type code of the elements
+    '''
+    type_code: Any
+    value: Any
+    element_type: Any = None
+
+    def __post_init__(self):
+        if type(self.type_code) is str:
+            self.type_code = ord(self.type_code)
+        if type(self.element_type) is str:
+            self.element_type = ord(self.element_type)
+
+
+U8 = Struct(">B")
+U16 = Struct(">H")
+U32 = Struct(">I")
+U64 = Struct(">Q")
+F32 = Struct(">f")
+F64 = Struct(">d")
+
+numpy_type_codes = {
+    "u1": ord("b"), "i1": ord("b"),
+    "u2": ord("k"), "i2": ord("k"),
+    "u4": ord("i"), "i4": ord("i"),
+    "u8": ord("l"), "i8": ord("l"),
+    "f4": ord("f"),
+    "f8": ord("d"),
+    "b1": ord("o"),
+}
+
+
+def infer_type_code(value):
+    if isinstance(value, Typed):
+        return value.type_code
+    if value is None:
+        return ord("*")
+    if isinstance(value, bool):
+        return ord("o")
+    if isinstance(value, int):
+        if -0x8000_0000 <= value <= 0xFFFF_FFFF:
+            return ord("i")
+        if -0x8000_0000_0000_0000 <= value <= 0xFFFF_FFFF_FFFF_FFFF:
+            return ord("l")
+        raise ValueError(f"{value} doesn't fit in a protocol16 Long")
+    if isinstance(value, float):
+        return ord("d")
+    if isinstance(value, str):
+        return ord("s")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return ord("x")
+    if isinstance(value, dict):
+        return ord("D")
+    if hasattr(value, "dtype"):
+        # numpy array, as decoded with protocol16_parser.use_numpy_arrays
+        return ord("y")
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(element, str) for element in value):
+            return ord("a")
+        if value and all(isinstance(element, bool) for element in value):
+            return ord("n")
+        return ord("z")
+
+    raise TypeError(f"Can't infer a protocol16 type for {type(value)}: {value!r}")
+
+
+def Serialize_Object(value, type_code=None):
+    '''
+    The type code followed by the serialized value
+    type_code: the type the value has to be serialized as, inferred if None
+    '''
+    if type_code is None or type_code in NO_OBJECT_CODES:
+        type_code = infer_type_code(value)
+    return U8.pack(type_code) + Serialize_Value(value, type_code)
+
+
+def Serialize_Value(value, type_code):
+    '''
+    The serialized value, without a type code
+    '''
+    if isinstance(value, Typed):
+        if value.type_code == ord("y"):
+            return Serialize_Array(value.value, value.element_type)
+        value = value.value
+    return datatype_serializers[type_code](value)
+
+
+@add_datatype_serializer(0)    # None
+@add_datatype_serializer("*")  # Null
+def Serialize_None(value):
+    return b""
+
+
+def two_complement(value, low, mask):
+    if value < low:
+        raise ValueError(f"{value} is too small for a {mask.bit_length()} bit integer")
+    return value & mask
+
+# integer type code => (lowest value, mask) of it's two's complement
+integer_ranges = {
+    ord("b"): (-0x80, 0xFF),
+    ord("k"): (-0x8000, 0xFFFF),
+    ord("i"): (-0x8000_0000, 0xFFFF_FFFF),
+    ord("l"): (-0x8000_0000_0000_0000, 0xFFFF_FFFF_FFFF_FFFF),
+}
+
+@add_datatype_serializer("b")
+def Serialize_Byte(value):
+    if value < 0:
+        value = two_complement(value, -0x80, 0xFF)
+    return U8.pack(value)
+
+@add_datatype_serializer("o")
+def Serialize_Boolean(value):
+    return b"\x01" if value else b"\x00"
+
+@add_datatype_serializer("k")
+def Serialize_Short(value):
+    if value < 0:
+        value = two_complement(value, -0x8000, 0xFFFF)
+    return U16.pack(value)
+
+@add_datatype_serializer("i")
+def Serialize_Integer(value):
+    if value < 0:
+        value = two_complement(value, -0x8000_0000, 0xFFFF_FFFF)
+    return U32.pack(value)
+
+@add_datatype_serializer("l")
+def Serialize_Long(value):
+    if value < 0:
+        value = two_complement(value, -0x8000_0000_0000_0000, 0xFFFF_FFFF_FFFF_FFFF)
+    return U64.pack(value)
+
+@add_datatype_serializer("s")
+def Serialize_String(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return U16.pack(len(value)) + bytes(value)
+
+@add_datatype_serializer("f")
+def Serialize_Float(value):
+    return F32.pack(value)
+
+@add_datatype_serializer("d")
+def Serialize_Double(value):
+    return F64.pack(value)
+
+
+@add_datatype_serializer("a")
+def Serialize_StringArray(value):
+    return U16.pack(len(value)) + b"".join(Serialize_String(element) for element in value)
+
+@add_datatype_serializer("y")
+def Serialize_Array(value, element_type=None):
+    '''
+    element_type: type code of the elements, inferred from the first element if None
+    '''
+    if element_type is None:
+        if hasattr(value, "dtype"):
+            element_type = numpy_type_codes[value.dtype.str[1:]]
+        elif len(value):
+            element_type = infer_type_code(value[0])
+        else:
+            element_type = ord("b")
+
+    header = U16.pack(len(value)) + U8.pack(element_type)
+
+    if element_type in bulk_array_formats:
+        struct_format, numpy_format, _ = bulk_array_formats[element_type]
+        if hasattr(value, "dtype"):
+            # the signed dtypes wrap around to the unsigned ones, in two's complement
+            return header + value.astype(numpy_format).tobytes()
+        elements = [element.item() if hasattr(element, "item") else element for element in value]
+        if element_type in integer_ranges:
+            low, mask = integer_ranges[element_type]
+            elements = [two_complement(element, low, mask) if element < 0 else element for element in elements]
+        return header + Struct(f">{len(value)}{struct_format}").pack(*elements)
+    if element_type == ord("o"):
+        return header + bytes(1 if element else 0 for element in value)
+
+    return header + b"".join(Serialize_Value(element, element_type) for element in value)
+
+@add_datatype_serializer("x")
+def Serialize_ByteArray(value):
+    return U32.pack(len(value)) + bytes(value)
+
+@add_datatype_serializer("n")
+def Serialize_BooleanArray(value):
+    return U16.pack(len(value)) + bytes(1 if element else 0 for element in value)
+
+@add_datatype_serializer("z")
+def Serialize_ObjectArray(value):
+    return U16.pack(len(value)) + b"".join(Serialize_Object(element) for element in value)
+
+@add_datatype_serializer("D")
+def Serialize_Dictionary(value):
+    # every key and value carries it's own type code
+    return b"**" + U16.pack(len(value)) + b"".join(
+        Serialize_Object(key) + Serialize_Object(val)
+            for key, val in value.items()
+    )
+
+def Serialize_Parameters(parameters):
+    return U16.pack(len(parameters)) + b"".join(
+        U8.pack(key) + Serialize_Object(val)
+            for key, val in parameters.items()
+    )
+
+@add_datatype_serializer("e")
+def Serialize_EventData(value):
+    code, parameters = value
+    return U8.pack(code) + Serialize_Parameters(parameters)
+
+
+@add_datatype_serializer("p")
+def Serialize_OperationResponse(value):
+    code, return_code, debug_msg, parameters = value
+    return U8.pack(code) + U16.pack(return_code) + Serialize_Object(debug_msg) + Serialize_Parameters(parameters)
+
+@add_datatype_serializer("q")
+def Serialize_OperationRequest(value):
+    code, parameters = value
+    return U8.pack(code) + Serialize_Parameters(parameters)
@@ -0,0 +1,200 @@
+from time import monotonic
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import photon_decoder as photon
+
+'''
+Reassembly of FragmentCommands
+
+Big commands(mostly responses) are split into FragmentCommands, each carrying:
+    start_sequence_number:  the sequence number of the first fragment, identifies the command
+    fragment_count, fragment_number
+    total_length, fragment_offset: where the fragment goes in the reassembled command
+
+A buffer of total_length is allocated on the first fragment of a command and every fragment is written
+directly at it's offset, so nothing is joined or copied again once the command is complete.
+Completed commands are handed out as a memoryview of the buffer.
+
+Sequence numbers are only unique per peer and channel, so commands are keyed by (peer, channel_id, start_sequence_number),
+peer being anything hashable identifying the connection, eg: the capture.FiveTuple of the datagram.
+
+Fragments retransmitted after their command was completed are recognized as duplicates for the last recent_commands commands.
+
+Lost fragments would keep the rest of the command around forever, so incomplete commands are evicted:
+    after timeout seconds without a new fragment
+    the oldest ones, when the buffered bytes go over max_buffered_bytes
+'''
+
+# (peer, channel_id, start_sequence_number)
+CommandKey = Tuple[Hashable, int, int]
+
+
+class PendingCommand:
+    __slots__ = ("buffer", "received", "received_count", "fragment_count", "first_seen", "last_seen")
+
+    def __init__(self, total_length, fragment_count, now):
+        self.buffer = bytearray(total_length)
+        # one flag per fragment, to spot duplicates
+        self.received = bytearray(fragment_count)
+        self.received_count = 0
+        self.fragment_count = fragment_count
+        self.first_seen = now
+        self.last_seen = now
+
+
+class FragmentReassembler:
+    '''
+    timeout:            seconds an incomplete command is kept after it's last fragment
+    max_buffered_bytes: total size of the incomplete commands, the oldest are evicted to stay under it
+    max_total_length:   bigger commands are dropped instead of allocated(a corrupt header could ask for 4GB)
+
+    Counters:
+        completed:          commands reassembled
+        fragments:          fragments received
+        duplicates:         fragments received more than once, ignored
+        malformed:          fragments not fitting the command(offset, count or length mismatch), ignored
+        oversized:          fragments of commands over max_total_length, dropped
+        evicted_timeout:    incomplete commands evicted after timeout
+        evicted_memory:     incomplete commands evicted to stay under max_buffered_bytes
+        evicted_bytes:      size of the evicted commands
+    '''
+
+    def __init__(self, timeout: float = 10.0, max_buffered_bytes: int = 32 * 1024 * 1024, max_total_length: int = 4 * 1024 * 1024,
+                 recent_commands: int = 256, clock=monotonic):
+        self.timeout = timeout
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_total_length = max_total_length
+        self.clock = clock
+
+        # in order of the first fragment, so the oldest command is first
+        self.pending: Dict[CommandKey, PendingCommand] = {}
+        self.buffered_bytes = 0
+        # keys of the last completed commands, used as an ordered set
+        self.completed_keys: Dict[CommandKey, None] = {}
+        self.recent_commands = recent_commands
+        # expired commands are looked for every timeout / 4
+        self.next_sweep = clock() + timeout / 4
+
+        self.completed = 0
+        self.fragments = 0
+        self.duplicates = 0
+        self.malformed = 0
+        self.oversized = 0
+        self.evicted_timeout = 0
+        self.evicted_memory = 0
+        self.evicted_bytes = 0
+
+    def add(self, peer: Hashable, channel_id: int, start_sequence_number: int, fragment_number: int, fragment_count: int,
+            total_length: int, fragment_offset: int, fragment) -> Optional[memoryview]:
+        '''
+        returns the reassembled command once all of it's fragments were received, None otherwise
+
+        fragment is copied into the buffer, it can be a view into the packet
+        '''
+        now = self.clock()
+        self.fragments += 1
+        if now >= self.next_sweep:
+            self.evict_expired(now)
+
+        if total_length > self.max_total_length:
+            self.oversized += 1
+            return None
+
+        fragment_end = fragment_offset + len(fragment)
+        if fragment_number >= fragment_count or fragment_end > total_length:
+            # before a buffer is allocated for it
+            self.malformed += 1
+            return None
+
+        key = (peer, channel_id, start_sequence_number)
+        command = self.pending.get(key)
+        if command is None:
+            if key in self.completed_keys:
+                # retransmitted
+                self.duplicates += 1
+                return None
+            self.make_room(total_length)
+            command = self.pending[key] = PendingCommand(total_length, fragment_count, now)
+            self.buffered_bytes += total_length
+
+        buffer = command.buffer
+        if fragment_count != command.fragment_count or total_length != len(buffer):
+            # not the command the first fragment announced
+            self.malformed += 1
+            return None
+
+        received = command.received
+        if received[fragment_number]:
+            self.duplicates += 1
+            return None
+
+        buffer[fragment_offset:fragment_end] = fragment
+        received[fragment_number] = 1
+        command.received_count += 1
+        command.last_seen = now
+
+        if command.received_count != fragment_count:
+            # waiting for fragments
+            return None
+
+        del self.pending[key]
+        self.buffered_bytes -= total_length
+        self.completed += 1
+        self.completed_keys[key] = None
+        if len(self.completed_keys) > self.recent_commands:
+            del self.completed_keys[next(iter(self.completed_keys))]
+        return memoryview(buffer)
+
+    def add_record(self, peer: Hashable, command: photon.CommandRecord) -> Optional[memoryview]:
+        '''
+        add for a FragmentCommand decoded by photon_decoder
+        '''
+        return self.add(
+            peer,
+            command.channel_id,
+            command.start_sequence_number,
+            command.fragment_number,
+            command.fragment_count,
+            command.total_length,
+            command.fragment_offset,
+            command.payload
+        )
+
+    def make_room(self, total_length):
+        while self.pending and self.buffered_bytes + total_length > self.max_buffered_bytes:
+            self.evict(next(iter(self.pending)))
+            self.evicted_memory += 1
+
+    def evict_expired(self, now=None):
+        if now is None:
+            now = self.clock()
+        self.next_sweep = now + self.timeout / 4
+
+        expired = [key for key, command in self.pending.items() if now - command.last_seen > self.timeout]
+        for key in expired:
+            self.evict(key)
+        self.evicted_timeout += len(expired)
+
+    def evict(self, key: CommandKey):
+        command = self.pending.pop(key)
+        self.buffered_bytes -= len(command.buffer)
+        self.evicted_bytes += len(command.buffer)
+
+    def clear(self):
+        self.pending.clear()
+        self.completed_keys.clear()
+        self.buffered_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self.pending),
+            "buffered_bytes": self.buffered_bytes,
+            "completed": self.completed,
+            "fragments": self.fragments,
+            "duplicates": self.duplicates,
+            "malformed": self.malformed,
+            "oversized": self.oversized,
+            "evicted_timeout": self.evicted_timeout,
+            "evicted_memory": self.evicted_memory,
+            "evicted_bytes": self.evicted_bytes,
+        }
@@ -0,0 +1,301 @@
+from dataclasses import replace
+from time import monotonic
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Tuple
+
+import photon_decoder as photon
+
+'''
+De-duplication and reordering of the reliable commands, before any Protocol16 decoding
+
+Reliable commands(and the fragments of the big ones) are numbered per peer and channel(sequence_number),
+a lost one is sent again, so the same command can show up more than once in the capture.
+Dispatching it again wastes the decoding and double counts things, eg: the fame of extensions/fame_meter.py.
+
+Every (peer, channel) has a sliding window of the last window_size sequence numbers, as a bitmap:
+    ahead of the highest one:   accepted, the window slides, the numbers jumped over are counted as skipped
+    in the window, not seen:    accepted, it came late(out of order), counted in late and reorder_depth_max
+    in the window, seen:        a duplicate, dropped
+    behind the window:          an old duplicate, dropped
+    too far ahead:              the peer started over(eg: reconnected on the same ports), the window is reset to it
+A peer starting over from lower sequence numbers only sends commands behind the window,
+the window is reset after max_stale of them in a row.
+
+With reorder, a command ahead of a missing one is held until the missing one comes,
+the missing ones are given up on once max_held commands are held or the first one was held for max_delay seconds.
+Held commands are only released by the next command of their channel, or by flush(eg: at the end of a capture).
+
+peer is anything hashable identifying the direction of the connection, eg: the capture.FiveTuple of the datagram.
+Unreliable commands are not numbered the same way and go through as they are.
+'''
+
+RELIABLE_COMMANDS = (photon.RELIABLE_COMMAND, photon.FRAGMENT_COMMAND)
+
+# (peer, channel_id)
+ChannelKey = Tuple[Hashable, int]
+
+
+class ChannelWindow:
+    __slots__ = ("highest", "seen", "next_expected", "held", "held_since", "last_seen", "stale", "received", "duplicates", "skipped", "late")
+
+    def __init__(self, sequence_number, now):
+        self.highest = sequence_number
+        # bit n: highest - n was received
+        self.seen = 1
+        # for reorder
+        self.next_expected = sequence_number + 1
+        # sequence number => command, waiting for the missing ones before it
+        self.held: Dict[int, photon.CommandRecord] = {}
+        self.held_since = now
+        self.last_seen = now
+        # commands behind the window in a row
+        self.stale = 0
+
+        # counters of the channel, see ReliableWindow
+        self.received = 1
+        self.duplicates = 0
+        self.skipped = 0
+        self.late = 0
+
+
+class ReliableWindow:
+    '''
+    window_size:    sequence numbers remembered per channel, older ones are dropped as duplicates
+    max_stale:      commands behind the window in a row after which the peer is taken to have started over
+    reorder:        put the reliable commands back in order, see above
+    max_held:       commands held per channel at most
+    max_delay:      seconds a command is held at most
+    idle_timeout:   seconds without a command after which a channel is forgotten(with what it holds)
+
+    Counters:
+        accepted:           commands let through
+        duplicates:         commands received again, dropped
+        stale:              of the duplicates, the ones behind the window
+        skipped:            sequence numbers jumped over
+        late:               sequence numbers received after a higher one
+        gaps:               skipped and still not received(skipped - late)
+        reorder_depth_max:  most sequence numbers a late command was behind by
+        resets:             windows started over
+        held:               commands waiting for a missing one
+        reordered:          commands released after being held
+        given_up:           missing sequence numbers the held commands stopped waiting for
+        dropped_held:       held commands lost with a forgotten channel
+    '''
+
+    def __init__(self, window_size: int = 1024, reorder: bool = False, max_held: int = 64, max_delay: float = 0.5,
+                 idle_timeout: float = 300.0, max_stale: int = 32, clock=monotonic):
+        self.window_size = window_size
+        self.max_stale = max_stale
+        self.mask = (1 << window_size) - 1
+        self.reorder = reorder
+        self.max_held = max_held
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+
+        self.channels: Dict[ChannelKey, ChannelWindow] = {}
+        self.next_sweep = clock() + idle_timeout / 4
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.skipped = 0
+        self.late = 0
+        self.reorder_depth_max = 0
+        self.resets = 0
+        self.reordered = 0
+        self.given_up = 0
+        self.dropped_held = 0
+
+    def accept(self, peer: Hashable, channel_id: int, sequence_number: int) -> bool:
+        '''
+        marks the sequence number as received, False for a duplicate
+        '''
+        now = self.clock()
+        if now >= self.next_sweep:
+            self.evict_idle(now)
+
+        key = (peer, channel_id)
+        channel = self.channels.get(key)
+        if channel is None:
+            self.channels[key] = ChannelWindow(sequence_number, now)
+            self.accepted += 1
+            return True
+
+        channel.last_seen = now
+        offset = sequence_number - channel.highest
+        if offset > 0 and offset < self.window_size:
+            self.skipped += offset - 1
+            channel.skipped += offset - 1
+            channel.seen = (channel.seen << offset | 1) & self.mask
+            channel.highest = sequence_number
+            channel.received += 1
+            channel.stale = 0
+            self.accepted += 1
+            return True
+
+        if offset <= 0:
+            if -offset >= self.window_size:
+                # behind the window, a retransmission of a long gone command or the peer started over
+                channel.stale += 1
+                if channel.stale < self.max_stale:
+                    self.duplicates += 1
+                    self.stale += 1
+                    channel.duplicates += 1
+                    return False
+                self.reset(key, sequence_number, now)
+                self.accepted += 1
+                return True
+
+            channel.stale = 0
+            bit = 1 << -offset
+            if channel.seen & bit:
+                self.duplicates += 1
+                channel.duplicates += 1
+                return False
+            channel.seen |= bit
+            self.late += 1
+            channel.late += 1
+            if -offset > self.reorder_depth_max:
+                self.reorder_depth_max = -offset
+            channel.received += 1
+            self.accepted += 1
+            return True
+
+        # too far ahead of the window to be the same sequence
+        self.reset(key, sequence_number, now)
+        self.accepted += 1
+        return True
+
+    def reset(self, key: ChannelKey, sequence_number: int, now: float):
+        channel = self.channels[key]
+        self.resets += 1
+        self.dropped_held += len(channel.held)
+        new_channel = self.channels[key] = ChannelWindow(sequence_number, now)
+        # the counters keep counting
+        new_channel.received += channel.received
+        new_channel.duplicates = channel.duplicates
+        new_channel.skipped = channel.skipped
+        new_channel.late = channel.late
+
+    def filter(self, peer: Hashable, command: photon.CommandRecord) -> Iterable[photon.CommandRecord]:
+        '''
+        the commands to handle now for a received one, in order: none for a duplicate or a held one,
+        more than one when it was the missing one of held commands
+        '''
+        if command.command_type not in RELIABLE_COMMANDS:
+            return (command,)
+        if not self.accept(peer, command.channel_id, command.sequence_number):
+            return ()
+        if not self.reorder:
+            return (command,)
+
+        channel = self.channels[(peer, command.channel_id)]
+        sequence_number = command.sequence_number
+        if sequence_number < channel.next_expected:
+            # the first of the channel, or late after it was given up on
+            return (command,)
+
+        if sequence_number > channel.next_expected:
+            held = channel.held
+            if not held:
+                channel.held_since = channel.last_seen
+            # the payload is a view into the packet, which can be a reused buffer(see capture.py)
+            held[sequence_number] = replace(command, payload=bytes(command.payload))
+            if len(held) > self.max_held or channel.last_seen - channel.held_since > self.max_delay:
+                return self.release(channel, give_up=True)
+            return ()
+
+        channel.next_expected += 1
+        if not channel.held:
+            return (command,)
+        return [command] + self.release(channel)
+
+    def release(self, channel: ChannelWindow, give_up: bool = False) -> List[photon.CommandRecord]:
+        '''
+        the held commands following next_expected
+        give_up: stop waiting for the missing ones before the first held command
+        '''
+        held = channel.held
+        if give_up:
+            first = min(held)
+            self.given_up += first - channel.next_expected
+            channel.next_expected = first
+
+        released = []
+        while channel.next_expected in held:
+            released.append(held.pop(channel.next_expected))
+            channel.next_expected += 1
+
+        self.reordered += len(released)
+        if held:
+            channel.held_since = channel.last_seen
+        return released
+
+    def filter_records(self, peer: Hashable, command_records: List[photon.CommandRecord]) -> Iterator[photon.CommandRecord]:
+        '''
+        filter over the commands of a datagram
+        '''
+        if self.reorder:
+            for command in command_records:
+                yield from self.filter(peer, command)
+            return
+
+        # filter, inlined
+        for command in command_records:
+            if command.command_type not in RELIABLE_COMMANDS or self.accept(peer, command.channel_id, command.sequence_number):
+                yield command
+
+    def flush(self) -> List[Tuple[Hashable, List[photon.CommandRecord]]]:
+        '''
+        gives up on every missing command, returns (peer, commands) of the held ones
+        '''
+        flushed = []
+        for (peer, _), channel in self.channels.items():
+            released = []
+            while channel.held:
+                released += self.release(channel, give_up=True)
+            if released:
+                flushed.append((peer, released))
+        return flushed
+
+    def evict_idle(self, now: float = None):
+        if now is None:
+            now = self.clock()
+        self.next_sweep = now + self.idle_timeout / 4
+        for key in [key for key, channel in self.channels.items() if now - channel.last_seen > self.idle_timeout]:
+            self.dropped_held += len(self.channels.pop(key).held)
+
+    def clear(self):
+        self.channels.clear()
+
+    def peer_stats(self) -> Dict[Hashable, Dict[str, int]]:
+        '''
+        peer => counters of it's channels, see loss.py
+        '''
+        peers = {}
+        # copied, called from other threads
+        for (peer, _), channel in list(self.channels.items()):
+            counters = peers.setdefault(peer, {"received": 0, "duplicates": 0, "gaps": 0})
+            counters["received"] += channel.received
+            counters["duplicates"] += channel.duplicates
+            # late ones older than the first of the channel were never skipped
+            counters["gaps"] += max(0, channel.skipped - channel.late)
+        return peers
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "channels": len(self.channels),
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "stale": self.stale,
+            "skipped": self.skipped,
+            "late": self.late,
+            "gaps": max(0, self.skipped - self.late),
+            "reorder_depth_max": self.reorder_depth_max,
+            "resets": self.resets,
+            # copied, called from other threads(see loss.py)
+            "held": sum(len(channel.held) for channel in list(self.channels.values())),
+            "reordered": self.reordered,
+            "given_up": self.given_up,
+            "dropped_held": self.dropped_held,
+        }
@@ -0,0 +1,139 @@
+from time import monotonic
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from capture import FiveTuple
+from photon_decoder import albion_ports
+from streams import state
+
+'''
+Game sessions seen in the capture, one per client connection, so one capture can follow several clients
+(on one or more interfaces, see capture.sniff_raw)
+
+A session is keyed by the connection, (client ip, client port, server ip, server port),
+the direction of a datagram is told by the albion ports(the server side) instead of a MAC address.
+
+pipeline.py activates the session of every datagram before dispatching it's messages:
+    state.session is the Session the messages being dispatched belong to
+    state.location_id is it's location, set by the PlayerInfoResponse hook of streams.py
+    state.direction is INCOMING or OUTGOING, for the hooks of streams seen both ways
+so the hooks keep using state.location_id and get the one of the right client.
+
+The reassembly of fragments(reassembly.py) is already keyed by connection.
+Sessions idle for idle_timeout seconds are forgotten.
+'''
+
+INCOMING = "incoming"
+OUTGOING = "outgoing"
+
+# (client ip, client port, server ip, server port)
+SessionKey = Tuple[str, int, str, int]
+
+
+def direction(five_tuple: FiveTuple) -> str:
+    '''
+    INCOMING for datagrams from the game server, OUTGOING for the ones of the client
+    '''
+    return INCOMING if five_tuple.sport in albion_ports else OUTGOING
+
+
+def session_key(five_tuple: FiveTuple) -> SessionKey:
+    if five_tuple.sport in albion_ports:
+        return five_tuple.dst, five_tuple.dport, five_tuple.src, five_tuple.sport
+    return five_tuple.src, five_tuple.sport, five_tuple.dst, five_tuple.dport
+
+
+class Session:
+    __slots__ = ("key", "first_seen", "last_seen", "location_id", "player_name")
+
+    def __init__(self, key: SessionKey, now: float):
+        self.key = key
+        self.first_seen = now
+        self.last_seen = now
+        self.location_id = None
+        self.player_name = None
+
+    @property
+    def client(self) -> Tuple[str, int]:
+        return self.key[0], self.key[1]
+
+    @property
+    def server(self) -> Tuple[str, int]:
+        return self.key[2], self.key[3]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "client": f"{self.key[0]}:{self.key[1]}",
+            "server": f"{self.key[2]}:{self.key[3]}",
+            "player_name": self.player_name,
+            "location_id": self.location_id,
+            "idle": round(monotonic() - self.last_seen, 3),
+        }
+
+    def __repr__(self):
+        return f"Session({self.key[0]}:{self.key[1]} <-> {self.key[2]}:{self.key[3]}, {self.player_name})"
+
+
+class SessionTable:
+    '''
+    idle_timeout: seconds without a datagram after which a session is forgotten
+    '''
+
+    def __init__(self, idle_timeout: float = 300.0, clock=monotonic):
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.sessions: Dict[SessionKey, Session] = {}
+        # both directions of every connection => it's session, to skip session_key on the hot path
+        self.by_peer: Dict[Hashable, Session] = {}
+        self.next_sweep = clock() + idle_timeout / 4
+
+    def activate(self, peer: FiveTuple) -> Session:
+        '''
+        the session of a datagram, made the current one(state.session)
+        '''
+        now = self.clock()
+        if now >= self.next_sweep:
+            self.evict_idle(now)
+        session = self.by_peer.get(peer)
+        if session is None:
+            key = session_key(peer)
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = Session(key, now)
+            self.by_peer[peer] = session
+
+        session.last_seen = now
+        state.direction = direction(peer)
+
+        if state.session is not session:
+            state.session = session
+            state.location_id = session.location_id
+        return session
+
+    def evict_idle(self, now: float = None):
+        if now is None:
+            now = self.clock()
+        self.next_sweep = now + self.idle_timeout / 4
+        idle = {key for key, session in self.sessions.items() if now - session.last_seen > self.idle_timeout}
+        for key in idle:
+            del self.sessions[key]
+        for peer in [peer for peer, session in self.by_peer.items() if session.key in idle]:
+            del self.by_peer[peer]
+
+    def get(self, key: SessionKey) -> Optional[Session]:
+        return self.sessions.get(key)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def clear(self):
+        self.sessions.clear()
+        self.by_peer.clear()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [session.as_dict() for session in self]
+
+
+sessions = SessionTable()
@@ -0,0 +1,280 @@
+from heapq import nsmallest
+from math import floor, hypot
+from threading import Lock
+from time import monotonic
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+from streams import state, RequestMove, PlayerInfoResponse, MESSAGE_CONTENT, MessageStream
+from sessions import sessions
+
+'''
+Positions of the entities of the current zone, with a uniform grid for "who is near X" queries
+
+Every entity is a slotted Entity record in a grid cell of cell_size x cell_size,
+moving only touches the record and, when it changes cell, two cell sets.
+
+    near(x, y, radius):     entities within radius, closest first, only the cells overlapping the circle are looked at
+    nearest(x, y, k):       the k closest entities, looking at rings of cells around x, y until no closer one can be left
+
+The positions belong to state.location_id, they are cleared when it changes(on every PlayerInfoResponse).
+With several clients in the capture every session has it's own store, see current.
+
+Off by default since it subscribes to every move event(see lazy decoding in pipeline.py), enable() adds the hooks:
+    move_event:         the entities around the player, the stream is passed in since the layout of the game's
+                        move events isn't confirmed yet(eg: traffic_generator.add_move_event_stream for synthetic traffic)
+    RequestMove:        the player(LOCAL_PLAYER)
+    PlayerInfoResponse: zone change and the player's position
+Messages without the fields(eg: a different layout) are skipped.
+'''
+
+# entity id of the player
+LOCAL_PLAYER = -1
+
+
+class Entity:
+    __slots__ = ("entity_id", "x", "y", "dst", "speed", "updated", "cell")
+
+    def __init__(self, entity_id, x, y, dst, speed, updated, cell):
+        self.entity_id = entity_id
+        self.x = x
+        self.y = y
+        # where it's heading, None if unknown
+        self.dst = dst
+        self.speed = speed
+        self.updated = updated
+        self.cell = cell
+
+    def __repr__(self):
+        return f"Entity({self.entity_id}, x={self.x:.1f}, y={self.y:.1f})"
+
+
+class EntityPositions:
+    '''
+    cell_size:  side of a grid cell, in game units, about the radius of the usual queries
+    clock:      of Entity.updated
+    '''
+
+    def __init__(self, cell_size: float = 20.0, clock=monotonic):
+        self.cell_size = cell_size
+        self.clock = clock
+        self.location_id = None
+        self.entities: Dict[Hashable, Entity] = {}
+        # (cell_x, cell_y) => entities in it
+        self.cells: Dict[Tuple[int, int], Set[Entity]] = {}
+        # queries come from other threads(eg: the event server)
+        self.lock = Lock()
+
+    def cell_of(self, x, y) -> Tuple[int, int]:
+        return floor(x / self.cell_size), floor(y / self.cell_size)
+
+    def check_location(self):
+        if state.location_id != self.location_id:
+            self.clear()
+            self.location_id = state.location_id
+
+    def update(self, entity_id: Hashable, x: float, y: float, dst: Optional[Tuple[float, float]] = None, speed: float = None):
+        with self.lock:
+            self.check_location()
+            cell = self.cell_of(x, y)
+            entity = self.entities.get(entity_id)
+
+            if entity is None:
+                entity = self.entities[entity_id] = Entity(entity_id, x, y, dst, speed, self.clock(), cell)
+                self.cells.setdefault(cell, set()).add(entity)
+                return
+
+            entity.x, entity.y, entity.dst, entity.speed, entity.updated = x, y, dst, speed, self.clock()
+            if entity.cell != cell:
+                self.remove_from_cell(entity)
+                entity.cell = cell
+                self.cells.setdefault(cell, set()).add(entity)
+
+    def remove_from_cell(self, entity: Entity):
+        members = self.cells[entity.cell]
+        members.discard(entity)
+        if not members:
+            del self.cells[entity.cell]
+
+    def remove(self, entity_id: Hashable):
+        with self.lock:
+            entity = self.entities.pop(entity_id, None)
+            if entity is not None:
+                self.remove_from_cell(entity)
+
+    def evict_stale(self, max_age: float) -> int:
+        '''
+        removes the entities not updated for max_age seconds(eg: out of sight), returns how many
+        '''
+        with self.lock:
+            oldest = self.clock() - max_age
+            stale = [entity for entity in self.entities.values() if entity.updated < oldest]
+            for entity in stale:
+                del self.entities[entity.entity_id]
+                self.remove_from_cell(entity)
+            return len(stale)
+
+    def clear(self):
+        self.entities.clear()
+        self.cells.clear()
+
+    def get(self, entity_id: Hashable) -> Optional[Entity]:
+        return self.entities.get(entity_id)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def near(self, x: float, y: float, radius: float) -> List[Tuple[float, Entity]]:
+        '''
+        (distance, entity) of the entities within radius of x, y, closest first
+        '''
+        min_x, min_y = self.cell_of(x - radius, y - radius)
+        max_x, max_y = self.cell_of(x + radius, y + radius)
+        found = []
+        with self.lock:
+            cells = self.cells
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > len(cells):
+                # a radius covering most of the grid, only look at the used cells
+                candidates = [cells[cell] for cell in cells if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y]
+            else:
+                candidates = [cells[cell] for cell in
+                    ((cell_x, cell_y) for cell_x in range(min_x, max_x + 1) for cell_y in range(min_y, max_y + 1))
+                    if cell in cells]
+
+            for members in candidates:
+                for entity in members:
+                    distance = hypot(entity.x - x, entity.y - y)
+                    if distance <= radius:
+                        found.append((distance, entity))
+
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, x: float, y: float, k: int = 1, exclude: Hashable = None) -> List[Tuple[float, Entity]]:
+        '''
+        (distance, entity) of the k entities closest to x, y, closest first
+        exclude: an entity id to leave out, eg: the one at x, y
+        '''
+        center_x, center_y = self.cell_of(x, y)
+        found = []
+        with self.lock:
+            cells = self.cells
+            remaining = len(self.entities) - (exclude in self.entities)
+            k = min(k, remaining)
+            if k <= 0:
+                return []
+
+            ring = 0
+            seen = 0
+            while True:
+                for cell in ring_cells(center_x, center_y, ring):
+                    members = cells.get(cell)
+                    if not members:
+                        continue
+                    for entity in members:
+                        if entity.entity_id == exclude:
+                            continue
+                        found.append((hypot(entity.x - x, entity.y - y), entity))
+                    seen += len(members)
+
+                # everything outside of the rings so far is at least this far
+                covered = (ring + min(x / self.cell_size - center_x, center_x + 1 - x / self.cell_size,
+                                      y / self.cell_size - center_y, center_y + 1 - y / self.cell_size)) * self.cell_size
+                if len(found) >= k and nsmallest(k, found, key=lambda item: item[0])[-1][0] <= covered:
+                    break
+                if seen >= len(self.entities):
+                    break
+                ring += 1
+
+        return nsmallest(k, found, key=lambda item: item[0])
+
+
+def ring_cells(center_x: int, center_y: int, ring: int):
+    '''
+    the cells at chebyshev distance ring from the center
+    '''
+    if ring == 0:
+        yield center_x, center_y
+        return
+    for cell_x in range(center_x - ring, center_x + ring + 1):
+        yield cell_x, center_y - ring
+        yield cell_x, center_y + ring
+    for cell_y in range(center_y - ring + 1, center_y + ring):
+        yield center_x - ring, cell_y
+        yield center_x + ring, cell_y
+
+
+# the store without sessions(eg: messages dispatched without their connection)
+positions = EntityPositions()
+# session key => store, see sessions.py
+stores: Dict[Hashable, EntityPositions] = {}
+
+
+def current() -> EntityPositions:
+    '''
+    the store of the session being dispatched(state.session)
+    '''
+    session = state.session
+    if session is None:
+        return positions
+
+    store = stores.get(session.key)
+    if store is None:
+        # forget the stores of the forgotten sessions
+        for key in [key for key in stores if sessions.get(key) is None]:
+            del stores[key]
+        store = stores[session.key] = EntityPositions(positions.cell_size, positions.clock)
+    return store
+
+
+def point(value) -> Optional[Tuple[float, float]]:
+    '''
+    None if value isn't an (x, y) pair
+    '''
+    try:
+        return float(value[0]), float(value[1])
+    except (TypeError, IndexError, ValueError):
+        return None
+
+
+def on_move_event(target):
+    content = target[MESSAGE_CONTENT]
+    position, entity_id = point(content.get("pos")), content.get("object_id")
+    if position is None or entity_id is None:
+        return
+    current().update(entity_id, *position, point(content.get("dst")), content.get("speed"))
+
+
+def on_request_move(target):
+    content = target[MESSAGE_CONTENT]
+    position = point(content.get("src"))
+    if position is None:
+        return
+    current().update(LOCAL_PLAYER, *position, point(content.get("dst")), content.get("speed"))
+
+
+def on_player_info(target):
+    # streams.PlayerInfoResponse_save_location already updated the location
+    store = current()
+    with store.lock:
+        store.check_location()
+    position = point(target[MESSAGE_CONTENT].get("pos"))
+    if position is not None:
+        store.update(LOCAL_PLAYER, *position)
+
+
+enabled = False
+
+
+def enable(move_event: MessageStream = None):
+    '''
+    starts tracking, the hooks stay for the rest of the session
+    move_event: the stream of the move events of the other entities, without it only the player is tracked
+    '''
+    global enabled
+    if enabled:
+        return
+    enabled = True
+    if move_event is not None:
+        move_event.add_hook(on_move_event)
+    RequestMove.add_hook(on_request_move)
+    PlayerInfoResponse.add_hook(on_player_info)
@@ -1,8 +1,12 @@
-from copy import deepcopy
 from pprint import pprint
 from functools import partial
 from typing import List, Tuple, Union, Dict, Any, Callable
 from dataclasses import dataclass, field, KW_ONLY
+from time import perf_counter_ns
+
+import metrics
+import hook_executors
+import interning
 
 pprint = partial(pprint, width=150)
 
@@ -45,6 +49,31 @@ __all__=[
 
 class state:
     location_id = None
+    # sessions.Session of the messages being dispatched, see sessions.py
+    session = None
+    # sessions.INCOMING(from the game server) or sessions.OUTGOING(from the client)
+    direction = None
+
+class subscriptions:
+    '''
+    version: changed on every new hook, stream or unknown stream,
+        StreamSeparator.has_subscribers is cached until it changes
+    '''
+    version = 0
+
+def subscriptions_changed():
+    '''
+    call after changing the hooks or streams without add_hook/add_stream/set_unknown_stream
+    '''
+    subscriptions.version += 1
+
+def has_subscribers(stream):
+    if stream is None:
+        return False
+    if isinstance(stream, (MessageStream, StreamSeparator)):
+        return stream.has_subscribers()
+    # any other callable
+    return True
 
 class TRANSLATOR_DEFAULT: pass 
 class TRANSLATOR_IGNORE: pass 
@@ -71,21 +100,7 @@ class TranslateDefinition:
     def apply(self, target):
         if self.old_key not in target[MESSAGE_CONTENT]:
             # old_key not present
-
-            if self.default_value is not TRANSLATOR_DEFAULT:
-                # provide default
-                return self.new_key, self.default_value
-            
-            if self.default_factory is not TRANSLATOR_DEFAULT:
-                # provide default
-                return self.new_key, self.default_factory()
-
-            # TODO: some way of providing more context would be helpful for the user
-            transformer = self.transformer if self.transformer else ""
-            if self.presence_guaranteed:
-                print(f"Old Key: {self.old_key} not presend for replaceing with {transformer}({self.new_key})")
-
-            return False
+            return self.missing()
 
         if self.new_key is TRANSLATOR_IGNORE:
             return TRANSLATOR_IGNORE, TRANSLATOR_IGNORE
@@ -97,17 +112,93 @@ class TranslateDefinition:
 
         return self.new_key, value
 
+    def missing(self):
+        '''
+        result of apply when old_key is not present
+        '''
+        if self.default_value is not TRANSLATOR_DEFAULT:
+            # provide default
+            return self.new_key, self.default_value
+        
+        if self.default_factory is not TRANSLATOR_DEFAULT:
+            # provide default
+            return self.new_key, self.default_factory()
+
+        # TODO: some way of providing more context would be helpful for the user
+        transformer = self.transformer if self.transformer else ""
+        if self.presence_guaranteed:
+            print(f"Old Key: {self.old_key} not presend for replaceing with {transformer}({self.new_key})")
+
+        return False
+
     __call__ = apply
 
 
+# stands in for an old_key already consumed by a previous TranslateDefinition, never present
+class TRANSLATOR_CONSUMED: pass
+
+
 class MessageTranslator:
-    """docstring for MessageTranslator."""
+    """
+    Applies the TranslateDefinitions in order to the content of a message,
+    the translated entries are replaced by their new keys and the others are kept
+
+    The definitions are compiled once(see compile), translate then builds a new content dict in a single pass,
+    the rest of the message is not copied, so the translated message shares the untranslated values with the original
+    """
 
     def __init__(self, translations: List[TranslateDefinition]):
         self.translations = translations
+        self.compile()
+
+    def compile(self):
+        '''
+        Precomputes the steps of translate, call again after changing translations
+        '''
+        old_keys = [translator.old_key for translator in self.translations]
+        self.old_keys = frozenset(old_keys)
+
+        # a new_key being translated again(or deleted) by itself or a later definition depends on the order
+        # the definitions are applied in, leave those to translate_generic
+        self.generic = any(
+            translator.new_key is not TRANSLATOR_IGNORE and translator.new_key in old_keys[index:]
+                for index, translator in enumerate(self.translations)
+        )
+
+        self.steps = []
+        for index, translator in enumerate(self.translations):
+            old_key = translator.old_key
+            if old_key in old_keys[:index]:
+                # already deleted by the previous definition
+                old_key = TRANSLATOR_CONSUMED
+            self.steps.append((old_key, translator.new_key, translator.transformer, translator))
 
     def translate(self, org_target):
-        target = deepcopy(org_target)
+        if self.generic:
+            return self.translate_generic(org_target)
+
+        content = org_target[MESSAGE_CONTENT]
+        old_keys = self.old_keys
+        new_content = {key: value for key, value in content.items() if key not in old_keys}
+
+        for old_key, new_key, transformer, translator in self.steps:
+            if old_key in content:
+                if new_key is not TRANSLATOR_IGNORE:
+                    new_content[new_key] = transformer(content[old_key]) if transformer else content[old_key]
+                continue
+
+            result = translator.missing()
+            if result and result[0] is not TRANSLATOR_IGNORE:
+                new_content[result[0]] = result[1]
+
+        return (*org_target[:MESSAGE_CONTENT], new_content)
+
+    def translate_generic(self, org_target):
+        '''
+        Applies the definitions one by one on a copy of the content
+        '''
+        content = dict(org_target[MESSAGE_CONTENT])
+        target = (*org_target[:MESSAGE_CONTENT], content)
 
         for translator in self.translations:
             result = translator(target)
@@ -118,10 +209,10 @@ class MessageTranslator:
             new_key, value = result
 
             if new_key is not TRANSLATOR_IGNORE:
-                target[MESSAGE_CONTENT][new_key] = value
+                content[new_key] = value
 
-            if translator.old_key in target[MESSAGE_CONTENT]:
-                del target[MESSAGE_CONTENT][translator.old_key]
+            if translator.old_key in content:
+                del content[translator.old_key]
 
         return target
 
@@ -131,14 +222,36 @@ class MessageTranslator:
 class MessageStream:
     """docstring for MessageStream."""
 
-    def __init__(self, translator=None):
+    def __init__(self, translator=None, name=None, projected=False):
+        '''
+        projected: only decode the parameters the translator uses(and the ones the separators look at),
+                   the hooks won't see the untranslated ones, see DispatchTable.projection
+        '''
         self.hooks = []
         self.translator = translator
+        # for the metrics, set to the variable name for the streams in this file
+        self.name = name
+        self.projected = projected
+
+    def add_hook(self, func=None, mode=hook_executors.INLINE, **options):
+        '''
+        mode: where func runs, "inline"(in the packet callback), "thread" or "async", see hook_executors.py
+        options: of the queue for "thread" and "async": queue_size, policy, timeout
+
+        usable as a decorator, with or without the arguments:
+            @FameEvent.add_hook
+            @FameEvent.add_hook(mode="thread", queue_size=100)
+        '''
+        if func is None:
+            return partial(self.add_hook, mode=mode, **options)
 
-    def add_hook(self, func):
-        self.hooks.append(func)
+        self.hooks.append(hook_executors.wrap_hook(func, mode, **options))
+        subscriptions_changed()
         return func
 
+    def has_subscribers(self):
+        return len(self.hooks) != 0
+
     def use_hooks(self, target):
         # don't waste time
         if len(self.hooks) == 0:
@@ -163,6 +276,10 @@ class StreamSeparator:
         self.streams = {}
         self.unknown_identifier_stream = unknown_identifier_stream
 
+        # cached has_subscribers
+        self.subscribed = False
+        self.subscribed_version = -1
+
     def separate(self, target):
         if self.identifier_index is SEPARATOR_MESSAGECODE:
             identifier = target[0]
@@ -178,8 +295,45 @@ class StreamSeparator:
 
     def add_stream(self, identifier, stream):
         self.streams[identifier] = stream
+        subscriptions_changed()
         return stream
 
+    def has_subscribers(self):
+        '''
+        if any hook or unknown stream is reachable through this separator
+        '''
+        if self.subscribed_version != subscriptions.version:
+            self.subscribed = has_subscribers(self.unknown_identifier_stream) or any(
+                has_subscribers(stream) for stream in self.streams.values()
+            )
+            self.subscribed_version = subscriptions.version
+        return self.subscribed
+
+    def is_subscribed(self, message_code, peek_parameter):
+        '''
+        if a message would reach any hook or unknown stream, used to skip decoding the ones nobody listens to
+
+        message_code: target[0]
+        peek_parameter: called with a key, returns the value of that parameter, None if missing
+        '''
+        if not self.has_subscribers():
+            return False
+
+        if self.identifier_index is SEPARATOR_MESSAGECODE:
+            identifier = message_code
+        else:
+            identifier = peek_parameter(self.identifier_index)
+
+        try:
+            stream = self.streams[identifier] if identifier in self.streams else self.unknown_identifier_stream
+        except TypeError:
+            # unhashable identifier, let separate deal with it
+            return True
+
+        if isinstance(stream, StreamSeparator):
+            return stream.is_subscribed(message_code, peek_parameter)
+        return has_subscribers(stream)
+
     def add_stream_d(self, identifier):
         return partial(self.add_stream, identifier)
 
@@ -187,6 +341,7 @@ class StreamSeparator:
         self.set_unknown_stream(None)
     def set_unknown_stream(self, stream):
         self.unknown_identifier_stream = stream
+        subscriptions_changed()
 
     def __getitem__(self, identifier):
         return self.streams[identifier]
@@ -196,6 +351,228 @@ class StreamSeparator:
     __call__ = separate
 
 
+# marks an identifier without a route in DispatchTable, None means there is nothing to call
+class DISPATCH_MISSING: pass
+
+
+class DispatchTable:
+    """
+    The separator tree under a StreamSeparator flattened into lookups by (identifier, sub_identifier),
+    eg: (message_code, parameter 252) for EventBundle, doing the same as separator(target) in one step
+
+    The routes resolve straight to the (translator, hooks, name, instruments, keys) of the MessageStreams,
+    streams without hooks resolve to None and are skipped.
+    keys are the parameters to decode for projected streams, None for all of them.
+    Deeper separators, other callables and MessageStreams with their own use_hooks are called as they are.
+
+    The table is rebuilt on the first message after any change to the streams(see subscriptions)
+
+    name: used for the metrics(see metrics.py), as are the names of the streams(their path if unnamed)
+    """
+
+    def __init__(self, separator: StreamSeparator, name: str = None):
+        self.separator = separator
+        self.name = name or f"table_{id(self):x}"
+        self.version = -1
+        # if any route has keys, see has_projections
+        self.projected = False
+        # identifiers(of the separator) with a route with keys under them
+        self.projected_identifiers = set()
+
+    def route(self, stream, path, identifier_indexes=()):
+        '''
+        identifier_indexes: the keys of the separators on the way to the stream
+        '''
+        if not has_subscribers(stream):
+            return None
+
+        if isinstance(stream, MessageStream) and type(stream).use_hooks is MessageStream.use_hooks:
+            translator, hooks = stream.translator, stream.hooks
+        else:
+            translator, hooks = None, [stream]
+        name = getattr(stream, "name", None) or path
+
+        instruments = None
+        if metrics.enabled:
+            instruments = (
+                metrics.stream_histogram(self.name, name),
+                [(hook, metrics.hook_histogram(self.name, name, metrics.hook_name(hook))) for hook in hooks],
+            )
+
+        keys = None
+        if getattr(stream, "projected", False) and translator is not None:
+            keys = translator.old_keys | frozenset(index for index in identifier_indexes if index is not SEPARATOR_MESSAGECODE)
+            self.projected = True
+
+        return translator, hooks, name, instruments, keys
+
+    def compile(self):
+        separator = self.separator
+        index = separator.identifier_index
+        self.projected = False
+
+        # identifier => route
+        self.routes = {}
+        # identifier => identifier_index of the StreamSeparator under it
+        self.sub_indexes = {}
+        # (identifier, sub_identifier) => route
+        self.sub_routes = {}
+        # identifier => route of the unknown_identifier_stream of the StreamSeparator under it
+        self.sub_unknown_routes = {}
+
+        for identifier, stream in separator.streams.items():
+            if isinstance(stream, StreamSeparator):
+                self.sub_indexes[identifier] = stream.identifier_index
+                indexes = (index, stream.identifier_index)
+                self.sub_unknown_routes[identifier] = self.route(stream.unknown_identifier_stream, f"{identifier}/unknown", indexes)
+                for sub_identifier, sub_stream in stream.streams.items():
+                    self.sub_routes[(identifier, sub_identifier)] = self.route(sub_stream, f"{identifier}/{sub_identifier}", indexes)
+            else:
+                self.routes[identifier] = self.route(stream, f"{identifier}", (index,))
+
+        self.unknown_route = self.route(separator.unknown_identifier_stream, "unknown", (index,))
+
+        self.projected_identifiers = {identifier for identifier, route in self.routes.items() if route and route[4] is not None}
+        self.projected_identifiers.update(
+            identifier for (identifier, _), route in self.sub_routes.items() if route and route[4] is not None
+        )
+        self.version = subscriptions.version
+
+    def lookup(self, message_code, get_parameter):
+        '''
+        returns (route, unknown), unknown being the (identifier, sub_identifier) if no stream was added for it, None otherwise
+        get_parameter: called with a key, returns the value of that parameter, None if missing
+        '''
+        if self.version != subscriptions.version:
+            self.compile()
+
+        index = self.separator.identifier_index
+        identifier = message_code if index is SEPARATOR_MESSAGECODE else get_parameter(index)
+
+        if identifier in self.sub_indexes:
+            index = self.sub_indexes[identifier]
+            sub_identifier = message_code if index is SEPARATOR_MESSAGECODE else get_parameter(index)
+
+            route = self.sub_routes.get((identifier, sub_identifier), DISPATCH_MISSING)
+            if route is DISPATCH_MISSING:
+                return self.sub_unknown_routes[identifier], (identifier, sub_identifier)
+            return route, None
+
+        if identifier in self.routes:
+            return self.routes[identifier], None
+        return self.unknown_route, (identifier, None)
+
+    def resolve(self, message_code, get_parameter):
+        '''
+        the route of a message
+        '''
+        return self.lookup(message_code, get_parameter)[0]
+
+    def has_projections(self, message_code=None):
+        '''
+        if any route has keys, checked before paying for the lookup of projection
+        message_code: only the routes under it, when the separator is on the message code
+        '''
+        if self.version != subscriptions.version:
+            self.compile()
+        if message_code is not None and self.separator.identifier_index is SEPARATOR_MESSAGECODE:
+            return message_code in self.projected_identifiers
+        return self.projected
+
+    def projection(self, message_code, get_parameter):
+        '''
+        the parameters to decode for a message, None for all of them
+        only projected streams(see MessageStream) have some
+        '''
+        try:
+            route = self.resolve(message_code, get_parameter)
+        except TypeError:
+            return None
+        return route[4] if route is not None else None
+
+    def dispatch(self, target):
+        # resolve, inlined
+        if self.version != subscriptions.version:
+            self.compile()
+
+        index = self.separator.identifier_index
+        identifier = target[0] if index is SEPARATOR_MESSAGECODE else target[MESSAGE_CONTENT].get(index)
+
+        sub_indexes = self.sub_indexes
+        if identifier in sub_indexes:
+            index = sub_indexes[identifier]
+            route = self.sub_routes.get(
+                (identifier, target[0] if index is SEPARATOR_MESSAGECODE else target[MESSAGE_CONTENT].get(index)),
+                DISPATCH_MISSING
+            )
+            if route is DISPATCH_MISSING:
+                route = self.sub_unknown_routes[identifier]
+        else:
+            route = self.routes.get(identifier, self.unknown_route)
+
+        if route is None:
+            return
+
+        translator = route[0]
+        if translator:
+            target = translator(target)
+
+        for hook in route[1]:
+            hook(target)
+
+    def dispatch_instrumented(self, target):
+        '''
+        dispatch, timing the stream and every hook, used while metrics are enabled
+        '''
+        route, unknown = self.lookup(target[0], target[MESSAGE_CONTENT].get)
+        if unknown is not None:
+            metrics.count_unknown(self.name, *unknown)
+
+        if route is None:
+            return
+
+        translator, _, name, (stream_histogram, timed_hooks), _ = route
+        start = perf_counter_ns()
+        if translator:
+            target = translator(target)
+
+        for hook, hook_histogram in timed_hooks:
+            hook_start = perf_counter_ns()
+            hook(target)
+            hook_histogram.observe((perf_counter_ns() - hook_start) / 1e9)
+
+        stream_histogram.observe((perf_counter_ns() - start) / 1e9)
+        # a message already routed when metrics.reset() cleared the counters
+        key = (self.name, name)
+        metrics.stream_messages[key] = metrics.stream_messages.get(key, 0) + 1
+
+    def is_subscribed_plain(self, message_code, peek_parameter):
+        '''
+        StreamSeparator.is_subscribed through the table
+        '''
+        try:
+            return self.resolve(message_code, peek_parameter) is not None
+        except TypeError:
+            # unhashable identifier, let dispatch deal with it
+            return True
+
+    def is_subscribed_instrumented(self, message_code, peek_parameter):
+        '''
+        is_subscribed, counting the unknown messages that won't be dispatched, used while metrics are enabled
+        '''
+        try:
+            route, unknown = self.lookup(message_code, peek_parameter)
+        except TypeError:
+            return True
+
+        if route is None and unknown is not None:
+            metrics.count_unknown(self.name, *unknown)
+        return route is not None
+
+    is_subscribed = is_subscribed_plain
+    __call__ = dispatch
+
+
 def StreamPrint_Generator(stream_name, use_pprint=False):
     if use_pprint:
         def temp(*args):
@@ -239,16 +616,20 @@ ReponseBundle[1] = StreamSeparator(253)
 # Confirmed @ Game.26.040.287170 - 18.09.2024 10:02
 PlayerInfoResponse = ReponseBundle[1].add_stream(2, MessageStream(MessageTranslator([
     TranslateDefinition(253, TRANSLATOR_IGNORE),
-    TranslateDefinition(1,   "CharacterID", transformer=bytes.hex),
-    TranslateDefinition(8,   "LocationID",  transformer=bytes.decode),
-    TranslateDefinition(2,   "player_name", transformer=bytes.decode),
-    TranslateDefinition(52,  "guild_name",  transformer=bytes.decode, presence_guaranteed=False),
+    # the same ids and names come again every zone change, see interning.py
+    TranslateDefinition(1,   "CharacterID", transformer=interning.hex_id),
+    TranslateDefinition(8,   "LocationID",  transformer=interning.decode_string),
+    TranslateDefinition(2,   "player_name", transformer=interning.decode_string),
+    TranslateDefinition(52,  "guild_name",  transformer=interning.decode_string, presence_guaranteed=False),
     TranslateDefinition(9,   "pos"),
-])))
+]), projected=True))
 
 @PlayerInfoResponse.add_hook
 def PlayerInfoResponse_save_location(target):
     state.location_id = target[MESSAGE_CONTENT]["LocationID"]
+    if state.session is not None:
+        state.session.location_id = state.location_id
+        state.session.player_name = target[MESSAGE_CONTENT]["player_name"]
     print(f"Entered {type(state.location_id)}({state.location_id})")
 
 
@@ -297,3 +678,14 @@ SayMessage = EventBundle[1].add_stream(69, MessageStream(MessageTranslator([
     TranslateDefinition(252, None),
     # not done
 ])))
+
+
+def name_streams(namespace: Dict[str, Any]):
+    '''
+    names the unnamed MessageStreams after their variable, eg: name_streams(globals())
+    '''
+    for name, value in namespace.items():
+        if isinstance(value, MessageStream) and not value.name:
+            value.name = name
+
+name_streams(globals())
@@ -0,0 +1,24 @@
+import importlib.util
+import os
+import sys
+
+'''
+The modules are imported from the root of the repository, like main.py does
+
+Protocol16_parser.py and Layers.py are imported as protocol16_parser and layers,
+which only works on case insensitive file systems(Windows), they are loaded under those names otherwise.
+'''
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+for name, filename in (("protocol16_parser", "Protocol16_parser.py"), ("layers", "Layers.py")):
+    if name not in sys.modules and not os.path.exists(os.path.join(root, f"{name}.py")):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(root, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except ImportError:
+            # layers needs Scapy
+            del sys.modules[name]
@@ -0,0 +1,95 @@
+from struct import unpack_from
+
+import pytest
+
+import capture
+from capture import FiveTuple, udp_ports_bpf
+from traffic_generator import ethernet_frame
+
+SERVER_TO_CLIENT = FiveTuple("10.0.0.1", 5056, "192.168.0.2", 50000)
+CLIENT_TO_SERVER = FiveTuple("192.168.0.2", 50000, "10.0.0.1", 5056)
+OTHER = FiveTuple("10.0.0.1", 53, "192.168.0.2", 50000)
+
+
+def run(program, frame):
+    '''
+    the classic BPF instructions used by udp_ports_bpf, returns the snap length(0 drops the frame)
+    '''
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        try:
+            if code == capture.BPF_LD_H_ABS:
+                a = unpack_from(">H", frame, k)[0]
+            elif code == capture.BPF_LD_B_ABS:
+                a = frame[k]
+            elif code == capture.BPF_LD_H_IND:
+                a = unpack_from(">H", frame, x + k)[0]
+            elif code == capture.BPF_LDX_B_MSH:
+                x = (frame[k] & 0x0F) * 4
+            elif code == capture.BPF_JEQ_K:
+                pc += jt if a == k else jf
+            elif code == capture.BPF_JSET_K:
+                pc += jt if a & k else jf
+            elif code == capture.BPF_RET_K:
+                return k
+            else:
+                raise AssertionError(f"unexpected opcode {code:#x}")
+        except IndexError:
+            # the kernel drops frames read past their end
+            return 0
+        pc += 1
+
+
+def with_ip_options(frame):
+    '''
+    the frame with 4 bytes of IPv4 options(ihl 6)
+    '''
+    ip_start = capture.ETH_HEADER_SIZE
+    return frame[:ip_start] + bytes((0x46,)) + frame[ip_start + 1:ip_start + 20] + b"\x01\x01\x01\x00" + frame[ip_start + 20:]
+
+
+def test_albion_ports_either_way():
+    program = udp_ports_bpf([5055, 5056], snaplen=1500)
+    assert run(program, ethernet_frame(SERVER_TO_CLIENT, b"payload")) == 1500
+    assert run(program, ethernet_frame(CLIENT_TO_SERVER, b"payload")) == 1500
+    assert run(program, ethernet_frame(OTHER, b"payload")) == 0
+
+
+@pytest.mark.parametrize("ports", [[5056], [5055, 5056, 5057], list(range(6000, 6100))])
+def test_every_port(ports):
+    program = udp_ports_bpf(ports)
+    for port in ports:
+        assert run(program, ethernet_frame(FiveTuple("10.0.0.1", port, "192.168.0.2", 50000), b"x")) == 0xFFFF
+        assert run(program, ethernet_frame(FiveTuple("192.168.0.2", 50000, "10.0.0.1", port), b"x")) == 0xFFFF
+    assert run(program, ethernet_frame(OTHER, b"x")) == 0
+
+    # jumps stay in the program and fit the 8 bit jt/jf
+    for index, (code, jt, jf, _) in enumerate(program):
+        if code in (capture.BPF_JEQ_K, capture.BPF_JSET_K):
+            assert 0 <= jt < 256 and 0 <= jf < 256
+            assert index + 1 + max(jt, jf) < len(program)
+
+
+def test_ip_options():
+    program = udp_ports_bpf([5056])
+    assert run(program, with_ip_options(ethernet_frame(SERVER_TO_CLIENT, b"x"))) == 0xFFFF
+    assert run(program, with_ip_options(ethernet_frame(OTHER, b"x"))) == 0
+
+
+def test_not_ipv4_udp():
+    program = udp_ports_bpf([5056])
+    frame = ethernet_frame(SERVER_TO_CLIENT, b"x")
+    # ARP
+    assert run(program, frame[:12] + b"\x08\x06" + frame[14:]) == 0
+    # TCP
+    assert run(program, frame[:23] + bytes((6,)) + frame[24:]) == 0
+
+
+def test_fragments():
+    program = udp_ports_bpf([5056])
+    frame = ethernet_frame(SERVER_TO_CLIENT, b"x")
+    # more fragments, the first one has the UDP header
+    assert run(program, frame[:20] + b"\x20\x00" + frame[22:]) == 0xFFFF
+    # fragment offset 8, the source port would be payload
+    assert run(program, frame[:20] + b"\x00\x01" + frame[22:]) == 0
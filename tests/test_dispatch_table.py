@@ -0,0 +1,128 @@
+import pytest
+
+from streams import (
+    DispatchTable, MessageStream, MessageTranslator, StreamSeparator, TranslateDefinition,
+    SEPARATOR_MESSAGECODE, TRANSLATOR_IGNORE, subscriptions_changed,
+)
+
+
+class LoggingStream(MessageStream):
+    '''
+    a stream with it's own use_hooks, called as it is by the table
+    '''
+
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+
+    def has_subscribers(self):
+        return True
+
+    def use_hooks(self, target):
+        self.log.append(("custom", target))
+
+    __call__ = use_hooks
+
+
+def logger(log, label):
+    return lambda target: log.append((label, target))
+
+
+def build(log):
+    bundle = StreamSeparator(SEPARATOR_MESSAGECODE)
+    bundle[1] = StreamSeparator(252)
+
+    translated = bundle[1].add_stream(10, MessageStream(MessageTranslator([
+        TranslateDefinition(252, TRANSLATOR_IGNORE),
+        TranslateDefinition(0,   "value"),
+        TranslateDefinition(1,   "name", transformer=str.upper, presence_guaranteed=False),
+    ])))
+    translated.add_hook(logger(log, "translated"))
+    translated.add_hook(logger(log, "translated again"))
+    # no hooks
+    bundle[1].add_stream(11, MessageStream())
+    bundle[1].add_stream(12, LoggingStream(log))
+    bundle[1].set_unknown_stream(logger(log, "unknown 252"))
+
+    plain = bundle.add_stream(2, MessageStream())
+    plain.add_hook(logger(log, "plain"))
+
+    unknown = MessageStream(MessageTranslator([TranslateDefinition(0, "value", default_value=None)]))
+    unknown.add_hook(logger(log, "unknown code"))
+    bundle.set_unknown_stream(unknown)
+    return bundle
+
+
+MESSAGES = [
+    (1, {252: 10, 0: 5, 1: "ab", 7: "kept"}),
+    (1, {252: 10, 0: 6}),
+    (1, {252: 11, 0: 7}),
+    (1, {252: 12, 0: 8}),
+    (1, {252: 99, 0: 9}),
+    # without the sub code
+    (1, {0: 10}),
+    (2, {0: 11}),
+    (3, {0: 12}),
+    (3, {}),
+]
+
+
+def test_same_hooks_and_targets_as_the_separator():
+    separated, dispatched = [], []
+    bundle = build(separated)
+    for message in MESSAGES:
+        bundle(message)
+
+    bundle = build(dispatched)
+    table = DispatchTable(bundle)
+    for message in MESSAGES:
+        table(message)
+
+    assert dispatched == separated
+    assert ("translated", (1, {7: "kept", "value": 5, "name": "AB"})) in dispatched
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_same_subscriptions_as_the_separator(message):
+    bundle = build([])
+    table = DispatchTable(bundle)
+    code, content = message
+    assert table.is_subscribed(code, content.get) == bundle.is_subscribed(code, content.get)
+
+
+def test_routes_follow_new_hooks_and_streams():
+    log = []
+    bundle = build(log)
+    table = DispatchTable(bundle)
+    table((1, {252: 11}))
+    assert log == []
+    assert not table.is_subscribed(1, {252: 11}.get)
+
+    bundle[1][11].add_hook(logger(log, "late hook"))
+    table((1, {252: 11}))
+    bundle[1].add_stream(13, MessageStream()).add_hook(logger(log, "late stream"))
+    table((1, {252: 13}))
+    assert [label for label, _ in log] == ["late hook", "late stream"]
+
+    bundle[1][13].hooks.clear()
+    subscriptions_changed()
+    table((1, {252: 13}))
+    assert len(log) == 2
+
+
+def test_projection_keys():
+    bundle = StreamSeparator(SEPARATOR_MESSAGECODE)
+    bundle[1] = StreamSeparator(252)
+    projected = bundle[1].add_stream(10, MessageStream(MessageTranslator([
+        TranslateDefinition(0, "value"),
+    ]), projected=True))
+    projected.add_hook(lambda target: None)
+    bundle[1].add_stream(11, MessageStream()).add_hook(lambda target: None)
+    table = DispatchTable(bundle)
+
+    # the translated keys and the sub code the table looks at
+    assert table.projection(1, {252: 10}.get) == frozenset((0, 252))
+    # the whole message for the others
+    assert table.projection(1, {252: 11}.get) is None
+    assert table.has_projections(1)
+    assert not table.has_projections(2)
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+import event
+from event import Serialized, SerializedJSON, drain_queue, emit_frame, set_coalescing
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event_name, data, to=None):
+        self.emitted.append((event_name, SerializedJSON.dumps([event_name, data]), to))
+
+
+@pytest.fixture(autouse=True)
+def clean_event_state(monkeypatch):
+    monkeypatch.setattr(event, "coalescing", {})
+    monkeypatch.setattr(event, "room_subscribers", {})
+    monkeypatch.setattr(event, "client_rooms", {})
+    monkeypatch.setattr(event, "event_queue", event.BoundedQueue(100, default_policy="drop_oldest"))
+    monkeypatch.setattr(event, "queue_consumer", True)
+    monkeypatch.setattr(event, "socketio", FakeSocketIO(), raising=False)
+
+
+def drain(*items):
+    for event_name, data in items[1:]:
+        event.event_queue.put_nowait(event_name, data)
+    return drain_queue(items[0])
+
+
+def test_every_payload_without_coalescing():
+    assert drain(("a", 1), ("b", 2), ("a", 3)) == [("a", [1]), ("b", [2]), ("a", [3])]
+
+
+def test_latest_keeps_the_last_payload_at_the_first_position():
+    set_coalescing("a", "latest")
+    assert drain(("a", 1), ("b", 2), ("a", 3), ("a", 4)) == [("a", [4]), ("b", [2])]
+
+
+def test_batch_collects_the_payloads_in_order():
+    set_coalescing("a", "batch")
+    set_coalescing("b", "latest")
+    assert drain(("a", 1), ("b", 2), ("a", 3), ("b", 4), ("c", 5)) == [("a", [1, 3]), ("b", [4]), ("c", [5])]
+
+
+def test_coalescing_can_be_turned_off():
+    set_coalescing("a", "batch")
+    set_coalescing("a", None)
+    assert drain(("a", 1), ("a", 2)) == [("a", [1]), ("a", [2])]
+
+    with pytest.raises(ValueError):
+        set_coalescing("a", "first")
+
+
+def test_frames_are_only_emitted_to_subscribed_rooms():
+    event.add_subscriber("sid", "a")
+    emit_frame("a", [{"x": 1}])
+    emit_frame("b", [{"x": 2}])
+    assert event.socketio.emitted == [("a", '["a",{"x":1}]', "a")]
+
+    event.remove_subscriber("sid", "a")
+    emit_frame("a", [{"x": 3}])
+    assert len(event.socketio.emitted) == 1
+
+
+def test_batch_frames_are_a_list():
+    event.add_subscriber("sid", "a")
+    set_coalescing("a", "batch")
+    for event_name, payloads in drain(("a", {"x": 1}), ("a", {"x": 2})):
+        emit_frame(event_name, payloads)
+    assert [json.loads(packet) for _, packet, _ in event.socketio.emitted] == [["a", [{"x": 1}, {"x": 2}]]]
+
+
+def test_payloads_json_cant_hold_are_left_to_socketio():
+    data = {"raw": b"\x00"}
+    assert event.serialize(data) is data
+    assert isinstance(event.serialize({"x": 1}), Serialized)
+
+
+def test_send_event_only_queues_for_subscribers():
+    event.send_event("a", 1)
+    assert event.event_queue.qsize() == 0
+
+    event.add_subscriber("first", "a")
+    event.add_subscriber("second", "a")
+    event.send_event("a", 2)
+    assert event.event_queue.get_nowait() == ("a", 2)
+
+    event.remove_subscriber("first", "a")
+    assert event.has_subscribers("a")
+    event.remove_subscriber("second", "a")
+    assert not event.has_subscribers("a")
@@ -0,0 +1,122 @@
+from struct import Struct
+
+import pytest
+
+import pcap_reader
+import traffic_generator
+from pcap_reader import PcapReader
+from traffic_generator import CLIENT_TO_SERVER, SERVER_TO_CLIENT, ethernet_frame, write_pcap
+
+PCAP_HEADER = Struct("<IHHiIII")
+PCAP_RECORD = Struct("<IIII")
+BLOCK_HEADER = Struct("<II")
+
+
+def datagrams():
+    return [
+        (1.5, SERVER_TO_CLIENT, b"first"),
+        (2.25, CLIENT_TO_SERVER, b"second" * 50),
+        (3.0, SERVER_TO_CLIENT, b"third" * 300),
+    ]
+
+
+def read(path):
+    with PcapReader(str(path)) as reader:
+        return [(timestamp, five_tuple, bytes(payload)) for timestamp, five_tuple, payload in reader]
+
+
+def write_frames(path, frames):
+    '''
+    a pcap of (frame, captured_length) records, the captured part of each frame only
+    '''
+    with open(path, "wb") as f:
+        f.write(PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, 0xFFFF, 1))
+        for frame, captured_length in frames:
+            f.write(PCAP_RECORD.pack(0, 0, captured_length, len(frame)))
+            f.write(frame[:captured_length])
+
+
+def pcapng_block(block_type, body):
+    body += b"\x00" * (-len(body) % 4)
+    length = len(body) + 12
+    return BLOCK_HEADER.pack(block_type, length) + body + length.to_bytes(4, "little")
+
+
+def write_pcapng(path, items):
+    blocks = [
+        pcapng_block(pcap_reader.PCAPNG_SECTION_HEADER, Struct("<IHHq").pack(pcap_reader.PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)),
+        # if_tsresol 10^-3
+        pcapng_block(pcap_reader.PCAPNG_INTERFACE_DESCRIPTION, Struct("<HHI").pack(1, 0, 0xFFFF) + Struct("<HHB3x").pack(9, 1, 3) + b"\x00" * 4),
+    ]
+    for timestamp, five_tuple, payload in items:
+        frame = ethernet_frame(five_tuple, payload)
+        ticks = int(timestamp * 1000)
+        blocks.append(pcapng_block(pcap_reader.PCAPNG_ENHANCED_PACKET, Struct("<IIIII").pack(0, ticks >> 32, ticks & 0xFFFFFFFF, len(frame), len(frame)) + frame))
+    with open(path, "wb") as f:
+        f.write(b"".join(blocks))
+
+
+def test_pcap_round_trip(tmp_path):
+    path = tmp_path / "capture.pcap"
+    write_pcap(str(path), datagrams())
+    assert read(path) == datagrams()
+
+
+def test_other_ports_are_skipped(tmp_path):
+    path = tmp_path / "capture.pcap"
+    other = traffic_generator.FiveTuple("10.0.0.1", 53, "192.168.0.2", 50000)
+    write_pcap(str(path), [(1.0, other, b"dns")] + datagrams())
+    with PcapReader(str(path)) as reader:
+        assert [bytes(payload) for _, _, payload in reader] == [payload for _, _, payload in datagrams()]
+        assert reader.frames == 4
+
+
+@pytest.mark.parametrize("cut", [1, 10, 100, 1000])
+def test_pcap_cut_in_the_last_frame(tmp_path, cut):
+    path = tmp_path / "capture.pcap"
+    write_pcap(str(path), datagrams())
+    data = path.read_bytes()
+    path.write_bytes(data[:-cut])
+
+    assert read(path) == datagrams()[:-1]
+
+
+def test_pcap_cut_in_a_record_header(tmp_path):
+    path = tmp_path / "capture.pcap"
+    write_pcap(str(path), datagrams()[:1])
+    path.write_bytes(path.read_bytes() + PCAP_RECORD.pack(0, 0, 100, 100)[:10])
+
+    assert read(path) == datagrams()[:1]
+
+
+def test_frames_cut_by_the_snaplen_are_skipped(tmp_path):
+    path = tmp_path / "capture.pcap"
+    frame = ethernet_frame(SERVER_TO_CLIENT, b"x" * 200)
+    # in the UDP payload, the UDP header, the IPv4 header and the Ethernet header
+    write_frames(path, [(frame, 100), (frame, 40), (frame, 20), (frame, 10), (frame, len(frame))])
+
+    assert read(path) == [(0.0, SERVER_TO_CLIENT, b"x" * 200)]
+
+
+def test_vlan_tags_cut_short(tmp_path):
+    path = tmp_path / "capture.pcap"
+    frame = ethernet_frame(SERVER_TO_CLIENT, b"x" * 20)
+    tagged = frame[:12] + b"\x81\x00\x00\x01" * 8 + frame[12:]
+    write_frames(path, [(tagged, 30), (tagged, len(tagged))])
+
+    assert read(path) == [(0.0, SERVER_TO_CLIENT, b"x" * 20)]
+
+
+def test_pcapng(tmp_path):
+    path = tmp_path / "capture.pcapng"
+    write_pcapng(path, datagrams())
+    assert read(path) == datagrams()
+
+
+@pytest.mark.parametrize("cut", [1, 10, 100, 1000])
+def test_pcapng_cut_in_the_last_block(tmp_path, cut):
+    path = tmp_path / "capture.pcapng"
+    write_pcapng(path, datagrams())
+    path.write_bytes(path.read_bytes()[:-cut])
+
+    assert read(path) == datagrams()[:-1]
@@ -0,0 +1,80 @@
+import pytest
+
+import protocol16_parser as protocol16
+from protocol16_serializer import Serialize_Object, Serialize_EventData, Typed
+
+
+def round_trip(value):
+    parsed, offset = protocol16.Parse_Object_at(Serialize_Object(value), 0)
+    return parsed
+
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, 1, 0xFFFF_FFFF, 0x1_0000_0000, 1.5, b"\x00\x01",
+    [b"a", 1, None], {1: b"x", b"k": [2.5]},
+])
+def test_round_trip(value):
+    assert round_trip(value) == value
+
+
+@pytest.mark.parametrize("type_code, value", [("b", 200), ("k", 65535), ("i", 7), ("l", 2**63), ("f", 0.5), ("d", -2.25)])
+def test_typed_round_trip(type_code, value):
+    assert round_trip(Typed(type_code, value)) == value
+
+
+def test_strings_come_back_as_bytes():
+    assert round_trip("héllo") == "héllo".encode()
+    assert round_trip(["a", "b"]) == [b"a", b"b"]
+
+
+@pytest.mark.parametrize("value, type_code, unsigned", [
+    (-5, "i", 2**32 - 5),
+    (-2**31, "i", 2**31),
+    (-2**31 - 1, "l", 2**64 - 2**31 - 1),
+    (-2**63, "l", 2**63),
+])
+def test_negative_ints_in_twos_complement(value, type_code, unsigned):
+    data = Serialize_Object(value)
+    assert data[0] == ord(type_code)
+    assert round_trip(value) == unsigned
+
+
+@pytest.mark.parametrize("value", [2**64, -2**63 - 1])
+def test_ints_out_of_range(value):
+    with pytest.raises(ValueError):
+        Serialize_Object(value)
+
+
+def test_typed_out_of_range():
+    with pytest.raises(ValueError):
+        Serialize_Object(Typed("k", -0x8001))
+    assert round_trip(Typed("k", -1)) == 0xFFFF
+    assert round_trip(Typed("b", -1)) == 0xFF
+
+
+@pytest.mark.parametrize("element_type, bits", [("b", 8), ("k", 16), ("i", 32), ("l", 64)])
+def test_negative_typed_arrays(element_type, bits):
+    parsed = round_trip(Typed("y", [-1, 2, -3], element_type=element_type))
+    assert list(parsed) == [2**bits - 1, 2, 2**bits - 3]
+
+
+@pytest.mark.parametrize("dtype", ["i1", "i2", "i4", "i8"])
+def test_negative_numpy_arrays(dtype):
+    numpy = pytest.importorskip("numpy")
+    array = numpy.array([-1, 0, 5, numpy.iinfo(dtype).min], dtype=dtype)
+    parsed = round_trip(array)
+    assert list(parsed) == list(array.astype(dtype.replace("i", "u")))
+
+
+@pytest.mark.parametrize("dtype", ["u2", "f4", "f8"])
+def test_numpy_arrays(dtype):
+    numpy = pytest.importorskip("numpy")
+    array = numpy.array([1, 0, 5], dtype=dtype)
+    assert list(round_trip(array)) == list(array)
+
+
+def test_event_data_round_trip():
+    parameters = {252: Typed("k", 82), 1: Typed("l", 1000), 2: b"name"}
+    code, parsed = protocol16.Parse_EventData_at(Serialize_EventData((1, parameters)))[0]
+    assert code == 1
+    assert parsed == {252: 82, 1: 1000, 2: b"name"}
@@ -0,0 +1,128 @@
+from reassembly import FragmentReassembler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fragments(command: bytes, size: int, start_sequence_number=10):
+    '''
+    (start_sequence_number, fragment_number, fragment_count, total_length, fragment_offset, fragment) of command split every size bytes
+    '''
+    offsets = range(0, len(command), size)
+    return [
+        (start_sequence_number, number, len(offsets), len(command), offset, command[offset:offset + size])
+        for number, offset in enumerate(offsets)
+    ]
+
+
+def add(reassembler, fragment, peer="peer", channel_id=0):
+    return reassembler.add(peer, channel_id, *fragment)
+
+
+def test_fragments_in_any_order():
+    command = bytes(range(256)) * 3
+    reassembler = FragmentReassembler()
+    parts = fragments(command, 100)
+
+    results = [add(reassembler, fragment) for fragment in reversed(parts)]
+    assert results[:-1] == [None] * (len(parts) - 1)
+    assert bytes(results[-1]) == command
+    assert reassembler.stats()["completed"] == 1
+    assert reassembler.stats()["pending"] == 0
+    assert reassembler.buffered_bytes == 0
+
+
+def test_peers_and_channels_are_separate():
+    reassembler = FragmentReassembler()
+    first, second = fragments(b"a" * 20, 10)
+
+    assert add(reassembler, first, peer="a") is None
+    assert add(reassembler, second, peer="b") is None
+    assert add(reassembler, second, peer="a", channel_id=1) is None
+    assert bytes(add(reassembler, second, peer="a")) == b"a" * 20
+
+
+def test_fragment_past_the_end_is_malformed():
+    reassembler = FragmentReassembler()
+    # 8 bytes at offset 16 of a 20 byte command
+    assert reassembler.add("peer", 0, 10, 1, 2, 20, 16, b"x" * 8) is None
+    assert reassembler.malformed == 1
+    # rejected before allocating a buffer
+    assert reassembler.pending == {}
+    assert reassembler.buffered_bytes == 0
+
+
+def test_fragment_ending_exactly_at_the_end():
+    reassembler = FragmentReassembler()
+    assert reassembler.add("peer", 0, 10, 1, 2, 20, 12, b"y" * 8) is None
+    assert bytes(reassembler.add("peer", 0, 10, 0, 2, 20, 0, b"x" * 12)) == b"x" * 12 + b"y" * 8
+    assert reassembler.malformed == 0
+
+
+def test_fragment_number_out_of_range_is_malformed():
+    reassembler = FragmentReassembler()
+    assert reassembler.add("peer", 0, 10, 2, 2, 20, 0, b"x" * 10) is None
+    assert reassembler.malformed == 1
+    assert reassembler.pending == {}
+
+
+def test_fragment_not_matching_the_first_one_is_malformed():
+    reassembler = FragmentReassembler()
+    assert reassembler.add("peer", 0, 10, 0, 2, 20, 0, b"x" * 10) is None
+    # another fragment count, then another total length for the same command
+    assert reassembler.add("peer", 0, 10, 1, 3, 20, 10, b"y" * 10) is None
+    assert reassembler.add("peer", 0, 10, 1, 2, 30, 10, b"y" * 10) is None
+    assert reassembler.malformed == 2
+
+    assert bytes(reassembler.add("peer", 0, 10, 1, 2, 20, 10, b"y" * 10)) == b"x" * 10 + b"y" * 10
+
+
+def test_oversized_command_is_dropped():
+    reassembler = FragmentReassembler(max_total_length=100)
+    assert reassembler.add("peer", 0, 10, 0, 2, 101, 0, b"x" * 10) is None
+    assert reassembler.oversized == 1
+    assert reassembler.pending == {}
+
+
+def test_duplicate_fragments():
+    reassembler = FragmentReassembler()
+    first, second = fragments(b"abcdefghij", 5)
+
+    assert add(reassembler, first) is None
+    assert add(reassembler, first) is None
+    assert bytes(add(reassembler, second)) == b"abcdefghij"
+    # retransmitted after completion
+    assert add(reassembler, first) is None
+    assert add(reassembler, second) is None
+    assert reassembler.duplicates == 3
+    assert reassembler.completed == 1
+
+
+def test_incomplete_commands_expire():
+    clock = FakeClock()
+    reassembler = FragmentReassembler(timeout=10, clock=clock)
+    add(reassembler, fragments(b"x" * 20, 10)[0])
+
+    clock.now = 11
+    reassembler.evict_expired()
+    assert reassembler.evicted_timeout == 1
+    assert reassembler.evicted_bytes == 20
+    assert reassembler.pending == {}
+    assert reassembler.buffered_bytes == 0
+
+
+def test_oldest_commands_evicted_over_the_memory_limit():
+    reassembler = FragmentReassembler(max_buffered_bytes=50)
+    add(reassembler, fragments(b"a" * 30, 10, start_sequence_number=1)[0])
+    add(reassembler, fragments(b"b" * 20, 10, start_sequence_number=2)[0])
+    assert reassembler.buffered_bytes == 50
+
+    add(reassembler, fragments(b"c" * 20, 10, start_sequence_number=3)[0])
+    assert reassembler.evicted_memory == 1
+    assert [key[2] for key in reassembler.pending] == [2, 3]
+    assert reassembler.buffered_bytes == 40
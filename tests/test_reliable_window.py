@@ -0,0 +1,112 @@
+import photon_decoder as photon
+from reliable_window import ReliableWindow
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def reliable(sequence_number, channel_id=0):
+    return photon.CommandRecord(photon.RELIABLE_COMMAND, channel_id, 1, sequence_number, photon.EVENT_MESSAGE, bytes([sequence_number % 256]))
+
+
+def test_duplicates_in_the_window_are_dropped():
+    window = ReliableWindow(window_size=64)
+    assert [window.accept("peer", 0, number) for number in (1, 2, 3, 2, 1, 4)] == [True, True, True, False, False, True]
+    assert window.stats()["duplicates"] == 2
+
+
+def test_channels_and_peers_are_separate():
+    window = ReliableWindow()
+    assert window.accept("a", 0, 1)
+    assert window.accept("a", 1, 1)
+    assert window.accept("b", 0, 1)
+    assert not window.accept("a", 0, 1)
+
+
+def test_late_and_gaps():
+    window = ReliableWindow(window_size=64)
+    for number in (1, 2, 5, 3):
+        assert window.accept("peer", 0, number)
+    stats = window.stats()
+    assert stats["skipped"] == 2
+    assert stats["late"] == 1
+    assert stats["gaps"] == 1
+    assert stats["reorder_depth_max"] == 2
+
+
+def test_old_duplicates_behind_the_window_are_dropped():
+    window = ReliableWindow(window_size=16)
+    for number in range(1, 101):
+        assert window.accept("peer", 0, number)
+    # long gone retransmissions
+    assert not window.accept("peer", 0, 10)
+    assert not window.accept("peer", 0, 50)
+    assert window.stats()["stale"] == 2
+    assert window.stats()["resets"] == 0
+    # the sequence keeps going
+    assert window.accept("peer", 0, 101)
+
+
+def test_forward_jump_resets():
+    window = ReliableWindow(window_size=16)
+    window.accept("peer", 0, 1)
+    assert window.accept("peer", 0, 1000)
+    assert window.stats()["resets"] == 1
+    assert not window.accept("peer", 0, 1000)
+
+
+def test_start_over_resets_after_max_stale():
+    window = ReliableWindow(window_size=16, max_stale=4)
+    for number in range(1000, 1100):
+        window.accept("peer", 0, number)
+    accepted = [window.accept("peer", 0, number) for number in range(1, 10)]
+    assert accepted == [False, False, False, True, True, True, True, True, True]
+    assert window.stats()["resets"] == 1
+
+
+def test_reorder_releases_in_order():
+    window = ReliableWindow(reorder=True)
+    order = []
+    for number in (1, 3, 4, 2, 5):
+        order += [command.sequence_number for command in window.filter("peer", reliable(number))]
+    assert order == [1, 2, 3, 4, 5]
+    assert window.stats()["reordered"] == 2
+
+
+def test_reorder_gives_up_after_max_held():
+    window = ReliableWindow(reorder=True, max_held=2)
+    order = []
+    for number in (1, 3, 4, 5):
+        order += [command.sequence_number for command in window.filter("peer", reliable(number))]
+    assert order == [1, 3, 4, 5]
+    assert window.stats()["given_up"] == 1
+
+
+def test_flush_releases_the_held_commands():
+    window = ReliableWindow(reorder=True)
+    for number in (1, 3, 4):
+        window.filter("peer", reliable(number))
+    flushed = window.flush()
+    assert [(peer, [command.sequence_number for command in commands]) for peer, commands in flushed] == [("peer", [3, 4])]
+
+
+def test_unreliable_commands_go_through():
+    window = ReliableWindow()
+    command = photon.CommandRecord(photon.UNRELIABLE_COMMAND, 0, 0, 1)
+    assert list(window.filter_records("peer", [command, command])) == [command, command]
+
+
+def test_idle_channels_are_forgotten():
+    clock = FakeClock()
+    window = ReliableWindow(idle_timeout=10, clock=clock)
+    window.accept("peer", 0, 1)
+    clock.now = 100
+    window.accept("other", 0, 1)
+    assert window.stats()["channels"] == 1
+    # a new start for the forgotten channel
+    assert window.accept("peer", 0, 1)
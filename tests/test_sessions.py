@@ -0,0 +1,101 @@
+import pipeline
+import streams
+from capture import FiveTuple
+from protocol16_serializer import Typed
+from sessions import INCOMING, OUTGOING, SessionTable, direction, session_key, sessions
+from streams import state
+from traffic_generator import PhotonPeer, float_array
+
+FIRST_SERVER = FiveTuple("10.0.0.1", 5056, "192.168.0.2", 50000)
+FIRST_CLIENT = FiveTuple("192.168.0.2", 50000, "10.0.0.1", 5056)
+SECOND_SERVER = FiveTuple("10.0.0.1", 5056, "192.168.0.3", 50001)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_both_directions_share_a_session():
+    assert session_key(FIRST_SERVER) == session_key(FIRST_CLIENT) == ("192.168.0.2", 50000, "10.0.0.1", 5056)
+    assert direction(FIRST_SERVER) == INCOMING
+    assert direction(FIRST_CLIENT) == OUTGOING
+
+    table = SessionTable()
+    session = table.activate(FIRST_SERVER)
+    assert table.activate(FIRST_CLIENT) is session
+    assert session.client == ("192.168.0.2", 50000)
+    assert session.server == ("10.0.0.1", 5056)
+    assert len(table) == 1
+
+
+def test_activate_switches_the_state():
+    table = SessionTable()
+    first = table.activate(FIRST_SERVER)
+    first.location_id = "3004"
+    second = table.activate(SECOND_SERVER)
+    assert state.session is second
+    assert state.location_id is None
+
+    table.activate(FIRST_CLIENT)
+    assert state.session is first
+    assert state.location_id == "3004"
+    assert state.direction == OUTGOING
+
+
+def test_idle_sessions_are_forgotten():
+    clock = FakeClock()
+    table = SessionTable(idle_timeout=10, clock=clock)
+    first = table.activate(FIRST_SERVER)
+    table.activate(SECOND_SERVER)
+
+    clock.now = 8
+    table.activate(SECOND_SERVER)
+    clock.now = 12
+    table.evict_idle()
+    assert table.get(session_key(SECOND_SERVER)) is not None
+    assert table.get(session_key(FIRST_SERVER)) is None
+    assert FIRST_SERVER not in table.by_peer
+
+    # the connection coming back gets a new session
+    assert table.activate(FIRST_SERVER) is not first
+
+
+def player_info(server: PhotonPeer, player_name, location_id):
+    return server.response(2, {
+        1: bytes(16),
+        2: player_name,
+        8: location_id,
+        9: float_array(1.0, 2.0),
+    })
+
+
+def test_hooks_see_the_session_of_their_datagram():
+    sessions.clear()
+    state.session = None
+    first, second = PhotonPeer(), PhotonPeer()
+    seen = []
+
+    def fame_hook(target):
+        seen.append((state.session.player_name, state.location_id, target[1]["fame_gained"]))
+
+    streams.FameEvent.add_hook(fame_hook)
+    try:
+        for five_tuple, commands in (
+            (FIRST_SERVER, player_info(first, "First", "3004")),
+            (SECOND_SERVER, player_info(second, "Second", "1000")),
+            (FIRST_SERVER, first.event(82, {1: Typed("l", 100), 2: Typed("l", 100_000)})),
+            (SECOND_SERVER, second.event(82, {1: Typed("l", 200), 2: Typed("l", 200_000)})),
+        ):
+            for datagram in first.pack(commands):
+                pipeline.procces_photon_payload(datagram, five_tuple)
+    finally:
+        streams.FameEvent.hooks.remove(fame_hook)
+        streams.subscriptions_changed()
+
+    assert [session.player_name for session in sessions] == ["First", "Second"]
+    assert seen == [("First", "3004", 10), ("Second", "1000", 20)]
+    sessions.clear()
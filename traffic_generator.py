@@ -0,0 +1,391 @@
+import random
+from math import cos, sin, pi
+from struct import Struct
+from time import perf_counter, sleep
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import photon_decoder as photon
+import streams
+from streams import MessageStream, MessageTranslator, TranslateDefinition, TRANSLATOR_IGNORE
+from protocol16_serializer import Typed, Serialize_EventData, Serialize_OperationRequest, Serialize_OperationResponse
+from capture import FiveTuple
+
+'''
+Synthetic Photon traffic for load testing the pipeline beyond what the recorded captures contain
+
+Messages are encoded with protocol16_serializer and wrapped into
+ReliableCommand/UnreliableCommand/FragmentCommand datagrams(see photon_decoder.py for the layouts).
+Workloads produce (timestamp, five_tuple, payload) items, the same as pcap_reader.PcapReader, which can be:
+    written to a pcap file: write_pcap
+    fed to a pipeline callback(prn(payload, five_tuple)): replay, optionally at the workload's own rate
+
+usage:
+    python traffic_generator.py moves --rate 50000 --duration 10 -o captures/synthetic_moves.pcap
+    python traffic_generator.py fragmented --count 1000 --size 50000 -o captures/synthetic_fragmented.pcap
+'''
+
+COMMAND_HEADER = Struct(">BBBBI")
+PHOTON_HEADER = Struct(">HBBII")
+RELIABLE_HEADER = Struct(">I")
+UNRELIABLE_HEADER = Struct(">II")
+FRAGMENT_HEADER = Struct(">IIIIII")
+
+# fits an Ethernet frame with IPv4 and UDP headers
+MAX_DATAGRAM_SIZE = 1200
+
+
+def build_command(command_type, body, channel_id=0, flags=1):
+    return COMMAND_HEADER.pack(command_type, channel_id, flags, 0, COMMAND_HEADER.size + len(body)) + body
+
+
+def message_wrapper(message_type, payload):
+    return bytes((0, message_type)) + payload
+
+
+def build_datagram(commands: List[bytes], peer_id=0, timestamp=0, challenge=0):
+    return PHOTON_HEADER.pack(peer_id, 0, len(commands), timestamp & 0xFFFFFFFF, challenge) + b"".join(commands)
+
+
+class PhotonPeer:
+    '''
+    Wraps protocol16 payloads into commands, keeping the per channel sequence numbers
+    '''
+
+    def __init__(self, peer_id=0, fragment_size=MAX_DATAGRAM_SIZE - PHOTON_HEADER.size - COMMAND_HEADER.size - FRAGMENT_HEADER.size):
+        self.peer_id = peer_id
+        self.fragment_size = fragment_size
+        self.reliable_sequence: Dict[int, int] = {}
+        self.unreliable_sequence: Dict[int, int] = {}
+
+    def next_reliable(self, channel_id):
+        self.reliable_sequence[channel_id] = self.reliable_sequence.get(channel_id, 0) + 1
+        return self.reliable_sequence[channel_id]
+
+    def reliable(self, message_type, payload, channel_id=0) -> List[bytes]:
+        '''
+        returns the commands carrying the message, fragmented if it doesn't fit a datagram
+        '''
+        message = message_wrapper(message_type, payload)
+        if len(message) > self.fragment_size:
+            return self.fragmented(message, channel_id)
+
+        body = RELIABLE_HEADER.pack(self.next_reliable(channel_id)) + message
+        return [build_command(photon.RELIABLE_COMMAND, body, channel_id)]
+
+    def unreliable(self, message_type, payload, channel_id=0) -> List[bytes]:
+        self.unreliable_sequence[channel_id] = self.unreliable_sequence.get(channel_id, 0) + 1
+        body = UNRELIABLE_HEADER.pack(self.reliable_sequence.get(channel_id, 0), self.unreliable_sequence[channel_id])
+        body += message_wrapper(message_type, payload)
+        return [build_command(photon.UNRELIABLE_COMMAND, body, channel_id, flags=0)]
+
+    def fragmented(self, message, channel_id=0) -> List[bytes]:
+        chunks = [message[offset:offset + self.fragment_size] for offset in range(0, len(message), self.fragment_size)]
+        start_sequence_number = None
+        commands = []
+        for fragment_number, chunk in enumerate(chunks):
+            sequence_number = self.next_reliable(channel_id)
+            if start_sequence_number is None:
+                start_sequence_number = sequence_number
+
+            body = FRAGMENT_HEADER.pack(
+                sequence_number, start_sequence_number, len(chunks),
+                fragment_number, len(message), fragment_number * self.fragment_size
+            ) + chunk
+            commands.append(build_command(photon.FRAGMENT_COMMAND, body, channel_id))
+        return commands
+
+    def event(self, code, parameters, reliable=False):
+        payload = Serialize_EventData((1, {**parameters, 252: Typed("k", code)}))
+        if reliable:
+            return self.reliable(photon.EVENT_MESSAGE, payload)
+        return self.unreliable(photon.EVENT_MESSAGE, payload)
+
+    def request(self, code, parameters):
+        return self.reliable(photon.REQUEST_MESSAGE, Serialize_OperationRequest((1, {**parameters, 253: Typed("k", code)})))
+
+    def response(self, code, parameters, return_code=0):
+        return self.reliable(photon.RESPONSE_MESSAGE, Serialize_OperationResponse((1, return_code, None, {**parameters, 253: Typed("k", code)})))
+
+    def pack(self, commands: Iterable[bytes], timestamp=0) -> Iterator[bytes]:
+        '''
+        Packs commands into as few datagrams as possible
+        '''
+        batch, size = [], PHOTON_HEADER.size
+        for command in commands:
+            if batch and (size + len(command) > MAX_DATAGRAM_SIZE or len(batch) == 255):
+                yield build_datagram(batch, self.peer_id, timestamp)
+                batch, size = [], PHOTON_HEADER.size
+            batch.append(command)
+            size += len(command)
+        if batch:
+            yield build_datagram(batch, self.peer_id, timestamp)
+
+
+# (timestamp, five_tuple, payload), same as pcap_reader
+Datagram = Tuple[float, FiveTuple, bytes]
+
+SERVER_TO_CLIENT = FiveTuple("10.0.0.1", 5056, "192.168.0.2", 50000)
+CLIENT_TO_SERVER = FiveTuple("192.168.0.2", 50000, "10.0.0.1", 5056)
+
+
+workloads: Dict[str, Callable[..., Iterator[Datagram]]] = {}
+
+def add_workload(func):
+    workloads[func.__name__] = func
+    return func
+
+
+def float_array(*values):
+    return Typed("y", list(values), element_type="f")
+
+
+class MovingEntities:
+    '''
+    entities walking in circles, producing move events(event 1, 252: 3)
+    '''
+
+    def __init__(self, entities, rng):
+        self.positions = [(rng.uniform(-500, 500), rng.uniform(-500, 500), rng.uniform(0, 2 * pi)) for _ in range(entities)]
+        self.next_entity = 0
+
+    def move_events(self, peer: PhotonPeer, count, timestamp):
+        commands = []
+        for _ in range(count):
+            entity = self.next_entity
+            self.next_entity = (self.next_entity + 1) % len(self.positions)
+
+            x, y, angle = self.positions[entity]
+            angle += 0.05
+            self.positions[entity] = x, y, angle
+            commands += peer.event(3, {
+                0: entity,
+                1: Typed("l", int(timestamp * 1000)),
+                2: float_array(x + 10 * cos(angle), y + 10 * sin(angle)),
+                3: Typed("f", angle * 180 / pi),
+                4: float_array(x + 10 * cos(angle + 0.05), y + 10 * sin(angle + 0.05)),
+                5: Typed("f", 5.5),
+            })
+        return commands
+
+
+def add_move_event_stream() -> MessageStream:
+    '''
+    the stream of the move events of MovingEntities, for trying spatial.py on synthetic traffic:
+        spatial.enable(move_event=add_move_event_stream())
+    not in streams.py, the layout is made up and not confirmed against the game
+    '''
+    separator = streams.EventBundle[1]
+    if 3 in separator.streams:
+        return separator[3]
+    return separator.add_stream(3, MessageStream(MessageTranslator([
+        TranslateDefinition(252, TRANSLATOR_IGNORE),
+        TranslateDefinition(0,   "object_id"),
+        TranslateDefinition(1,   "timestamp"),
+        TranslateDefinition(2,   "pos"),
+        TranslateDefinition(3,   "angle",       presence_guaranteed=False), #degrees
+        TranslateDefinition(4,   "dst",         presence_guaranteed=False),
+        TranslateDefinition(5,   "speed",       presence_guaranteed=False),
+    ])))
+
+
+def request_move(client: PhotonPeer, tick_number, timestamp):
+    '''
+    the local player's streams.RequestMove
+    '''
+    x, y = tick_number * 0.1, 0.0
+    return client.request(21, {
+        0: Typed("l", int(timestamp * 1000)),
+        1: float_array(x, y),
+        2: Typed("f", 90.0),
+        3: float_array(x + 0.1, y),
+        4: Typed("f", 5.5),
+    })
+
+
+def player_info_response(server: PhotonPeer, rng, number, size):
+    '''
+    streams.PlayerInfoResponse padded with about size bytes of extra parameters,
+    like the inventory and equipment parameters of the real responses
+    '''
+    parameters = {
+        1: bytes(rng.randrange(256) for _ in range(16)),
+        2: f"Player{number}",
+        8: "3004",
+        9: float_array(rng.uniform(-500, 500), rng.uniform(-500, 500)),
+        52: "Guild",
+    }
+    for key in range(100, 250):
+        parameters[key] = Typed("y", [rng.randrange(2**31) for _ in range(size // 150 // 4)], element_type="i")
+
+    return server.response(2, parameters)
+
+
+@add_workload
+def moves(rate=50_000, duration=1.0, entities=200, tick=0.05, seed=0) -> Iterator[Datagram]:
+    '''
+    rate move events per second, plus a RequestMove every tick
+    '''
+    return mixed(rate=rate, duration=duration, entities=entities, tick=tick, seed=seed, responses_per_second=0)
+
+
+@add_workload
+def fragmented(count=100, size=50_000, interval=0.01, seed=0) -> Iterator[Datagram]:
+    '''
+    count large responses, each split into FragmentCommands
+    '''
+    rng = random.Random(seed)
+    server = PhotonPeer()
+    for i in range(count):
+        timestamp = i * interval
+        for payload in server.pack(player_info_response(server, rng, i, size), int(timestamp * 1000)):
+            yield timestamp, SERVER_TO_CLIENT, payload
+
+
+@add_workload
+def mixed(rate=5_000, duration=1.0, entities=200, tick=0.05, seed=0, responses_per_second=1, size=50_000) -> Iterator[Datagram]:
+    '''
+    move events and RequestMoves(see moves) with responses_per_second large fragmented responses
+    '''
+    rng = random.Random(seed)
+    server = PhotonPeer()
+    client = PhotonPeer()
+    entities = MovingEntities(entities, rng)
+
+    per_tick = max(1, round(rate * tick))
+    responses = 0
+    for tick_number in range(int(duration / tick)):
+        timestamp = tick_number * tick
+        commands = entities.move_events(server, per_tick, timestamp)
+        while responses < responses_per_second * (timestamp + tick):
+            commands += player_info_response(server, rng, responses, size)
+            responses += 1
+
+        for payload in server.pack(commands, int(timestamp * 1000)):
+            yield timestamp, SERVER_TO_CLIENT, payload
+
+        for payload in client.pack(request_move(client, tick_number, timestamp), int(timestamp * 1000)):
+            yield timestamp, CLIENT_TO_SERVER, payload
+
+
+def unreliable_network(items: Iterable[Datagram], duplicates=0.0, reorders=0.0, seed=0) -> Iterator[Datagram]:
+    '''
+    what a capture of a lossy link looks like
+    duplicates: share of the datagrams sent again a few datagrams later(retransmitted)
+    reorders:   share of the datagrams swapped with the next one of their connection
+    '''
+    rng = random.Random(seed)
+    # datagrams waiting to be sent again, in number of datagrams
+    retransmits: List[Tuple[int, Datagram]] = []
+    # connection => datagram held back to be swapped
+    held: Dict[FiveTuple, Datagram] = {}
+
+    for item in items:
+        five_tuple = item[1]
+        if five_tuple in held:
+            yield item
+            item = held.pop(five_tuple)
+        elif rng.random() < reorders:
+            held[five_tuple] = item
+            continue
+
+        yield item
+        if rng.random() < duplicates:
+            retransmits.append((rng.randint(1, 8), item))
+
+        due = [retransmit for retransmit in retransmits if retransmit[0] <= 1]
+        retransmits = [(delay - 1, retransmit) for delay, retransmit in retransmits if delay > 1]
+        for _, retransmit in due:
+            yield retransmit
+
+    yield from held.values()
+    for _, retransmit in retransmits:
+        yield retransmit
+
+
+PCAP_HEADER = Struct("<IHHiIII")
+PCAP_RECORD = Struct("<IIII")
+ETHERNET_HEADER = Struct(">6s6sH")
+IPV4_HEADER = Struct(">BBHHHBBH4s4s")
+UDP_HEADER = Struct(">HHHH")
+
+
+def ipv4_checksum(header):
+    total = sum(Struct(">10H").unpack(header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def ethernet_frame(five_tuple: FiveTuple, payload: bytes, ip_id=0):
+    from socket import inet_aton
+
+    udp = UDP_HEADER.pack(five_tuple.sport, five_tuple.dport, UDP_HEADER.size + len(payload), 0)
+    total_length = IPV4_HEADER.size + len(udp) + len(payload)
+    ip = IPV4_HEADER.pack(0x45, 0, total_length, ip_id & 0xFFFF, 0, 64, 17, 0, inet_aton(five_tuple.src), inet_aton(five_tuple.dst))
+    ip = ip[:10] + ipv4_checksum(ip).to_bytes(2, "big") + ip[12:]
+    return ETHERNET_HEADER.pack(b"\x02\x00\x00\x00\x00\x01", b"\x02\x00\x00\x00\x00\x02", 0x0800) + ip + udp + payload
+
+
+def write_pcap(path: str, items: Iterable[Datagram]) -> int:
+    '''
+    Writes the datagrams as Ethernet/IPv4/UDP frames to a pcap file
+    returns the number of written frames
+    '''
+    written = 0
+    with open(path, "wb") as f:
+        f.write(PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, 0xFFFF, 1))
+        for timestamp, five_tuple, payload in items:
+            frame = ethernet_frame(five_tuple, payload, written)
+            seconds = int(timestamp)
+            f.write(PCAP_RECORD.pack(seconds, int((timestamp - seconds) * 1e6), len(frame), len(frame)))
+            f.write(frame)
+            written += 1
+    return written
+
+
+def replay(items: Iterable[Datagram], prn: Callable[[memoryview, FiveTuple], None], realtime=False) -> int:
+    '''
+    Feeds the datagrams to prn(payload, five_tuple), same callback as pcap_reader.replay
+    realtime: keep to the timestamps of the workload instead of going as fast as possible
+
+    returns the number of datagrams replayed
+    '''
+    replayed = 0
+    start = perf_counter()
+    first_timestamp = None
+    for timestamp, five_tuple, payload in items:
+        if realtime:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) - (perf_counter() - start)
+            if delay > 0:
+                sleep(delay)
+        prn(memoryview(payload), five_tuple)
+        replayed += 1
+    return replayed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from inspect import signature
+
+    parser = ArgumentParser(description="Generate synthetic Photon traffic")
+    parser.add_argument("workload", choices=workloads)
+    parser.add_argument("-o", "--output", required=True, help="pcap file to write")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="share of the datagrams retransmitted, see unreliable_network")
+    parser.add_argument("--reorders", type=float, default=0.0, help="share of the datagrams out of order")
+    # every workload parameter as an option, eg: --rate 50000
+    options = {}
+    for workload in workloads.values():
+        for parameter in signature(workload).parameters.values():
+            options[parameter.name] = type(parameter.default)
+    for name, option_type in options.items():
+        parser.add_argument("--" + name, type=option_type)
+    args = parser.parse_args()
+
+    workload = workloads[args.workload]
+    kwargs = {name: getattr(args, name) for name in signature(workload).parameters if getattr(args, name) is not None}
+    items = workload(**kwargs)
+    if args.duplicates or args.reorders:
+        items = unreliable_network(items, args.duplicates, args.reorders, kwargs.get("seed", 0))
+    print(f"{write_pcap(args.output, items)} frames written to {args.output}")